@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List
+import numpy as np
+
+from benchmarks import synthetic
+
+# Times the model's stages on synthetic watersheds and stores them as JSON for regression comparison:
+#   python -m benchmarks.run --drains 1000 10000 --output results.json
+#   python -m benchmarks.run --drains 1000 10000 --output new.json --baseline results.json
+# load         model.data reading and validating the files and routing road segments to drains
+# connectivity drains.get_nodes() and ponds.get_nodes(), tracing every flowpath
+# graph        Graph.add_nodes() and engine.build_topology()
+# events       every rainfall event through the batched engine, as Model.run does
+# The model reads its configuration from the working directory on import, so every scale runs in
+# its own process from the directory its watershed is written to. Without load/connectivity the
+# generator's own nodes are used, which is how the graph and events stages are run at scales the
+# loader can't handle (events alone go up to a million drains).
+
+STAGES = ['load', 'connectivity', 'graph', 'events']
+REPOSITORY = Path(__file__).resolve().parents[1]
+
+@contextmanager
+def stage(stages: Dict[str, Dict[str, float]], name: str, memory: bool) -> Iterator[Dict[str, float]]:
+    record: Dict[str, float] = {}
+    if memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield record
+    record['seconds'] = time.perf_counter() - start
+    if memory:
+        record['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    stages[name] = record
+
+def environment() -> Dict[str, str | None]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': str(os.cpu_count()),
+    }
+
+def run_scale(n_drains: int, seed: int, n_events: int, stages: List[str], directory: Path, memory: bool) -> Dict[str, object]:
+    timings: Dict[str, Dict[str, float]] = {}
+    if memory:
+        tracemalloc.start()
+
+    with stage(timings, 'generate', memory):
+        watershed = synthetic.generate(n_drains=n_drains, seed=seed, n_events=n_events)
+        watershed.write(directory, spatial='load' in stages)
+    os.chdir(directory)
+
+    # Imported here, utils.config finds the configuration relative to the working directory
+    from model import engine, graph
+
+    nodes = None
+    if 'load' in stages:
+        with stage(timings, 'load', memory):
+            from model import data
+            data.elevation, data.roads, data.drains, data.ponds, data.flowpaths # The data modules load on first use
+        if 'connectivity' in stages:
+            with stage(timings, 'connectivity', memory):
+                drains, ponds = data.drains.get_nodes(), data.ponds.get_nodes()
+            nodes = drains + ponds
+
+    topology = None
+    if 'graph' in stages:
+        with stage(timings, 'graph', memory):
+            base_graph = graph.Graph()
+            base_graph.add_nodes(nodes if nodes is not None else watershed.graph_nodes())
+            topology = engine.build_topology(base_graph)
+
+    if 'events' in stages:
+        if topology is None:
+            topology = watershed.topology()
+        with stage(timings, 'events', memory) as record:
+            batch_size = engine.batch_size(topology)
+            aggregates = engine.EventAggregates.empty(topology.n_nodes)
+            for first in range(0, n_events, batch_size):
+                aggregates.add(engine.run_events(topology, watershed.rainfall[first:first + batch_size]))
+            record['batch_size'] = batch_size
+        timings['events']['seconds_per_event'] = timings['events']['seconds'] / max(n_events, 1)
+
+    if memory:
+        tracemalloc.stop()
+    return {
+        'drains': n_drains,
+        'seed': seed,
+        'events': n_events,
+        'dataset': watershed.summary(),
+        'stages': timings,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+    }
+
+def compare(results: Dict[str, object], baseline: Dict[str, object], threshold: float) -> bool:
+    # Prints every stage's time against the baseline run of the same scale, False if any got slower than threshold x
+    previous = {(run['drains'], run['seed'], run['events']): run for run in baseline['runs']}
+    passed = True
+    print(f"{'drains':>9} {'stage':<13} {'baseline (s)':>12} {'now (s)':>10} {'ratio':>7}")
+    for run in results['runs']:
+        before = previous.get((run['drains'], run['seed'], run['events']))
+        if before is None:
+            print(f"{run['drains']:>9} no baseline run at this scale")
+            continue
+        for name, record in run['stages'].items():
+            if name not in before['stages']:
+                continue
+            ratio = record['seconds'] / max(before['stages'][name]['seconds'], 1e-9)
+            slower = ratio > threshold
+            passed &= not slower
+            print(f"{run['drains']:>9} {name:<13} {before['stages'][name]['seconds']:>12.3f} {record['seconds']:>10.3f} {ratio:>7.2f}{'  SLOWER' if slower else ''}")
+    return passed
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Time the model on synthetic watersheds")
+    parser.add_argument('--drains', type=int, nargs='+', default=[1000], help="Approximate number of drains, one run per scale")
+    parser.add_argument('--events', type=int, default=100, help="Rainfall events per run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--data', type=Path, help="Keep the generated watersheds in this directory")
+    parser.add_argument('--no-memory', action='store_true', help="Don't trace memory (tracing slows Python-heavy stages down)")
+    parser.add_argument('--output', type=Path, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', type=Path, help="Compare against the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Ratio to the baseline counted as a regression")
+    args = parser.parse_args(argv)
+
+    if 'connectivity' in args.stages and 'load' not in args.stages:
+        parser.error("the connectivity stage needs the load stage")
+    # A run changes the working directory
+    output, baseline = (path.resolve() if path is not None else None for path in (args.output, args.baseline))
+
+    runs = []
+    for n_drains in args.drains:
+        with tempfile.TemporaryDirectory() as scratch:
+            directory = (args.data / f"drains_{n_drains}") if args.data is not None else Path(scratch) / 'watershed'
+            directory = directory.resolve()
+            if len(args.drains) == 1:
+                runs.append(run := run_scale(n_drains, args.seed, args.events, args.stages, directory, not args.no_memory))
+                for name, record in run['stages'].items():
+                    print(f"{n_drains:>9} drains {name:<13} {record['seconds']:>10.3f} s" + (f" {record['peak_memory_mb']:>10.1f} MiB" if 'peak_memory_mb' in record else ''))
+                continue
+
+            # Every scale in a fresh process, the model's data modules only load once per process
+            run_output = Path(scratch) / 'run.json'
+            command = [
+                sys.executable, '-m', 'benchmarks.run', '--drains', str(n_drains), '--events', str(args.events),
+                '--seed', str(args.seed), '--stages', *args.stages, '--data', str(directory.parent), '--output', str(run_output)
+            ]
+            subprocess.run(command + (['--no-memory'] if args.no_memory else []), cwd=REPOSITORY, check=True)
+            with open(run_output) as run_file:
+                runs.extend(json.load(run_file)['runs'])
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment(),
+        'runs': runs,
+    }
+    if output is not None:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+
+    if baseline is not None:
+        with open(baseline) as baseline_file:
+            return 0 if compare(results, json.load(baseline_file), args.threshold) else 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,372 @@
+import json
+import math
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+
+# Synthetic watersheds for benchmarking, built from the sandbox in notebooks/exploration/Simulation.py:
+# a \_/ valley (generate_valley_elevation) with random local features on its flanks
+# (generate_local_features), roads running along the flanks cut into ~2m segments (generate_simple_road_pattern
+# + preprocess) and drains at the segments lower than their neighbours (identify_local_min). Flowpaths
+# run straight down the flank to the next road (or the valley floor), some through a pond. Everything
+# is laid out so the files load exactly like real inputs do, and so that which drain every segment
+# and flowpath ends up at is known without running the loader, which doesn't scale to a million drains.
+
+CRS = 6566
+ORIGIN = (320084.0, 251741.0)
+
+# Same road types as the example configuration
+ROAD_TYPES = {
+    'sand': {'runoff_coefficient': 0.11, 'erosion_rate': 0.003},
+    'dirt': {'runoff_coefficient': 0.22, 'erosion_rate': 4.15},
+    'gravel': {'runoff_coefficient': 0.33, 'erosion_rate': 5.35},
+}
+
+def generate_valley_elevation(width: int, height: int, flank_slope: float, base_region_elevation: float, base_region_percent: float, pixel_size: float) -> tuple[np.ndarray, np.ndarray]:
+    # DEM with a \_/ profile across x and a mask of the base region (the valley floor)
+    if base_region_percent > 1:
+        raise ValueError(f"Percent greater than 1 is invalid: {base_region_percent}")
+    flank_width = int(width * (1 - base_region_percent) / 2)
+    base_region_width = width - 2 * flank_width
+
+    exclusion_mask = np.zeros((height, width), dtype=bool)
+    exclusion_mask[:, flank_width:flank_width + base_region_width] = True
+
+    west_flank_row = np.linspace(flank_width * pixel_size * flank_slope, 0, flank_width) + base_region_elevation
+    single_row = np.concatenate([west_flank_row, np.full(base_region_width, base_region_elevation), west_flank_row[::-1]])
+    return np.tile(single_row.astype(np.float32), (height, 1)), exclusion_mask
+
+def generate_local_features(dem: np.ndarray, exclusion_mask: np.ndarray, amplitude: float, grid_shape: tuple[int, int], rng: np.random.Generator) -> np.ndarray:
+    # Bumps from a sparse grid of random heights, interpolated to every pixel. The notebook uses a
+    # clipped normal and a spline, here the heights are uniform in [0, amplitude] (bounded, so
+    # flowpaths are guaranteed to run downhill) and interpolated bilinearly (no scipy needed).
+    height, width = dem.shape
+    grid_height, grid_width = max(2, height // grid_shape[0]), max(2, width // grid_shape[1])
+    noise_grid = rng.uniform(0, amplitude, size=(grid_height, grid_width)).astype(np.float32)
+
+    def weights(n: int, n_grid: int) -> tuple[np.ndarray, np.ndarray]:
+        position = np.arange(n) * (n_grid - 1) / max(n - 1, 1)
+        low = np.minimum(position.astype(np.int64), n_grid - 2)
+        return low, (position - low).astype(np.float32)
+
+    row, row_weight = weights(height, grid_height)
+    column, column_weight = weights(width, grid_width)
+    across = noise_grid[:, column] * (1 - column_weight) + noise_grid[:, column + 1] * column_weight # (grid_height, width)
+
+    array = dem.copy()
+    for first in range(0, height, 4096): # Row blocks keep the temporaries small for very large DEMs
+        rows = slice(first, first + 4096)
+        noise = across[row[rows]] * (1 - row_weight[rows, None]) + across[row[rows] + 1] * row_weight[rows, None]
+        array[rows] += np.where(exclusion_mask[rows], 0, noise)
+    return array
+
+def identify_local_min(elevation: np.ndarray, road: np.ndarray) -> np.ndarray:
+    # Segments (ordered along their road) no higher than the segments they touch
+    same_before = np.r_[False, road[1:] == road[:-1]]
+    same_after = np.r_[road[1:] == road[:-1], False]
+    before = np.where(same_before, np.r_[np.inf, elevation[:-1]], np.inf)
+    after = np.where(same_after, np.r_[elevation[1:], np.inf], np.inf)
+    return (elevation <= before) & (elevation <= after)
+
+def route_segments(elevation: np.ndarray, road: np.ndarray, is_drain: np.ndarray) -> np.ndarray:
+    # Drain segment every segment ends up at, as model.data.roads assigns them: a segment next to a
+    # drain takes the first one, anything else walks towards its lower neighbour to the nearest drain
+    n = len(elevation)
+    index = np.arange(n)
+    same_before = np.r_[False, road[1:] == road[:-1]]
+    same_after = np.r_[road[1:] == road[:-1], False]
+    before = np.where(same_before, np.r_[np.inf, elevation[:-1]], np.inf)
+    after = np.where(same_after, np.r_[elevation[1:], np.inf], np.inf)
+
+    previous_drain = np.maximum.accumulate(np.where(is_drain, index, -1))
+    next_drain = np.minimum.accumulate(np.where(is_drain, index, n)[::-1])[::-1]
+    drain_before = same_before & np.r_[False, is_drain[:-1]]
+    drain_after = same_after & np.r_[is_drain[1:], False]
+
+    goes_back = np.where(drain_before | drain_after, drain_before, before <= after)
+    target = np.where(goes_back, np.r_[-1, previous_drain[:-1]], np.r_[next_drain[1:], n])
+    return np.where(is_drain, index, target)
+
+@dataclass
+class SyntheticWatershed:
+    elevation: np.ndarray       # (H, W) DEM
+    transform: rasterio.Affine
+    roads: gpd.GeoDataFrame     # Segments with AREA, TYPE, ELEVATION and LENGTH
+    drains: gpd.GeoDataFrame
+    ponds: gpd.GeoDataFrame     # With MAX_CAP and USED_CAP
+    flowpaths: gpd.GeoDataFrame
+    rainfall: np.ndarray        # Rainfall depth of every event (mm)
+    travel_cost: float
+
+    # Drainage network in topological order: drains, ponds, then terminal points on the valley floor
+    node_points: np.ndarray     # (N, 2)
+    node_type: np.ndarray       # (N,) NodeType.value
+    child: np.ndarray           # (N,) -1 for terminal points
+    distance_to_child: np.ndarray
+    segment_node: np.ndarray    # (S,) node every road segment drains to
+
+    @property
+    def n_drains(self) -> int: return len(self.drains)
+
+    @property
+    def n_ponds(self) -> int: return len(self.ponds)
+
+    def summary(self) -> Dict[str, int | List[int]]:
+        return {
+            'drains': self.n_drains,
+            'ponds': self.n_ponds,
+            'road_segments': len(self.roads),
+            'flowpaths': len(self.flowpaths),
+            'nodes': len(self.node_type),
+            'events': len(self.rainfall),
+            'dem_shape': list(self.elevation.shape),
+        }
+
+    def config(self) -> Dict[str, object]:
+        return {
+            'rainfall_values': [float(value) for value in self.rainfall],
+            'travel_cost': self.travel_cost,
+            'simulation_mode': 'independent',
+            'sediment_bulk_density': 1600,
+            'road_types': ROAD_TYPES,
+            'datapaths': {name: f"user_data/{name}.{'tif' if name == 'elevation' else 'shp'}" for name in ('roads', 'flowpaths', 'drains', 'ponds', 'elevation')},
+        }
+
+    def write(self, directory: Path, spatial: bool = True) -> None:
+        # config/config.json and user_data/ as the model expects them, relative to `directory`
+        (directory / 'config').mkdir(parents=True, exist_ok=True)
+        (directory / 'user_data').mkdir(parents=True, exist_ok=True)
+        with open(directory / 'config' / 'config.json', 'w') as config_file:
+            json.dump(self.config(), config_file, indent=4)
+
+        if not spatial:
+            return
+        for name in ('roads', 'drains', 'ponds', 'flowpaths'):
+            getattr(self, name).to_file(directory / 'user_data' / f"{name}.shp")
+
+        height, width = self.elevation.shape
+        with rasterio.open(
+            directory / 'user_data' / 'elevation.tif', 'w', driver='GTiff', height=height, width=width, count=1,
+            dtype='float32', crs=rasterio.CRS.from_epsg(CRS), transform=self.transform, nodata=-9999
+        ) as dst:
+            dst.write(self.elevation, 1)
+
+    def road_totals(self, column: str) -> np.ndarray:
+        # (N, T) sum of a road segment column draining directly to every node, per road type
+        types = list(ROAD_TYPES)
+        totals = np.zeros((len(self.node_type), len(types)))
+        np.add.at(totals, (self.segment_node, self.roads['TYPE'].map(types.index).to_numpy()), self.roads[column].to_numpy())
+        return totals
+
+    def topology(self):
+        # The engine topology build_topology gives for these files, without loading them
+        from model.engine import Topology
+        from model.graph import NodeType
+
+        topology = Topology(
+            points=list(shapely.points(self.node_points)),
+            node_type=self.node_type,
+            child=self.child,
+            distance_to_child=self.distance_to_child,
+            cost_to_connect_child=self.distance_to_child * self.travel_cost,
+            road_types=list(ROAD_TYPES),
+            local_area=self.road_totals('AREA'),
+            local_length=self.road_totals('LENGTH'),
+            runoff_coefficient=np.array([road_type['runoff_coefficient'] for road_type in ROAD_TYPES.values()]),
+            erosion_rate=np.array([road_type['erosion_rate'] for road_type in ROAD_TYPES.values()]),
+            max_capacity=np.zeros(len(self.node_type)),
+            used_capacity=np.zeros(len(self.node_type)),
+        )
+        ponds = np.flatnonzero(self.node_type == NodeType.POND.value)
+        topology.max_capacity[ponds] = self.ponds['MAX_CAP'].to_numpy()
+        topology.used_capacity[ponds] = self.ponds['USED_CAP'].to_numpy()
+        topology.build_levels()
+        return topology
+
+    def graph_nodes(self) -> list:
+        # GraphNodes as model.data gives them (terminal points included), children first so that
+        # Graph.add_nodes never needs a provisional node (which would load the input files)
+        from model.graph import GraphNode, NodeType, PondInformation
+
+        types = list(ROAD_TYPES)
+        area, length = self.road_totals('AREA'), self.road_totals('LENGTH')
+        indices: Dict[int, Dict[str, List[int]]] = {}
+        for segment, (node, road_type) in enumerate(zip(self.segment_node, self.roads['TYPE'])):
+            indices.setdefault(int(node), {}).setdefault(road_type, []).append(segment)
+
+        points = shapely.points(self.node_points)
+        column, row = ~self.transform * (self.node_points[:, 0], self.node_points[:, 1])
+        elevation = self.elevation[row.astype(np.int64), column.astype(np.int64)]
+        ponds = iter(self.ponds[['MAX_CAP', 'USED_CAP']].itertuples(index=False))
+
+        nodes = []
+        for i in range(len(self.node_type)):
+            node = GraphNode(point=points[i], node_type=NodeType(int(self.node_type[i])), elevation=float(elevation[i]))
+            if node.node_type == NodeType.DRAIN:
+                node.road._local_indices = indices.get(i, {})
+                node.road._local_length = {name: float(length[i, t]) for t, name in enumerate(types) if name in node.road._local_indices}
+                node.road._local_area = {name: float(area[i, t]) for t, name in enumerate(types) if name in node.road._local_indices}
+            elif node.node_type == NodeType.POND:
+                max_capacity, used_capacity = next(ponds)
+                node.pond = PondInformation(max_capacity=max_capacity, used_capacity=used_capacity)
+            if self.child[i] >= 0:
+                node.child = points[self.child[i]]
+                node.distance_to_child = float(self.distance_to_child[i])
+                node.cost_to_connect_child = float(self.distance_to_child[i]) * self.travel_cost
+            nodes.append(node)
+        return nodes[::-1]
+
+def generate(
+    n_drains: int = 1000,
+    seed: int = 0,
+    n_events: int = 100,
+    pixel_size: float = 1.0,
+    segment_length: float = 2.0,
+    road_width: float = 3.0,
+    road_spacing: float = 10.0,
+    feature_spacing: int = 4,
+    flank_slope: float = 0.2,
+    base_region_percent: float = 0.1,
+    pond_fraction: float = 0.1,
+    travel_cost: float = 0.01,
+) -> SyntheticWatershed:
+    # A watershed with roughly n_drains drains (the exact number depends on the random features).
+    # Drains come out about every 3 * feature_spacing pixels along a road, the number of roads and
+    # their length are chosen to get n_drains with a roughly square DEM.
+    rng = np.random.default_rng(seed)
+    if segment_length / pixel_size != round(segment_length / pixel_size):
+        raise ValueError("segment_length must be a multiple of pixel_size")
+    spacing = max(2, round(road_spacing / pixel_size))    # Pixels between roads
+    per_segment = round(segment_length / pixel_size)      # Pixels per road segment
+    drain_spacing = 3 * feature_spacing * pixel_size    # Expected metres of road per drain
+
+    roads_per_flank = max(1, round(math.sqrt(3 * feature_spacing * n_drains / (4 * spacing))))
+    n_segments = max(3, math.ceil(n_drains * drain_spacing / (2 * roads_per_flank * segment_length)))
+    margin = spacing // 2
+    width = math.ceil(2 * (roads_per_flank * spacing + margin) / (1 - base_region_percent))
+    height = n_segments * per_segment + 2 * margin + 1
+
+    # Elevation, the flanks drop slope * spacing between roads and the features are at most 40% of that
+    dem, exclusion_mask = generate_valley_elevation(width, height, flank_slope, 0, base_region_percent, pixel_size)
+    amplitude = 0.4 * flank_slope * spacing * pixel_size
+    dem = generate_local_features(dem, exclusion_mask, amplitude, (feature_spacing, feature_spacing), rng)
+    transform = rasterio.Affine(pixel_size, 0, ORIGIN[0], 0, -pixel_size, ORIGIN[1])
+
+    # Roads run north to south along the flanks, ordered from the ridges down to the valley floor,
+    # alternating between the west (flowing east) and east (flowing west) flank. Everything is placed
+    # at pixel centres so sampling the DEM is never ambiguous.
+    step = np.repeat(np.arange(roads_per_flank), 2)
+    east = np.tile([False, True], roads_per_flank)
+    road_column = np.where(east, width - 1 - (margin + step * spacing), margin + step * spacing)
+    flow = np.where(east, -1, 1)
+    n_roads = len(road_column)
+    road_types = np.array(list(ROAD_TYPES))[rng.integers(len(ROAD_TYPES), size=n_roads)]
+
+    def x(column: np.ndarray) -> np.ndarray: return ORIGIN[0] + (column + 0.5) * pixel_size
+    shift = 0.5 if per_segment % 2 == 0 else 0 # Puts segment centres at pixel centres
+    segment_y = ORIGIN[1] - (margin + shift + np.arange(n_segments + 1) * per_segment) * pixel_size # Segment ends
+    centre = margin + shift + (np.arange(n_segments) + 0.5) * per_segment # Rows of segment centres
+    centre_y, centre_row = ORIGIN[1] - centre * pixel_size, np.floor(centre).astype(np.int64)
+
+    road = np.repeat(np.arange(n_roads), n_segments)
+    k = np.tile(np.arange(n_segments), n_roads)
+    road_x = x(road_column)[road]
+    lines = shapely.linestrings(np.stack([
+        np.stack([road_x, segment_y[k]], axis=1),
+        np.stack([road_x, segment_y[k + 1]], axis=1),
+    ], axis=1))
+    elevation = dem[centre_row[k], road_column[road]].astype(float)
+    roads = gpd.GeoDataFrame({
+        'AREA': np.full(len(road), segment_length * road_width),
+        'TYPE': road_types[road],
+        'ELEVATION': elevation,
+        'LENGTH': np.full(len(road), segment_length),
+    }, geometry=lines, crs=CRS)
+
+    # Drains at the centre of the segments lower than their neighbours, every segment drains to one
+    is_drain = identify_local_min(elevation, road)
+    drain_segments = np.flatnonzero(is_drain)
+    segment_drain = np.cumsum(is_drain) - 1 # Drain number of drain segments
+    segment_node = segment_drain[route_segments(elevation, road, is_drain)]
+    n = len(drain_segments)
+
+    # Flowpaths leave every drain down the flank, optionally through a pond half way, and end on the
+    # next road down (where the segment they reach drains to) or on the valley floor
+    drain_road, drain_k = road[drain_segments], k[drain_segments]
+    drain_xy = np.stack([road_x[drain_segments], centre_y[drain_k]], axis=1)
+    innermost = step[drain_road] == roads_per_flank - 1
+    next_road = np.minimum(drain_road + 2, n_roads - 1)
+    end_column = np.where(innermost, width // 2, road_column[next_road])
+    end_xy = np.stack([x(end_column), drain_xy[:, 1]], axis=1)
+
+    has_pond = rng.random(n) < pond_fraction
+    ponds_of = np.flatnonzero(has_pond)
+    pond_column = road_column[drain_road[ponds_of]] + flow[drain_road[ponds_of]] * (spacing // 2)
+    pond_xy = np.stack([x(pond_column), drain_xy[ponds_of, 1]], axis=1)
+    n_ponds = len(ponds_of)
+    max_capacity = np.round(rng.uniform(5, 20, n_ponds), 1)
+    ponds = gpd.GeoDataFrame({
+        'USED_CAP': np.round(rng.uniform(0, 0.5, n_ponds) * max_capacity, 1),
+        'MAX_CAP': max_capacity,
+    }, geometry=shapely.points(pond_xy), crs=CRS)
+
+    # Terminal points, one per row of the valley floor that anything reaches
+    terminal_rows, terminal_of = np.unique(drain_k[innermost], return_inverse=True)
+    terminal_xy = np.stack([np.full(len(terminal_rows), x(width // 2)), centre_y[terminal_rows]], axis=1)
+
+    # Nodes are drains, then ponds, then terminal points; `order` puts them in topological order (by
+    # road step, a pond right after its drain)
+    child = np.empty(n + n_ponds, dtype=np.int64)
+    reaches = np.empty(n, dtype=np.int64)
+    reaches[~innermost] = segment_node[next_road[~innermost] * n_segments + drain_k[~innermost]]
+    reaches[innermost] = n + n_ponds + terminal_of
+    child[:n] = reaches
+    child[ponds_of] = n + np.arange(n_ponds)
+    child[n:] = reaches[ponds_of]
+
+    start = np.concatenate([drain_xy, pond_xy])
+    end = np.concatenate([end_xy, end_xy[ponds_of]])
+    end[ponds_of] = pond_xy
+    flowpaths = gpd.GeoDataFrame(geometry=shapely.linestrings(np.stack([start, end], axis=1)), crs=CRS)
+
+    rank = np.concatenate([2 * step[drain_road], 2 * step[drain_road[ponds_of]] + 1, np.full(len(terminal_rows), 2 * roads_per_flank)])
+    order = np.argsort(rank, kind='stable')
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+    routed = np.concatenate([child, np.full(len(terminal_rows), -1)])
+
+    node_points = np.concatenate([start, terminal_xy])[order]
+    node_child = np.where(routed >= 0, position[np.maximum(routed, 0)], -1)[order]
+    distance = np.concatenate([np.linalg.norm(end - start, axis=1), np.zeros(len(terminal_rows))])[order]
+    node_type = np.concatenate([np.full(n, 1), np.full(n_ponds, 2), np.full(len(terminal_rows), 3)])[order]
+
+    # Drains and ponds are written in node order, so the loader sees them the same way
+    drain_order, pond_order = order[order < n], order[(order >= n) & (order < n + n_ponds)] - n
+    watershed = SyntheticWatershed(
+        elevation=dem,
+        transform=transform,
+        roads=roads,
+        drains=gpd.GeoDataFrame(geometry=shapely.points(drain_xy[drain_order]), crs=CRS),
+        ponds=ponds.iloc[pond_order].reset_index(drop=True),
+        flowpaths=flowpaths,
+        rainfall=np.round(rng.lognormal(np.log(30), 0.8, n_events), 1),
+        travel_cost=travel_cost,
+        node_points=node_points,
+        node_type=node_type,
+        child=node_child,
+        distance_to_child=distance,
+        segment_node=position[segment_node],
+    )
+
+    # The DEM must agree with the flowpaths, as model.data.flowpaths checks them
+    column, row = ~transform * (start[:, 0], start[:, 1])
+    start_elevation = dem[row.astype(np.int64), column.astype(np.int64)]
+    column, row = ~transform * (end[:, 0], end[:, 1])
+    end_elevation = dem[row.astype(np.int64), column.astype(np.int64)]
+    if not (start_elevation > end_elevation).all():
+        raise ValueError("Some flowpaths run uphill, increase flank_slope or road_spacing")
+    return watershed
@@ -3,9 +3,3 @@ __license__ = "GNU General Public License v3.0"
 __author__ = "Rushi Bhatt"
 __email__ = "therushibhatt [at] gmail [dot] com"
 __secondary_email__ = "bhattrushi [at] utexas [dot] edu"
-
-print(f"Welcome to RoadConnect version {__version__}.")
-print(f"This program has been written by {__author__} ({__email__}, or {__secondary_email__}) as part of an undergraduate capstone research project at the University of Texas at Austin.")
-print(f"This version of the program is licensed under {__license__}.")
-print("Thank you to Professor Carlos E. Ramos Scharrón for his mentorship and the foundational field studies that supported this research.")
-print("Thank you to Protectores de Cuencas Inc. for supporting me in this project with a stipend.")
@@ -1,11 +1,30 @@
 # /src/model/base.py
-from typing import List
-from utils import config
-from model import graph
-import networkx as nx
+from dataclasses import dataclass
+from typing import Dict, List
+from utils import config, profiling
+from model import graph, engine, checkpoint, response, scenario, optimize, ensemble, sensitivity, forest
+import numpy as np
+import pandas as pd
 from model import data
 from tqdm import tqdm
-from copy import deepcopy
+import networkx as nx
+
+@dataclass
+class RunResults:
+    aggregates: engine.EventAggregates  # Per-node totals over all events
+    events: pd.DataFrame                # One row per event, including the rainfall series' metadata
+    state: engine.PondState | None = None # Pond state after the last event (continuous mode only)
+
+@dataclass
+class EnsembleRunResults:
+    ensemble: ensemble.EnsembleResults  # Per-sample, per-node totals over all events
+    bands: pd.DataFrame                 # Percentiles over the samples, one row per node
+    samples: pd.DataFrame               # The sampled parameters, one row per sample
+
+@dataclass
+class SensitivityRunResults:
+    indices: sensitivity.SensitivityIndices
+    table: pd.DataFrame # One row per output and parameter
 
 class Model:
     def __init__(self) -> None:
@@ -13,27 +32,205 @@ class Model:
         self.load_config_values()
         self.generate_base_graph()
 
-        self.run()
+        match self.simulation_mode:
+            case 'continuous':
+                self.results = self.run_continuous()
+            case 'ensemble':
+                self.results = self.run_ensemble()
+            case 'sensitivity':
+                self.results = self.run_sensitivity()
+            case _:
+                self.results = self.run()
         pass
 
     def load_config_values(self):
         # Load values from configuration file
-        self.rainfall_events: List[float] = config.get_rainfall_values()
+        with profiling.stage('config'):
+            self.rainfall: data.rainfall.RainfallSource = data.rainfall.open_source()
+            self.simulation_mode: str = config.get_simulation_mode()
 
     def generate_base_graph(self):
-        # Generate base graph
-        self.base_graph = graph.Graph()
-        self.base_graph.add_nodes(data.drains.get_nodes())
-        self.base_graph.add_nodes(data.ponds.get_nodes())
+        # Trace every drain's and pond's flowpath, then generate base graph
+        with profiling.stage('trace drains'):
+            drains = data.drains.get_nodes()
+        with profiling.stage('trace ponds'):
+            ponds = data.ponds.get_nodes()
+        with profiling.stage('graph'):
+            self.base_graph = graph.Graph()
+            self.base_graph.add_nodes(drains)
+            self.base_graph.add_nodes(ponds)
+
+    def build_topology(self) -> engine.Topology:
+        with profiling.stage('topology'):
+            return engine.build_topology(self.base_graph)
+
+    def resume(self, topology: engine.Topology) -> tuple[checkpoint.Checkpointer | None, checkpoint.Checkpoint]:
+        # Picks up where a previous (killed) run left off, or starts from scratch
+        fresh = checkpoint.Checkpoint(
+            next_event=0,
+            aggregates=engine.EventAggregates.empty(topology.n_nodes),
+            log=engine.EventLog()
+        )
+
+        settings = config.get_checkpoint_settings()
+        if settings is None:
+            return None, fresh
+
+        checkpointer = checkpoint.Checkpointer(
+            settings['directory'],
+            settings['interval'],
+            self.simulation_mode,
+            self.rainfall.key,
+            self.rainfall.n_events,
+            topology,
+            {'sediment_bulk_density': config.get_sediment_bulk_density()} if self.simulation_mode == 'continuous' else None
+        )
+        return checkpointer, checkpointer.load() or fresh
+
+    def run(self) -> RunResults:
+        # Rainfall events are independent of each other, so they go through the engine in batches
+        topology = self.build_topology()
+        batch_size = engine.batch_size(topology)
+
+        checkpointer, saved = self.resume(topology)
+        aggregates, log = saved.aggregates, saved.log
+
+        with tqdm(total=self.rainfall.n_events, initial=saved.next_event) as progress:
+            for chunk in self.rainfall.chunks(start=saved.next_event, points=topology.points):
+                first = 0
+                while first < chunk.n_events:
+                    event = chunk.first_event + first
+                    last = min(first + batch_size, chunk.n_events)
+                    if checkpointer is not None: # Batches end where checkpoints are due
+                        last = min(last, first + checkpointer.interval - event % checkpointer.interval)
+
+                    with profiling.stage(f"events {event}-{chunk.first_event + last}"):
+                        results = engine.run_events(topology, chunk.depth[first:last])
+                        aggregates.add(results)
+                        log.add(event, topology, results, {key: values[first:last] for key, values in chunk.metadata.items()})
+                        if checkpointer is not None:
+                            checkpointer.save_if_due(chunk.first_event + last, aggregates, log)
+
+                    progress.update(last - first)
+                    first = last
+
+        events = log.to_frame()
+        print(events.set_index('event'))
+        print(f"{aggregates.n_events} events: runoff leaving the watershed {events['runoff_out'].sum()}, sediment leaving the watershed {events['sediment_out'].sum()}, trapped in ponds {events['trapped_sediment'].sum()}")
+        return RunResults(aggregates=aggregates, events=events)
+
+    def event_graph(self, event: int) -> nx.DiGraph:
+        # One rainfall event as a NetworkX graph (connected edges only), for export and visualization
+        topology = self.build_topology()
+        chunk = next(self.rainfall.chunks(start=event, points=topology.points))
+        return engine.to_networkx(topology, engine.run_events(topology, chunk.depth[:1]), 0)
+
+    def run_continuous(self) -> RunResults:
+        # Rainfall events are treated as a time series, ponds keep the sediment they trap
+        topology = self.build_topology()
+        bulk_density = config.get_sediment_bulk_density()
+
+        checkpointer, saved = self.resume(topology)
+        aggregates, log = saved.aggregates, saved.log
+        state = engine.PondState(
+            next_event=saved.next_event,
+            used_capacity=saved.used_capacity if saved.used_capacity is not None else topology.used_capacity.copy()
+        )
+
+        with tqdm(total=self.rainfall.n_events, initial=state.next_event) as progress:
+            for chunk in self.rainfall.chunks(start=state.next_event, points=topology.points):
+
+                def on_event(state: engine.PondState, result: engine.EventResults) -> None:
+                    event = state.next_event - 1
+                    i = event - chunk.first_event
+
+                    aggregates.add(result)
+                    log.add(event, topology, result, {key: values[i:i + 1] for key, values in chunk.metadata.items()})
+                    if checkpointer is not None:
+                        checkpointer.save_if_due(state.next_event, aggregates, log, state.used_capacity)
+
+                    progress.update()
+
+                with profiling.stage(f"events {state.next_event}-{chunk.first_event + chunk.n_events}"):
+                    engine.run_continuous(topology, chunk.depth, bulk_density, state, on_event=on_event)
+
+        for node in np.flatnonzero(topology.is_pond):
+            print(f"Pond {topology.points[node]}: used capacity {topology.used_capacity[node]} -> {state.used_capacity[node]} of {topology.max_capacity[node]}, trapped sediment {aggregates.trapped_sediment[node]}")
+
+        return RunResults(aggregates=aggregates, events=log.to_frame(), state=state)
+
+    def run_ensemble(self) -> EnsembleRunResults:
+        # Every rainfall event once per sample of the uncertain road type parameters and travel cost
+        topology = self.build_topology()
+        settings = config.get_uncertainty_settings()
+
+        samples = ensemble.sample_parameters(topology, config.get_flowpath_travel_cost(), settings['parameters'], settings['samples'], settings['seed'])
+        results = ensemble.EnsembleResults.empty(samples, topology.n_nodes)
+
+        with tqdm(total=self.rainfall.n_events) as progress:
+            for chunk in self.rainfall.chunks(points=topology.points):
+                with profiling.stage(f"events {chunk.first_event}-{chunk.first_event + chunk.n_events}"):
+                    ensemble.run_ensemble(topology, chunk.depth, results)
+                progress.update(chunk.n_events)
+
+        terminal = topology.child < 0
+        sediment_out = np.percentile(results.sediment[:, terminal].sum(axis=1) / max(results.n_events, 1), settings['percentiles'])
+        for p, value in zip(settings['percentiles'], sediment_out):
+            print(f"Sediment leaving the watershed per event, p{p:g}: {value}")
+
+        return EnsembleRunResults(
+            ensemble=results,
+            bands=results.to_frame(topology.points, settings['percentiles']),
+            samples=samples.to_frame(topology.road_types),
+        )
+
+    def run_sensitivity(self) -> SensitivityRunResults:
+        # Sobol or Morris indices of the watershed outputs for the configured parameter ranges
+        topology = self.build_topology()
+        settings = config.get_sensitivity_settings()
+        names = list(settings['parameters'])
+        bounds = np.array([settings['parameters'][name] for name in names])
+
+        cache = sensitivity.ResultCache(
+            None if settings['cache'] is None else settings['cache'] / 'sensitivity.npz',
+            checkpoint.fingerprint(f"sensitivity:{','.join(names)}", self.rainfall.key, topology),
+            len(names)
+        )
+        evaluate = sensitivity.Evaluator(topology, self.rainfall, config.get_flowpath_travel_cost(), names, cache)
+        rng = np.random.default_rng(settings['seed'])
+
+        with profiling.stage(settings['method']):
+            if settings['method'] == 'morris':
+                indices = sensitivity.morris(evaluate, names, bounds, settings['samples'], settings['levels'], rng)
+            else:
+                indices = sensitivity.sobol(evaluate, names, bounds, settings['samples'], rng)
+
+        table = indices.to_frame()
+        print(f"{indices.n_points} parameter points, {evaluate.n_runs} run and the rest cached")
+        print(table.loc['sediment_out'])
+        return SensitivityRunResults(indices=indices, table=table)
+
+    def build_response_curves(self, max_depth: float = 500.0, resolution: float = 1.0) -> response.ResponseCurves:
+        # Every node's response to a uniform rainfall depth, precomputed once for instant what-if queries
+        return response.build_response_curves(self.build_topology(), max_depth, resolution)
 
-    def run(self) -> List[nx.DiGraph]:
-        processing_order = self.base_graph.get_topological_order()
+    def build_connectivity_index(self) -> response.ConnectivityIndex:
+        # Critical rainfall depth of every edge, the connected edges of any uniform storm are then a threshold query
+        return response.build_connectivity_index(self.build_topology())
 
-        for rainfall_event_total in tqdm(self.rainfall_events, total=len(self.rainfall_events)):
-            g = deepcopy(self.base_graph)
-            g.prepare_graph(rainfall_event_total)
+    def build_scenario(self) -> scenario.Scenario:
+        # Every rainfall event on the base graph, ready for incremental pond/road what-ifs
+        topology = self.build_topology()
+        rainfall = np.concatenate([chunk.depth for chunk in self.rainfall.chunks(points=topology.points)])
+        return scenario.Scenario(topology, rainfall, scenario.SegmentTable.from_roads(data.roads._gdf, topology))
 
-            for node in processing_order:
-                g.process_node(node)
+    def site_ponds(self, capacities: List[float], k: int | None = None, budget: float | None = None, cost_per_volume: float | None = None, workers: int | None = None) -> optimize.SitingResult:
+        # Where new ponds trap the most sediment over all rainfall events, see model/optimize.py
+        what_if = self.build_scenario()
+        candidates = optimize.candidate_grid(what_if, capacities, cost_per_volume=cost_per_volume)
+        return optimize.site_ponds(what_if, candidates, k=k, budget=budget, workers=workers)
 
-            g.print()
+    def build_queries(self) -> forest.DrainageQueries:
+        # Upstream/downstream questions about the drainage network (which segments reach a pond, ...)
+        topology = self.build_topology()
+        return forest.DrainageQueries(topology, scenario.SegmentTable.from_roads(data.roads._gdf, topology))
@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import tempfile
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+
+from model.engine import Topology, EventAggregates, EventLog
+
+@dataclass
+class Checkpoint:
+    next_event: int
+    aggregates: EventAggregates
+    log: EventLog
+    used_capacity: np.ndarray | None = None # Continuous mode only
+
+def fingerprint(mode: str, rainfall_key: bytes, topology: Topology, settings: Dict[str, float] | None = None) -> str:
+    # Identifies a run so that a checkpoint is never resumed against different inputs. `settings` are the
+    # mode's own configuration values, e.g. the sediment bulk density of continuous runs.
+    digest = hashlib.sha256(mode.encode())
+    digest.update(rainfall_key)
+    digest.update(json.dumps(settings or {}, sort_keys=True).encode())
+    for array in (
+        topology.child,
+        topology.cost_to_connect_child,
+        topology.local_area,
+        topology.local_length,
+        topology.runoff_coefficient,
+        topology.erosion_rate,
+        topology.max_capacity,
+        topology.used_capacity,
+    ):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+def save_atomically(path: Path, arrays: Dict[str, np.ndarray]) -> None:
+    # Write next to the file and rename over it, a run killed mid-write leaves the previous file intact
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            np.savez(temp_file, **arrays)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class Checkpointer:
+    # The aggregates and state are rewritten at every checkpoint to {mode}.npz, the event log (which grows
+    # with the run) goes to one {mode}.log.{first event}.npz per checkpoint with only the rows added since
+    # the previous one. The state file lists its log files and is written last, so a run killed in between
+    # resumes from the previous checkpoint and overwrites the log file it left behind.
+    def __init__(self, directory: Path, interval: int, mode: str, rainfall_key: bytes, n_events: int, topology: Topology, settings: Dict[str, float] | None = None) -> None:
+        if interval <= 0:
+            raise ValueError("checkpoint interval must be a positive number of events")
+
+        self.directory = directory
+        self.interval = interval
+        self.mode = mode
+        self.path = directory / f"{mode}.npz"
+        self.fingerprint = fingerprint(mode, rainfall_key, topology, settings)
+        self.n_events = n_events
+        self.log_files: List[int] = [] # First event of every log file written so far
+        self.saved_batches = 0          # Batches of the log written so far
+
+    def log_path(self, first_event: int) -> Path:
+        return self.directory / f"{self.mode}.log.{first_event}.npz"
+
+    def load(self) -> Checkpoint | None:
+        if not self.path.is_file():
+            return None
+
+        with np.load(self.path) as saved:
+            if str(saved['fingerprint']) != self.fingerprint:
+                raise ValueError(f"Checkpoint {self.path} belongs to a different run (inputs changed), delete it and its log files to start over.")
+
+            aggregates = EventAggregates(**{
+                f.name: saved[f"aggregates.{f.name}"] if f.name != 'n_events' else int(saved['aggregates.n_events'])
+                for f in fields(EventAggregates)
+            })
+            next_event = int(saved['next_event'])
+            log_files = saved['log_files'].tolist()
+            used_capacity = saved['used_capacity'] if 'used_capacity' in saved else None
+
+        columns: Dict[str, List[np.ndarray]] = {}
+        for first_event in log_files:
+            with np.load(self.log_path(first_event)) as rows:
+                for name in rows.files:
+                    columns.setdefault(name, []).append(rows[name])
+        log = EventLog.from_arrays({name: np.concatenate(values) for name, values in columns.items()})
+
+        self.log_files, self.saved_batches = log_files, log.n_batches
+        return Checkpoint(next_event=next_event, aggregates=aggregates, log=log, used_capacity=used_capacity)
+
+    def save(self, next_event: int, aggregates: EventAggregates, log: EventLog, used_capacity: np.ndarray | None = None) -> None:
+        log_files = self.log_files
+        rows = log.to_arrays(since=self.saved_batches)
+        if rows:
+            first_event = int(rows['event'][0])
+            save_atomically(self.log_path(first_event), rows)
+            log_files = log_files + [first_event]
+
+        arrays = {
+            'fingerprint': np.array(self.fingerprint),
+            'next_event': np.array(next_event),
+            'log_files': np.array(log_files, dtype=np.int64),
+            **{f"aggregates.{f.name}": np.asarray(getattr(aggregates, f.name)) for f in fields(EventAggregates)},
+        }
+        if used_capacity is not None:
+            arrays['used_capacity'] = used_capacity
+
+        save_atomically(self.path, arrays)
+        self.log_files, self.saved_batches = log_files, log.n_batches
+
+    def save_if_due(self, next_event: int, aggregates: EventAggregates, log: EventLog, used_capacity: np.ndarray | None = None) -> None:
+        if next_event % self.interval == 0 or next_event == self.n_events:
+            self.save(next_event, aggregates, log, used_capacity)
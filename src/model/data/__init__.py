@@ -1,4 +1,8 @@
-from . import roads, flowpaths, drains, ponds, elevation
+import importlib
+
+# The data modules read and validate their input files when they're imported, so they're only
+# imported when first used (data.drains, from model.data import roads, ...). Importing the package
+# itself, e.g. in a worker process or for `roadconnect --version`, doesn't touch any input file.
 
 __all__ = [
     "roads",
@@ -6,5 +10,12 @@ __all__ = [
     "drains",
     "ponds",
     "elevation",
+    "rainfall",
 ]
 
+def __getattr__(name: str):
+    if name in __all__:
+        if name == "drains": # roads and drains import each other, roads routes its segments to the drains as it loads
+            importlib.import_module(".roads", __name__)
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -3,13 +3,13 @@ import geopandas as gpd
 from pathlib import Path
 
 from model.graph import GraphNode, NodeType
-from utils import config
+from utils import config, profiling
 from . import roads, flowpaths, elevation
 
 path: Path = config.resolve_drains_data_path()
-_gdf = gpd.read_file(path)
-
-_gdf['ELEVATION'] = _gdf['geometry'].apply(lambda point: elevation.sample_point(point) )
+with profiling.stage('load drains'):
+    _gdf = gpd.read_file(path)
+    _gdf['ELEVATION'] = _gdf['geometry'].apply(lambda point: elevation.sample_point(point) )
 
 def get_nodes() -> List[GraphNode]:
     nodes: List[GraphNode] = []
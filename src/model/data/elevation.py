@@ -2,12 +2,14 @@ import rasterio
 import shapely
 from pathlib import Path
 
-from utils import config
+from utils import config, profiling
 
 path: Path = config.resolve_elevation_data_path()
-__src = rasterio.open(path)
+with profiling.stage('load elevation'):
+    __src = rasterio.open(path)
 
 # TODO: I need to add a function that smoothens the elevation profile of the input file
 
+@profiling.timed
 def sample_point(point: shapely.geometry.Point) -> float:
     return float(list(__src.sample( [point.xy] ))[0][0])
@@ -3,12 +3,13 @@ import geopandas as gpd
 from pathlib import Path
 
 import shapely
-from utils import config
+from utils import config, profiling
 from . import roads, elevation
 
 path: Path = config.resolve_flowpaths_data_path()
 __flowpath_travel_cost = config.get_flowpath_travel_cost()
-_gdf = gpd.read_file(path)
+with profiling.stage('load flowpaths'):
+    _gdf = gpd.read_file(path)
 
 def __vd_lines() -> None:
     invalid_indices =  [
@@ -22,6 +23,7 @@ __vd_lines()
 
 
 
+@profiling.timed
 def trace_drainage_endpoint(reference_point: shapely.geometry.Point) -> Tuple[shapely.geometry.point.Point | None, float | None, float | None] :
     # Find flowpaths intersecting with the reference point
     intersecting_flowpaths = _gdf[_gdf.intersects(reference_point)]
@@ -0,0 +1,309 @@
+import os
+import json
+import warnings
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.warp
+import rasterio.windows
+from rasterio.crs import CRS
+import shapely
+
+from utils import config
+
+# NOTE: Unlike the other data modules nothing is read on import, rainfall series can be far too large
+# to hold in memory so they're streamed in chunks of events by whoever runs them.
+
+@dataclass
+class RainfallChunk:
+    first_event: int
+    depth: np.ndarray # (E,) one depth per event, or (E, N) one depth per node and event (mm)
+    metadata: Dict[str, np.ndarray] = field(default_factory=dict) # e.g. timestamp/storm_id, one value per event
+
+    @property
+    def n_events(self) -> int: return self.depth.shape[0]
+
+def _validated(values: np.ndarray | List, name: str) -> np.ndarray:
+    try:
+        depth = np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must only contain numbers that can be converted to float")
+    if not np.isfinite(depth).all():
+        raise ValueError(f"{name} contains missing or non-finite rainfall values")
+    return depth
+
+class RainfallSource(ABC):
+    n_events: int
+    key: bytes # Identifies the series for checkpoints
+
+    @abstractmethod
+    def chunks(self, start: int = 0, points: List[shapely.geometry.Point] | None = None) -> Iterator[RainfallChunk]:
+        # Events from `start` on in chunks, one depth per node of `points` (in topological order) for gridded sources
+        ...
+
+class InlineRainfall(RainfallSource):
+    # The 'rainfall_values' list in the configuration file
+    def __init__(self, values: List[float], chunk_size: int) -> None:
+        self.values = _validated(values, 'rainfall_values')
+        self.chunk_size = chunk_size
+        self.n_events = len(self.values)
+        self.key = self.values.tobytes()
+
+    def chunks(self, start: int = 0, points: List[shapely.geometry.Point] | None = None) -> Iterator[RainfallChunk]:
+        for first_event in range(start, self.n_events, self.chunk_size):
+            yield RainfallChunk(first_event, self.values[first_event:first_event + self.chunk_size])
+
+class _FileRainfall(RainfallSource):
+    def __init__(self, settings: config.RainfallSourceSettings) -> None:
+        self.settings = settings
+        self.path: Path = settings['path']
+
+        stat = os.stat(self.path)
+        self.key = json.dumps([str(self.path.resolve()), stat.st_size, stat.st_mtime_ns, {k: str(v) for k, v in settings.items()}]).encode()
+
+    def _metadata(self, table: pd.DataFrame) -> Dict[str, np.ndarray]:
+        metadata = {}
+        if self.settings['timestamp_column'] is not None:
+            metadata['timestamp'] = pd.to_datetime(table[self.settings['timestamp_column']]).dt.strftime('%Y-%m-%dT%H:%M:%S').to_numpy(dtype=str)
+        if self.settings['storm_id_column'] is not None:
+            metadata['storm_id'] = table[self.settings['storm_id_column']].astype(str).to_numpy(dtype=str)
+        return metadata
+
+    def _columns(self) -> List[str]:
+        return [column for column in (self.settings['column'], self.settings['timestamp_column'], self.settings['storm_id_column']) if column is not None]
+
+    def _skip(self, tables: Iterator[pd.DataFrame], start: int) -> Iterator[RainfallChunk]:
+        # Drops the events before `start` (already run, e.g. before a checkpoint) from a stream of tables
+        first_event = 0
+        for table in tables:
+            last_event = first_event + len(table)
+            if last_event > start:
+                table = table.iloc[max(0, start - first_event):]
+                yield RainfallChunk(
+                    max(first_event, start),
+                    _validated(table[self.settings['column']].to_numpy(), str(self.path)),
+                    self._metadata(table)
+                )
+            first_event = last_event
+
+class CsvRainfall(_FileRainfall):
+    def __init__(self, settings: config.RainfallSourceSettings) -> None:
+        super().__init__(settings)
+        self.n_events = sum(len(table) for table in self.__read(usecols=[settings['column']]))
+
+    def __read(self, usecols: List[str]) -> Iterator[pd.DataFrame]:
+        return pd.read_csv(self.path, usecols=usecols, chunksize=self.settings['chunk_size'])
+
+    def chunks(self, start: int = 0, points: List[shapely.geometry.Point] | None = None) -> Iterator[RainfallChunk]:
+        return self._skip(self.__read(usecols=self._columns()), start)
+
+class ParquetRainfall(_FileRainfall):
+    def __init__(self, settings: config.RainfallSourceSettings) -> None:
+        super().__init__(settings)
+        self.n_events = self.__file().metadata.num_rows
+
+    def __file(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Reading rainfall from Parquet requires pyarrow (pip install 'RoadConnect[rainfall]')")
+        return pyarrow.parquet.ParquetFile(self.path)
+
+    def chunks(self, start: int = 0, points: List[shapely.geometry.Point] | None = None) -> Iterator[RainfallChunk]:
+        batches = self.__file().iter_batches(batch_size=self.settings['chunk_size'], columns=self._columns())
+        return self._skip((batch.to_pandas() for batch in batches), start)
+
+def _nearest(coordinates: np.ndarray, values: np.ndarray, source: str) -> np.ndarray:
+    # Index of the nearest grid coordinate for every value, coordinates may be ascending or descending.
+    # Values more than half a cell beyond the first or last coordinate are outside of the grid.
+    order = np.argsort(coordinates)
+    ordered = coordinates[order]
+    if len(ordered) > 1 and (
+        values.min() < ordered[0] - (ordered[1] - ordered[0]) / 2 or values.max() > ordered[-1] + (ordered[-1] - ordered[-2]) / 2
+    ):
+        raise ValueError(f"Road segments fall outside of rainfall grid {source}")
+    right = np.clip(np.searchsorted(ordered, values), 1, len(ordered) - 1)
+    left = right - 1
+    nearest = np.where(np.abs(values - ordered[left]) <= np.abs(values - ordered[right]), left, right)
+    return order[nearest]
+
+@dataclass
+class _Samples:
+    # Where to sample a gridded rainfall product for every node: the midpoint of each road segment
+    # draining to the node, weighted by the segment's area. Nodes without road segments (ponds,
+    # terminations) are sampled at the node itself, their rainfall doesn't generate any runoff.
+    x: np.ndarray       # (S,)
+    y: np.ndarray       # (S,)
+    weight: np.ndarray  # (S,)
+    starts: np.ndarray  # (N,) np.add.reduceat boundaries, samples are sorted by node
+    crs: CRS | None     # Of the road segments
+
+    @classmethod
+    def contributing_segments(cls, points: List[shapely.geometry.Point]) -> '_Samples':
+        from . import roads
+
+        position = {point: i for i, point in enumerate(points)}
+        node = roads._gdf['DRAIN_IDX'].map(lambda drain: position.get(drain, -1)).to_numpy(dtype=np.int64)
+        routed = node >= 0
+
+        midpoints = shapely.line_interpolate_point(roads._gdf.geometry.to_numpy()[routed], 0.5, normalized=True)
+        xy = np.concatenate([shapely.get_coordinates(midpoints), shapely.get_coordinates(np.asarray(points, dtype=object))])
+        node = np.concatenate([node[routed], np.arange(len(points))])
+        weight = np.concatenate([roads._gdf['AREA'].to_numpy(dtype=float)[routed], np.zeros(len(points))])
+
+        # Node points only count for nodes without any road segment
+        has_segments = np.bincount(node[:routed.sum()], minlength=len(points)) > 0
+        weight[routed.sum():] = np.where(has_segments, 0.0, 1.0)
+
+        order = np.argsort(node, kind='stable')
+        return cls(
+            x=xy[order, 0],
+            y=xy[order, 1],
+            weight=weight[order],
+            starts=np.searchsorted(node[order], np.arange(len(points))),
+            crs=CRS.from_user_input(roads._gdf.crs) if roads._gdf.crs is not None else None
+        )
+
+    def coordinates(self, crs: CRS | None) -> tuple[np.ndarray, np.ndarray]:
+        # x and y of the samples in `crs`, as they are when either CRS is unknown
+        if crs is None or self.crs is None or crs == self.crs:
+            return self.x, self.y
+        x, y = rasterio.warp.transform(self.crs, crs, self.x, self.y)
+        return np.asarray(x), np.asarray(y)
+
+    def reduce(self, values: np.ndarray) -> np.ndarray:
+        # (E, S) sampled rainfall -> (E, N) area-weighted rainfall per node, NaN (missing data) samples are
+        # left out. A node without any valid sample in an event gets the nearest valid sample of the event
+        # to its first one, and 0 when the whole event is missing.
+        valid = ~np.isnan(values)
+        weighted = np.add.reduceat(np.where(valid, values, 0) * self.weight, self.starts, axis=1)
+        total_weight = np.add.reduceat(valid * self.weight, self.starts, axis=1)
+        depth = np.divide(weighted, total_weight, out=np.full(weighted.shape, np.nan), where=total_weight > 0)
+
+        missing = total_weight <= 0
+        if not missing.any():
+            return depth
+        empty = 0
+        for event in np.flatnonzero(missing.any(axis=1)):
+            nodes, available = np.flatnonzero(missing[event]), np.flatnonzero(valid[event])
+            if not len(available):
+                depth[event, nodes] = 0
+                empty += 1
+                continue
+            tree = shapely.STRtree(shapely.points(self.x[available], self.y[available]))
+            _, nearest = tree.query_nearest(shapely.points(self.x[self.starts[nodes]], self.y[self.starts[nodes]]), all_matches=False)
+            depth[event, nodes] = values[event, available[nearest]]
+        warnings.warn(
+            f"{missing.sum()} node rainfall values have no valid sample, they take the nearest valid one"
+            + (f", {empty} event{'s' if empty > 1 else ''} without any valid sample {'are' if empty > 1 else 'is'} taken as 0" if empty else "")
+        )
+        return depth
+
+def _xarray():
+    try:
+        import xarray
+    except ImportError:
+        raise ImportError("Reading rainfall from NetCDF requires xarray and netCDF4 (pip install 'RoadConnect[rainfall]')")
+    return xarray
+
+class NetcdfRainfall(_FileRainfall):
+    # A rainfall variable over (time,) for a gauge, or (time, y, x) for a gridded product, in which
+    # case every node gets the rainfall over the road segments draining to it (see _Samples).
+    def __init__(self, settings: config.RainfallSourceSettings) -> None:
+        super().__init__(settings)
+        with self.__open() as dataset:
+            self.n_events = dataset[self.settings['column']].sizes[self.__time_dim(dataset)]
+
+    def __open(self):
+        return _xarray().open_dataset(self.path)
+
+    def __time_dim(self, dataset) -> str:
+        return dataset[self.settings['column']].dims[0]
+
+    def chunks(self, start: int = 0, points: List[shapely.geometry.Point] | None = None) -> Iterator[RainfallChunk]:
+        with self.__open() as dataset:
+            variable = dataset[self.settings['column']]
+            time_dim = self.__time_dim(dataset)
+
+            # Grid cell of every sample, looked up once for the whole series
+            samples, sample_cells = None, {}
+            if variable.ndim == 3:
+                if points is None:
+                    raise ValueError(f"{self.path} is gridded, node points are needed to look up rainfall")
+                samples = _Samples.contributing_segments(points)
+                y_dim, x_dim = variable.dims[1:]
+                sample_cells[y_dim] = _xarray().DataArray(_nearest(dataset[y_dim].to_numpy(), samples.y, str(self.path)), dims='sample')
+                sample_cells[x_dim] = _xarray().DataArray(_nearest(dataset[x_dim].to_numpy(), samples.x, str(self.path)), dims='sample')
+            elif variable.ndim != 1:
+                raise ValueError(f"{self.settings['column']} in {self.path} must have dimensions (time,) or (time, y, x)")
+
+            for first_event in range(start, self.n_events, self.settings['chunk_size']):
+                window = {time_dim: slice(first_event, first_event + self.settings['chunk_size'])}
+                depth = variable.isel(window)
+                depth = samples.reduce(depth.isel(sample_cells).to_numpy()) if samples is not None else depth.to_numpy()
+
+                metadata = {}
+                if time_dim in dataset.coords:
+                    metadata['timestamp'] = pd.to_datetime(dataset[time_dim].isel(window).to_numpy()).strftime('%Y-%m-%dT%H:%M:%S').to_numpy(dtype=str)
+                if self.settings['storm_id_column'] is not None:
+                    metadata['storm_id'] = dataset[self.settings['storm_id_column']].isel(window).to_numpy().astype(str)
+
+                yield RainfallChunk(first_event, _validated(depth, str(self.path)), metadata)
+
+class RasterStackRainfall(_FileRainfall):
+    # A multi-band raster (e.g. radar precipitation) where every band is one event. Every node gets the
+    # rainfall over the road segments draining to it (see _Samples), read for a chunk of bands at a time
+    # from the window around all the samples and looked up in bulk.
+    def __init__(self, settings: config.RainfallSourceSettings) -> None:
+        super().__init__(settings)
+        with rasterio.open(self.path) as src:
+            self.n_events = src.count
+
+    def chunks(self, start: int = 0, points: List[shapely.geometry.Point] | None = None) -> Iterator[RainfallChunk]:
+        if points is None:
+            raise ValueError(f"{self.path} is gridded, node points are needed to look up rainfall")
+        samples = _Samples.contributing_segments(points)
+
+        with rasterio.open(self.path) as src:
+            rows, cols = rasterio.transform.rowcol(src.transform, *samples.coordinates(src.crs))
+            rows, cols = np.asarray(rows), np.asarray(cols)
+            if rows.min() < 0 or cols.min() < 0 or rows.max() >= src.height or cols.max() >= src.width:
+                raise ValueError(f"Road segments fall outside of rainfall raster {self.path}")
+
+            window = rasterio.windows.Window(cols.min(), rows.min(), cols.max() - cols.min() + 1, rows.max() - rows.min() + 1)
+            rows, cols = rows - rows.min(), cols - cols.min()
+
+            for first_event in range(start, self.n_events, self.settings['chunk_size']):
+                bands = list(range(first_event + 1, min(first_event + self.settings['chunk_size'], self.n_events) + 1)) # Bands are 1-indexed
+                values = src.read(bands, window=window).astype(float)[:, rows, cols] # (bands, samples)
+                if src.nodata is not None:
+                    values[values == src.nodata] = np.nan
+
+                metadata = {'band': np.array(bands)}
+                descriptions = [src.descriptions[band - 1] for band in bands]
+                if all(descriptions):
+                    metadata['band_description'] = np.array(descriptions, dtype=str)
+
+                yield RainfallChunk(first_event, _validated(samples.reduce(values), str(self.path)), metadata)
+
+def open_source() -> RainfallSource:
+    # A rainfall file from 'rainfall_source' if there is one, the inline 'rainfall_values' otherwise
+    settings = config.get_rainfall_source()
+    if settings is None:
+        return InlineRainfall(config.get_rainfall_values(), chunk_size=10000)
+
+    match settings['path'].suffix.lower():
+        case '.csv':
+            return CsvRainfall(settings)
+        case '.parquet' | '.pq':
+            return ParquetRainfall(settings)
+        case '.nc' | '.nc4' | '.netcdf':
+            return NetcdfRainfall(settings)
+        case '.tif' | '.tiff':
+            return RasterStackRainfall(settings)
+        case suffix:
+            raise ValueError(f"Unsupported rainfall file type '{suffix}', expected .csv, .parquet, .nc or .tif")
@@ -1,11 +1,12 @@
 import geopandas as gpd
 from pathlib import Path
 
-from utils import config
+from utils import config, profiling
 from . import drains
 
 path: Path = config.resolve_roads_data_path()
-_gdf = gpd.read_file(path)
+with profiling.stage('load roads'):
+    _gdf = gpd.read_file(path)
 
 # Data Validation Functions
 def __vd_index() -> None:
@@ -20,9 +21,10 @@ def __vd_length_and_area() -> None:
     if (zero_indices := [idx for idx, (length, area) in enumerate(zip(_gdf['LENGTH'], _gdf['AREA'])) if length <= 0 or area <= 0]):
             raise ValueError(f"Zero or negative LENGTH/AREA at road indices: {zero_indices}")
 
-__vd_index()
-__vd_road_types()
-__vd_length_and_area()
+with profiling.stage('validate roads'):
+    __vd_index()
+    __vd_road_types()
+    __vd_length_and_area()
 # TODO: Add slope to attribute for erosion
 
 # Pre-Processing Functions
@@ -79,4 +81,5 @@ def ___pp_calculate_drain_connectivity() -> None:
         print(f"\n\nTotal unroutable segment length: {unroutable_length}")
         print(f"\nNumber of unroutable segments: {len(unroutable_segments)}")
 
-___pp_calculate_drain_connectivity()
+with profiling.stage('road connectivity'):
+    ___pp_calculate_drain_connectivity()
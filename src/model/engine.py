@@ -0,0 +1,389 @@
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import TYPE_CHECKING, Callable, Dict, List
+import shapely.geometry
+import numpy as np
+
+from model.graph import Graph, NodeType, EfficiencyCurve, pond_efficiency
+from model.forest import ForestIndex
+from utils import config, profiling
+
+if TYPE_CHECKING: # Only needed for export, imported where they're used to keep importing the engine fast
+    import networkx as nx
+    import pandas as pd
+
+# The engine is a flat-array copy of the base graph. Every node has at most one child, so the
+# topology is just a `child` index array, and nodes are grouped into levels where every child
+# sits in a later level than all of its parents. A level can then be processed with a handful of
+# numpy operations for all of its nodes and for a whole batch of rainfall events at once.
+
+@dataclass
+class Level:
+    nodes: np.ndarray       # Every node in the level, routed nodes first and sorted by child
+    n_routed: int           # nodes[:n_routed] have a child
+    starts: np.ndarray      # np.add.reduceat boundaries of nodes[:n_routed] grouped by child
+    children: np.ndarray    # The child of each group in starts
+    ponds: np.ndarray       # Pond nodes in the level
+
+@dataclass
+class Topology:
+    points: List[shapely.geometry.point.Point]
+    node_type: np.ndarray               # (N,) NodeType.value
+    child: np.ndarray                   # (N,) index of the child node, -1 if there is none
+    distance_to_child: np.ndarray       # (N,) flowpath length to the child, 0 if there is none
+    cost_to_connect_child: np.ndarray   # (N,) volume-to-breakthrough of that flowpath, 0 if there is none
+    road_types: List[str]
+    local_area: np.ndarray              # (N, T) road area draining directly to the node per road type
+    local_length: np.ndarray            # (N, T) road length draining directly to the node per road type
+    runoff_coefficient: np.ndarray      # (T,)
+    erosion_rate: np.ndarray            # (T,)
+    max_capacity: np.ndarray            # (N,) 0 for anything that isn't a pond
+    used_capacity: np.ndarray           # (N,) 0 for anything that isn't a pond
+    depth: np.ndarray | None = None     # (N,) level of every node
+    levels: List[Level] = field(default_factory=list)
+    forest: ForestIndex | None = None   # Upstream/downstream index of the (static) drainage network
+
+    @property
+    def n_nodes(self) -> int: return len(self.points)
+
+    @property
+    def is_pond(self) -> np.ndarray: return self.node_type == NodeType.POND.value
+
+    @cached_property
+    def index(self) -> Dict[shapely.geometry.point.Point, int]: return {point: i for i, point in enumerate(self.points)} # Built once, points don't change
+
+    @profiling.timed
+    def build_levels(self) -> None:
+        # Longest path from any source, so that every child lands in a later level than its parents
+        depth = np.zeros(self.n_nodes, dtype=np.int64)
+        for node in range(self.n_nodes): # self.points is in topological order
+            if self.child[node] >= 0:
+                depth[self.child[node]] = max(depth[self.child[node]], depth[node] + 1)
+
+        self.depth = depth
+        self.levels = []
+        for level in range(int(depth.max(initial=-1)) + 1):
+            nodes = np.flatnonzero(depth == level)
+            routed = nodes[self.child[nodes] >= 0]
+            routed = routed[np.argsort(self.child[routed], kind='stable')]
+            children, starts = np.unique(self.child[routed], return_index=True)
+
+            self.levels.append(Level(
+                nodes=np.concatenate([routed, nodes[self.child[nodes] < 0]]),
+                n_routed=len(routed),
+                starts=starts,
+                children=children,
+                ponds=nodes[self.is_pond[nodes]],
+            ))
+        self.forest = ForestIndex.build(self)
+
+@profiling.timed
+def build_topology(graph: Graph) -> Topology:
+    road_types = config.get_road_types()
+    type_names = list(road_types)
+
+    order = graph.get_topological_order()
+    position = {point: i for i, point in enumerate(order)}
+    nodes = [graph.get_node(point) for point in order]
+
+    n, t = len(nodes), len(type_names)
+    topology = Topology(
+        points=order,
+        node_type=np.array([node.node_type.value for node in nodes], dtype=np.int64),
+        child=np.full(n, -1, dtype=np.int64),
+        distance_to_child=np.zeros(n),
+        cost_to_connect_child=np.zeros(n),
+        road_types=type_names,
+        local_area=np.zeros((n, t)),
+        local_length=np.zeros((n, t)),
+        runoff_coefficient=np.array([road_types[name]['runoff_coefficient'] for name in type_names]),
+        erosion_rate=np.array([road_types[name]['erosion_rate'] for name in type_names]),
+        max_capacity=np.zeros(n),
+        used_capacity=np.zeros(n),
+    )
+
+    for i, node in enumerate(nodes):
+        if node.child is not None:
+            if node.cost_to_connect_child is None or node.distance_to_child is None:
+                raise ValueError(f"{node.node_type} {node.point} is incomplete to compute child node (missing cost_to_connect_child)")
+            topology.child[i] = position[node.child]
+            topology.distance_to_child[i] = node.distance_to_child
+            topology.cost_to_connect_child[i] = node.cost_to_connect_child
+
+        for t_idx, name in enumerate(type_names):
+            topology.local_area[i, t_idx] = node.road._local_area.get(name, 0.0)
+            topology.local_length[i, t_idx] = node.road._local_length.get(name, 0.0)
+
+        if node.pond is not None:
+            topology.max_capacity[i] = node.pond.max_capacity
+            topology.used_capacity[i] = node.pond.used_capacity
+
+    topology.build_levels()
+    return topology
+
+@dataclass
+class EventResults:
+    rainfall: np.ndarray                    # (B,) or (B, N) rainfall depth in mm
+    runoff: np.ndarray                      # (B, N, T) runoff leaving each node (after pond trapping)
+    sediment: np.ndarray                    # (B, N, T) sediment leaving each node (after pond trapping)
+    volume_reaching_child: np.ndarray       # (B, N)
+    sediment_reaching_child: np.ndarray     # (B, N)
+    connected: np.ndarray                   # (B, N) True where the edge node -> child exists for the event
+    trapped_runoff: np.ndarray              # (B, N) 0 for anything that isn't a pond
+    trapped_sediment: np.ndarray            # (B, N) 0 for anything that isn't a pond
+    topology: Topology = field(repr=False)
+
+    @cached_property
+    def __contributing(self) -> np.ndarray:
+        # Only computed when asked for, from the connected edges with the forest index
+        local = np.stack([self.topology.local_area.sum(axis=1), self.topology.local_length.sum(axis=1)], axis=1)
+        return self.topology.forest.connected_upstream_sum(local, self.connected)
+
+    @property
+    def contributing_area(self) -> np.ndarray: return self.__contributing[..., 0] # (B, N) road area connected to the node for the event
+
+    @property
+    def contributing_length(self) -> np.ndarray: return self.__contributing[..., 1] # (B, N) road length connected to the node for the event
+
+    @property
+    def runoff_sum(self) -> np.ndarray: return self.runoff.sum(axis=-1)
+
+    @property
+    def sediment_sum(self) -> np.ndarray: return self.sediment.sum(axis=-1)
+
+def trap_in_ponds(runoff: np.ndarray, sediment: np.ndarray, available: np.ndarray, curve: EfficiencyCurve = EfficiencyCurve()) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # runoff/sediment (..., T) entering ponds with `available` (...) capacity left. Returns the share of
+    # runoff and of sediment that leaves the ponds, and the runoff and sediment they trap.
+    runoff_in = runoff.sum(axis=-1)
+    sediment_in = sediment.sum(axis=-1)
+
+    trapped = np.minimum(available, runoff_in)
+    runoff_out = runoff_in - trapped
+    efficiency = pond_efficiency(available, runoff_in, runoff_out, curve)
+
+    runoff_scale = np.divide(runoff_out, runoff_in, out=np.ones_like(runoff_in), where=runoff_in != 0)
+    return runoff_scale, 1 - efficiency, trapped, sediment_in * efficiency
+
+def route_to_children(runoff: np.ndarray, cost: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # runoff (..., T) leaving nodes whose flowpath costs `cost` (...) to break through. Returns the
+    # volume reaching the child and the share of runoff (and sediment) that it is.
+    runoff_total = runoff.sum(axis=-1)
+    volume = np.maximum(0, runoff_total - cost)
+    percent = np.divide(volume, runoff_total, out=np.zeros_like(volume), where=volume > 0)
+    return volume, percent
+
+def batch_size(topology: Topology, max_batch_values: int = 2 ** 24) -> int:
+    # Events per run_events call so that a (B, N, T) array holds at most max_batch_values values
+    return max(1, max_batch_values // (topology.n_nodes * len(topology.road_types)))
+
+def _batched(value: np.ndarray, batch_size: int, width: int) -> np.ndarray:
+    # Broadcast a shared (width,) parameter, or one row per event, to (B, width)
+    return np.broadcast_to(np.asarray(value, dtype=float), (batch_size, width))
+
+@profiling.timed
+def run_events(
+    topology: Topology,
+    rainfall: np.ndarray,
+    runoff_coefficient: np.ndarray | None = None,
+    erosion_rate: np.ndarray | None = None,
+    travel_cost: float | np.ndarray | None = None,
+    used_capacity: np.ndarray | None = None,
+    max_capacity: np.ndarray | None = None,
+    efficiency_curve: np.ndarray | None = None,
+) -> EventResults:
+    # rainfall is either (B,) with one depth per event, or (B, N) with a depth per node and event.
+    # The optional parameters override the topology's values, either shared ((T,), scalar, (N,)) or
+    # per event ((B, T), (B,), (B, N)). efficiency_curve holds the EfficiencyCurve coefficients, (4,) or (B, 4).
+    rainfall = np.asarray(rainfall, dtype=float)
+    b, n, t = rainfall.shape[0], topology.n_nodes, len(topology.road_types)
+
+    depth = (rainfall[:, None] if rainfall.ndim == 1 else rainfall) / 1000 # Rainfall is in mm and area is in square meters
+    coefficient = _batched(topology.runoff_coefficient if runoff_coefficient is None else runoff_coefficient, b, t)
+    erosion = _batched(topology.erosion_rate if erosion_rate is None else erosion_rate, b, t)
+
+    if travel_cost is None:
+        cost = np.broadcast_to(topology.cost_to_connect_child, (b, n))
+    else:
+        cost = np.asarray(travel_cost, dtype=float).reshape(-1, 1) * topology.distance_to_child
+
+    # A pond shrunk below what is already used has nothing left (rather than a negative capacity)
+    available = np.broadcast_to(np.maximum(0,
+        (topology.max_capacity if max_capacity is None else max_capacity) - (topology.used_capacity if used_capacity is None else used_capacity)
+    ), (b, n))
+    curve = EfficiencyCurve() if efficiency_curve is None else EfficiencyCurve(*_batched(efficiency_curve, b, len(EfficiencyCurve._fields)).T[..., None])
+
+    # Runoff/sediment start out as the local contribution and collect the parents' contributions as
+    # levels are processed, by the time a node's level comes up they hold ancestor + local.
+    runoff = topology.local_area * coefficient[:, None, :] * depth[..., None]
+    sediment = topology.local_area * erosion[:, None, :] * depth[..., None]
+
+    volume_reaching_child = np.zeros((b, n))
+    sediment_reaching_child = np.zeros((b, n))
+    connected = np.zeros((b, n), dtype=bool)
+    trapped_runoff = np.zeros((b, n))
+    trapped_sediment = np.zeros((b, n))
+
+    for level in topology.levels:
+        if len(level.ponds):
+            ponds = level.ponds
+            runoff_scale, sediment_scale, trapped_runoff[:, ponds], trapped_sediment[:, ponds] = trap_in_ponds(
+                runoff[:, ponds], sediment[:, ponds], available[:, ponds], curve
+            )
+            runoff[:, ponds] *= runoff_scale[..., None]
+            sediment[:, ponds] *= sediment_scale[..., None]
+
+        if level.n_routed == 0:
+            continue
+
+        routed = level.nodes[:level.n_routed]
+        volume, percent = route_to_children(runoff[:, routed], cost[:, routed])
+        is_connected = volume > 0
+
+        volume_reaching_child[:, routed] = volume
+        sediment_reaching_child[:, routed] = sediment[:, routed].sum(axis=-1) * percent
+        connected[:, routed] = is_connected
+
+        runoff[:, level.children] += np.add.reduceat(runoff[:, routed] * percent[..., None], level.starts, axis=1)
+        sediment[:, level.children] += np.add.reduceat(sediment[:, routed] * percent[..., None], level.starts, axis=1)
+
+    return EventResults(
+        rainfall=rainfall,
+        runoff=runoff,
+        sediment=sediment,
+        volume_reaching_child=volume_reaching_child,
+        sediment_reaching_child=sediment_reaching_child,
+        connected=connected,
+        trapped_runoff=trapped_runoff,
+        trapped_sediment=trapped_sediment,
+        topology=topology,
+    )
+
+def to_networkx(topology: Topology, results: EventResults, event: int) -> 'nx.DiGraph':
+    # One event of a batch as a NetworkX graph keyed by point, with only the connected edges.
+    # For export and visualization, the engine itself never builds graphs.
+    import networkx as nx
+    graph = nx.DiGraph()
+    for node, point in enumerate(topology.points):
+        graph.add_node(
+            point,
+            node_type=NodeType(topology.node_type[node]).name,
+            runoff=float(results.runoff_sum[event, node]),
+            sediment=float(results.sediment_sum[event, node]),
+            trapped_runoff=float(results.trapped_runoff[event, node]),
+            trapped_sediment=float(results.trapped_sediment[event, node]),
+            contributing_area=float(results.contributing_area[event, node]),
+            contributing_length=float(results.contributing_length[event, node]),
+        )
+    for node in np.flatnonzero(results.connected[event]):
+        graph.add_edge(
+            topology.points[node],
+            topology.points[topology.child[node]],
+            weight=float(topology.distance_to_child[node]),
+            volume=float(results.volume_reaching_child[event, node]),
+            sediment=float(results.sediment_reaching_child[event, node]),
+        )
+    return graph
+
+@dataclass
+class EventAggregates:
+    # Per-node totals over every event run so far, small enough to checkpoint
+    n_events: int
+    runoff: np.ndarray                      # (N,) runoff leaving each node
+    sediment: np.ndarray                    # (N,) sediment leaving each node
+    volume_reaching_child: np.ndarray       # (N,)
+    sediment_reaching_child: np.ndarray     # (N,)
+    trapped_sediment: np.ndarray            # (N,) 0 for anything that isn't a pond
+    events_connected: np.ndarray            # (N,) number of events the node reached its child
+
+    @classmethod
+    def empty(cls, n_nodes: int) -> 'EventAggregates':
+        return cls(
+            n_events=0,
+            runoff=np.zeros(n_nodes),
+            sediment=np.zeros(n_nodes),
+            volume_reaching_child=np.zeros(n_nodes),
+            sediment_reaching_child=np.zeros(n_nodes),
+            trapped_sediment=np.zeros(n_nodes),
+            events_connected=np.zeros(n_nodes, dtype=np.int64),
+        )
+
+    def add(self, results: EventResults) -> None:
+        self.n_events += results.rainfall.shape[0]
+        self.runoff += results.runoff_sum.sum(axis=0)
+        self.sediment += results.sediment_sum.sum(axis=0)
+        self.volume_reaching_child += results.volume_reaching_child.sum(axis=0)
+        self.sediment_reaching_child += results.sediment_reaching_child.sum(axis=0)
+        self.trapped_sediment += results.trapped_sediment.sum(axis=0)
+        self.events_connected += results.connected.sum(axis=0)
+
+@dataclass
+class EventLog:
+    # One row per event with the rainfall series' metadata (timestamp, storm id, ...) and watershed totals
+    columns: Dict[str, List[np.ndarray]] = field(default_factory=dict)
+
+    def __append(self, first_event: int, n_events: int, metadata: Dict[str, np.ndarray], totals: Dict[str, np.ndarray]) -> None:
+        rows = {'event': np.arange(first_event, first_event + n_events), **metadata, **totals}
+        for name, values in rows.items():
+            self.columns.setdefault(name, []).append(np.atleast_1d(values))
+
+    def add(self, first_event: int, topology: Topology, results: EventResults, metadata: Dict[str, np.ndarray]) -> None:
+        terminal = topology.child < 0
+        self.__append(first_event, results.rainfall.shape[0], metadata, {
+            'rainfall': results.rainfall if results.rainfall.ndim == 1 else results.rainfall.mean(axis=1),
+            'runoff_out': results.runoff_sum[:, terminal].sum(axis=1),
+            'sediment_out': results.sediment_sum[:, terminal].sum(axis=1),
+            'trapped_sediment': results.trapped_sediment.sum(axis=1),
+            'connected_edges': results.connected.sum(axis=1),
+        })
+
+    @property
+    def n_batches(self) -> int:
+        # Number of calls to add (from_arrays counts as one)
+        return len(next(iter(self.columns.values()), []))
+
+    def to_arrays(self, since: int = 0) -> Dict[str, np.ndarray]:
+        # The rows of the batches from the `since`-th one on, e.g. the ones added since a checkpoint
+        return {name: np.concatenate(values[since:]) for name, values in self.columns.items() if values[since:]}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'EventLog':
+        return cls(columns={name: [values] for name, values in arrays.items()})
+
+    def to_frame(self) -> 'pd.DataFrame':
+        import pandas as pd
+        return pd.DataFrame(self.to_arrays())
+
+@dataclass
+class PondState:
+    # Everything continuous mode carries from one event to the next, enough to restart a run
+    next_event: int
+    used_capacity: np.ndarray # (N,)
+
+def run_continuous(
+    topology: Topology,
+    rainfall: np.ndarray,
+    bulk_density: float,
+    state: PondState,
+    on_event: Callable[[PondState, EventResults], None] | None = None,
+) -> PondState:
+    # Runs rainfall ((E,) or (E, N), e.g. one chunk of a long series) in sequence starting from state.
+    # The sediment a pond traps is converted to a volume through the sediment bulk density and stays in
+    # the pond, shrinking its available capacity for later events. on_event is called after every event
+    # with the updated state and that event's results, e.g. to aggregate them or write checkpoints.
+    if bulk_density <= 0:
+        raise ValueError("sediment_bulk_density must be a positive number")
+
+    rainfall = np.asarray(rainfall, dtype=float)
+    for event in range(rainfall.shape[0]):
+        result = run_events(topology, rainfall[event:event + 1], used_capacity=state.used_capacity)
+
+        state.used_capacity = np.minimum(
+            topology.max_capacity,
+            state.used_capacity + result.trapped_sediment[0] / bulk_density
+        )
+        state.next_event += 1
+
+        if on_event is not None:
+            on_event(state, result)
+
+    return state
@@ -0,0 +1,176 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List
+import shapely.geometry
+import numpy as np
+
+from model.graph import EfficiencyCurve
+from model.engine import Topology, run_events, batch_size
+from utils.config import DistributionData
+
+if TYPE_CHECKING: # Only needed for export, imported where it's used
+    import pandas as pd
+
+# An ensemble runs every rainfall event once per parameter sample. Samples are just another batch
+# dimension for the engine: a kernel call takes a block of (sample, event) rows with the sample's
+# runoff coefficients, erosion rates, travel cost and pond parameters on each row. Per-node totals
+# are kept per sample, and percentiles over the samples give the uncertainty band of every node.
+
+def sample_distribution(distribution: DistributionData, rng: np.random.Generator, n: int) -> np.ndarray:
+    p = distribution['parameters']
+    match distribution['distribution']:
+        case 'uniform':
+            return rng.uniform(p['low'], p['high'], n)
+        case 'normal':
+            # Truncated at 0: negative samples are drawn again, at least half of every draw is kept
+            if p['mean'] < 0:
+                raise ValueError("A normal distribution truncated at 0 needs mean >= 0")
+            values = rng.normal(p['mean'], p['std'], n)
+            while (negative := values < 0).any():
+                values[negative] = rng.normal(p['mean'], p['std'], negative.sum())
+            return values
+        case 'lognormal':
+            return rng.lognormal(np.log(p['median']), p['sigma'], n)
+        case 'triangular':
+            return rng.triangular(p['low'], p['mode'], p['high'], n)
+        case unknown:
+            raise ValueError(f"Unknown distribution '{unknown}'")
+
+@dataclass
+class ParameterSamples:
+    runoff_coefficient: np.ndarray  # (S, T)
+    erosion_rate: np.ndarray        # (S, T)
+    travel_cost: np.ndarray         # (S,)
+    pond_capacity: np.ndarray       # (S,) multiplier of every pond's max capacity
+    pond_efficiency: np.ndarray     # (S, 4) EfficiencyCurve coefficients
+
+    @classmethod
+    def constant(cls, topology: Topology, travel_cost: float, n_samples: int) -> 'ParameterSamples':
+        # The configured value of every parameter in every sample
+        return cls(
+            runoff_coefficient=np.repeat(topology.runoff_coefficient[None], n_samples, axis=0),
+            erosion_rate=np.repeat(topology.erosion_rate[None], n_samples, axis=0),
+            travel_cost=np.full(n_samples, travel_cost),
+            pond_capacity=np.ones(n_samples),
+            pond_efficiency=np.repeat(np.array(EfficiencyCurve(), dtype=float)[None], n_samples, axis=0),
+        )
+
+    @property
+    def n_samples(self) -> int: return len(self.travel_cost)
+
+    def set(self, name: str, road_types: List[str], values: np.ndarray) -> None:
+        # name is '<road type>.runoff_coefficient', '<road type>.erosion_rate', 'travel_cost', 'pond_capacity'
+        # or 'pond_efficiency.<EfficiencyCurve field>'
+        group, _, member = name.partition('.')
+        if group in ('travel_cost', 'pond_capacity'):
+            getattr(self, group)[:] = values
+        elif group == 'pond_efficiency':
+            self.pond_efficiency[:, EfficiencyCurve._fields.index(member)] = values
+        else:
+            getattr(self, member)[:, road_types.index(group)] = values
+
+    def to_frame(self, road_types: List[str]) -> 'pd.DataFrame':
+        import pandas as pd
+        columns = {'travel_cost': self.travel_cost, 'pond_capacity': self.pond_capacity}
+        for t, road_type in enumerate(road_types):
+            columns[f"{road_type}.runoff_coefficient"] = self.runoff_coefficient[:, t]
+            columns[f"{road_type}.erosion_rate"] = self.erosion_rate[:, t]
+        for c, name in enumerate(EfficiencyCurve._fields):
+            columns[f"pond_efficiency.{name}"] = self.pond_efficiency[:, c]
+        return pd.DataFrame(columns)
+
+def sample_parameters(topology: Topology, travel_cost: float, distributions: Dict[str, DistributionData], n_samples: int, seed: int | None = None) -> ParameterSamples:
+    # Parameters without a distribution keep the configured value in every sample
+    rng = np.random.default_rng(seed)
+    samples = ParameterSamples.constant(topology, travel_cost, n_samples)
+    for name, distribution in distributions.items(): # Config order, so a seed always gives the same samples
+        samples.set(name, topology.road_types, sample_distribution(distribution, rng, n_samples))
+    np.clip(samples.runoff_coefficient, 0, 1, out=samples.runoff_coefficient) # A coefficient is a fraction of the rainfall
+    return samples
+
+@dataclass
+class EnsembleResults:
+    samples: ParameterSamples
+    n_events: int
+    runoff: np.ndarray              # (S, N) runoff leaving each node, summed over events
+    sediment: np.ndarray            # (S, N) sediment leaving each node, summed over events
+    trapped_sediment: np.ndarray    # (S, N)
+    events_connected: np.ndarray    # (S, N)
+
+    @classmethod
+    def empty(cls, samples: ParameterSamples, n_nodes: int) -> 'EnsembleResults':
+        shape = (samples.n_samples, n_nodes)
+        return cls(
+            samples=samples,
+            n_events=0,
+            runoff=np.zeros(shape),
+            sediment=np.zeros(shape),
+            trapped_sediment=np.zeros(shape),
+            events_connected=np.zeros(shape, dtype=np.int64),
+        )
+
+    def percentiles(self, quantity: str, q: List[float]) -> np.ndarray:
+        # (Q, N) percentiles over the samples of the per-event mean of a quantity
+        return np.percentile(getattr(self, quantity) / max(self.n_events, 1), q, axis=0)
+
+    def to_frame(self, points: List[shapely.geometry.point.Point], q: List[float]) -> 'pd.DataFrame':
+        # One row per node, one column per quantity and percentile (e.g. sediment_p95)
+        import pandas as pd
+        columns: Dict[str, object] = {'node': points}
+        for quantity in ('runoff', 'sediment', 'trapped_sediment', 'events_connected'):
+            for p, values in zip(q, self.percentiles(quantity, q)):
+                columns[f"{quantity}_p{p:g}"] = values
+        return pd.DataFrame(columns)
+
+def run_ensemble(
+    topology: Topology,
+    rainfall: np.ndarray,
+    results: EnsembleResults,
+    max_batch_values: int = 2 ** 24,
+    workers: int | None = None,
+) -> None:
+    # Adds one chunk of rainfall events ((E,) or (E, N)) to the ensemble totals. Blocks of samples are
+    # independent and write to their own rows, so they run on `workers` threads (default: up to 4). The
+    # kernel calls running at the same time hold at most max_batch_values runoff values (rows x nodes x
+    # road types) between them, which bounds memory.
+    rainfall = np.asarray(rainfall, dtype=float)
+    samples = results.samples
+    workers = workers or min(4, os.cpu_count() or 1)
+    rows = batch_size(topology, max(1, max_batch_values // workers))
+
+    blocks = []
+    for first_event in range(0, rainfall.shape[0], rows):
+        events = rainfall[first_event:first_event + rows]
+        per_block = max(1, rows // events.shape[0])
+        blocks.extend((events, first_sample, min(first_sample + per_block, samples.n_samples)) for first_sample in range(0, samples.n_samples, per_block))
+
+    def run_block(block: tuple[np.ndarray, int, int]) -> None:
+        events, first, last = block
+        n_events, block_samples = events.shape[0], slice(first, last)
+
+        # Rows are sample-major: row s * n_events + e is event e with sample first + s
+        result = run_events(
+            topology,
+            np.tile(events, (last - first,) + (1,) * (events.ndim - 1)),
+            runoff_coefficient=np.repeat(samples.runoff_coefficient[block_samples], n_events, axis=0),
+            erosion_rate=np.repeat(samples.erosion_rate[block_samples], n_events, axis=0),
+            travel_cost=np.repeat(samples.travel_cost[block_samples], n_events),
+            max_capacity=np.repeat(samples.pond_capacity[block_samples, None] * topology.max_capacity, n_events, axis=0),
+            efficiency_curve=np.repeat(samples.pond_efficiency[block_samples], n_events, axis=0),
+        )
+        shape = (last - first, n_events, topology.n_nodes)
+        results.runoff[block_samples] += result.runoff_sum.reshape(shape).sum(axis=1)
+        results.sediment[block_samples] += result.sediment_sum.reshape(shape).sum(axis=1)
+        results.trapped_sediment[block_samples] += result.trapped_sediment.reshape(shape).sum(axis=1)
+        results.events_connected[block_samples] += result.connected.reshape(shape).sum(axis=1)
+
+    # Blocks of the same samples (events split over several blocks) must not run at the same time
+    by_samples: Dict[int, list] = {}
+    for block in blocks:
+        by_samples.setdefault(block[1], []).append(block)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda group: [run_block(block) for block in group], by_samples.values()))
+
+    results.n_events += rainfall.shape[0]
@@ -0,0 +1,182 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List
+import shapely.geometry
+import numpy as np
+
+if TYPE_CHECKING: # engine builds the index, this module only needs its types
+    from model.engine import Topology
+    from model.scenario import SegmentTable
+
+# Every node has at most one child, so the nodes draining through X form a subtree of the reversed
+# forest (X and everything upstream of it). Numbering the nodes in pre-order from the terminal nodes
+# upstream puts every such subtree in one contiguous interval [tin[X], tout[X]) of positions, and
+# "does A drain through B" becomes two comparisons, and a sum over everything upstream of a node a
+# difference of two prefix sums.
+
+@dataclass
+class ForestIndex:
+    child: np.ndarray   # (N,) as in Topology
+    order: np.ndarray   # (N,) node at every position, terminal nodes before everything upstream of them
+    tin: np.ndarray     # (N,) position of every node
+    tout: np.ndarray    # (N,) end of its interval, order[tin[X]:tout[X]] is X and everything upstream of it
+    terminal: np.ndarray # (N,) terminal node every node ends up at
+    position_child: np.ndarray # (N,) position of the child of the node at every position, -1 if there is none
+
+    @classmethod
+    def build(cls, topology: 'Topology') -> 'ForestIndex':
+        # Subtree sizes parents-first and positions children-first, one level at a time
+        n, child = topology.n_nodes, topology.child
+        size = np.ones(n, dtype=np.int64)
+        for level in topology.levels:
+            routed = level.nodes[:level.n_routed]
+            if len(routed):
+                size[level.children] += np.add.reduceat(size[routed], level.starts)
+
+        # A node starts right after its child, after the subtrees of the siblings that come before it
+        routed = np.flatnonzero(child >= 0)
+        routed = routed[np.argsort(child[routed], kind='stable')]
+        before = np.cumsum(size[routed]) - size[routed]
+        _, first = np.unique(child[routed], return_index=True)
+        group_start = np.repeat(before[first], np.diff(np.append(first, len(routed))))
+        offset = np.zeros(n, dtype=np.int64)
+        offset[routed] = before - group_start
+
+        roots = np.flatnonzero(child < 0)
+        tin = np.zeros(n, dtype=np.int64)
+        tin[roots] = np.cumsum(size[roots]) - size[roots]
+        terminal = np.arange(n)
+        for level in reversed(topology.levels):
+            nodes = level.nodes[:level.n_routed]
+            tin[nodes] = tin[child[nodes]] + 1 + offset[nodes]
+            terminal[nodes] = terminal[child[nodes]]
+
+        order = np.empty(n, dtype=np.int64)
+        order[tin] = np.arange(n)
+        position_child = np.where(child[order] >= 0, tin[child[order]], -1)
+        return cls(child=child, order=order, tin=tin, tout=tin + size, terminal=terminal, position_child=position_child)
+
+    @property
+    def n_nodes(self) -> int: return len(self.order)
+
+    def drains_through(self, node: int | np.ndarray, through: int | np.ndarray) -> np.ndarray:
+        # True where `node` is `through` or upstream of it (broadcasts)
+        node, through = np.asarray(node), np.asarray(through)
+        return (self.tin[through] <= self.tin[node]) & (self.tin[node] < self.tout[through])
+
+    def upstream(self, node: int) -> np.ndarray:
+        # Every node draining through `node`, including itself
+        return self.order[self.tin[node]:self.tout[node]]
+
+    def downstream(self, node: int) -> np.ndarray:
+        # Path from `node` (included) to its terminal node
+        path = [node]
+        while self.child[path[-1]] >= 0:
+            path.append(int(self.child[path[-1]]))
+        return np.array(path, dtype=np.int64)
+
+    def upstream_count(self) -> np.ndarray:
+        return self.tout - self.tin
+
+    def upstream_sum(self, values: np.ndarray) -> np.ndarray:
+        # values (..., N) summed over every node's interval
+        prefix = np.concatenate([np.zeros(values.shape[:-1] + (1,)), np.cumsum(values[..., self.order], axis=-1)], axis=-1)
+        return prefix[..., self.tout] - prefix[..., self.tin]
+
+    def connected_upstream_sum(self, values: np.ndarray, connected: np.ndarray) -> np.ndarray:
+        # values (N, V) summed over the nodes whose whole path to X is connected, for every event of
+        # connected (B, N) -> (B, N, V). Starting from the static upstream sums, a cut edge t removes
+        # everything upstream of it from the nodes that t is the first cut above: the path from child(t)
+        # to the next cut (or terminal) node below it. A path update is two point updates, at its top and
+        # below its bottom, summed over every node's interval. Everything is done by position.
+        b, n = connected.shape
+        rows = np.arange(b)[:, None]
+        child, end = self.position_child, self.tout[self.order]
+        cut = ~connected[:, self.order] & (child >= 0)
+
+        # Cut edges on the path from every position to its terminal node, via a difference array
+        ended = np.bincount((rows * (n + 1) + end).reshape(-1), cut.reshape(-1), minlength=b * (n + 1)).reshape(b, n + 1)
+        cuts = np.cumsum(cut - ended[:, :n], axis=1).astype(np.int64)
+
+        # The first cut or terminal node at or below p is the last one before p with the same number of
+        # cuts below it. Cut counts are small, as int16 numpy sorts them with a radix sort, and the stable
+        # sort keeps positions in order within a count.
+        sort = np.argsort(cuts.astype(np.int16) if cuts.max(initial=0) < np.iinfo(np.int16).max else cuts, axis=1, kind='stable')
+        stops = np.take_along_axis(cut | (child < 0), sort, axis=1)
+        last_stop = np.maximum.accumulate(np.where(stops, np.arange(n), 0), axis=1)
+        stop = np.empty_like(sort)
+        np.put_along_axis(stop, sort, np.take_along_axis(sort, last_stop, axis=1), axis=1)
+
+        ordered = values[self.order]
+        prefix = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(ordered, axis=0)])
+        upstream = prefix[end] - prefix[:n] # (N, V) by position
+
+        row, top = np.nonzero(cut)
+        top_child = child[top]
+        below = child[stop[row, top_child]] # -1 when the path runs to the terminal node
+        bottom = below >= 0
+        index = np.concatenate([row * n + top_child, row[bottom] * n + below[bottom]])
+
+        connected_upstream = np.empty((b, n, values.shape[1]))
+        for v in range(values.shape[1]):
+            weights = np.concatenate([upstream[top, v], -upstream[top[bottom], v]])
+            points = np.bincount(index, weights, minlength=b * n).reshape(b, n)
+            points_prefix = np.concatenate([np.zeros((b, 1)), np.cumsum(points, axis=1)], axis=1)
+            connected_upstream[..., v] = (upstream[:, v] - (points_prefix[:, end] - points_prefix[:, :n]))[:, self.tin]
+        return connected_upstream
+
+@dataclass
+class ItemIndex:
+    # Items attached to nodes (e.g. road segments and the drain they drain to), sorted by position,
+    # so that the items upstream of a node are found with two binary searches
+    forest: ForestIndex
+    items: np.ndarray       # Item indices sorted by position of their node
+    positions: np.ndarray   # Position of each item in `items`
+
+    @classmethod
+    def build(cls, forest: ForestIndex, item_nodes: np.ndarray) -> 'ItemIndex':
+        # Items at node -1 (e.g. unroutable segments) are left out
+        attached = np.flatnonzero(item_nodes >= 0)
+        positions = forest.tin[item_nodes[attached]]
+        sort = np.argsort(positions, kind='stable')
+        return cls(forest=forest, items=attached[sort], positions=positions[sort])
+
+    def upstream(self, node: int) -> np.ndarray:
+        low = np.searchsorted(self.positions, self.forest.tin[node])
+        high = np.searchsorted(self.positions, self.forest.tout[node])
+        return self.items[low:high]
+
+class DrainageQueries:
+    # Point based upstream/downstream queries over the static drainage network
+    def __init__(self, topology: 'Topology', segments: 'SegmentTable') -> None:
+        self.topology = topology
+        self.forest = topology.forest
+        self.segments = ItemIndex.build(self.forest, segments.node)
+        self.position = topology.index
+        self.upstream_area = self.forest.upstream_sum(topology.local_area.sum(axis=1))
+        self.upstream_length = self.forest.upstream_sum(topology.local_length.sum(axis=1))
+
+    def __node(self, point: shapely.geometry.point.Point) -> int:
+        if (node := self.position.get(point)) is None:
+            raise KeyError(f"{point} is not a node of the graph")
+        return node
+
+    def segments_reaching(self, point: shapely.geometry.point.Point) -> np.ndarray:
+        # Road segments (row numbers of the roads file) draining to or through the node
+        return np.sort(self.segments.upstream(self.__node(point)))
+
+    def upstream(self, point: shapely.geometry.point.Point) -> List[shapely.geometry.point.Point]:
+        return [self.topology.points[node] for node in self.forest.upstream(self.__node(point))]
+
+    def downstream(self, point: shapely.geometry.point.Point) -> List[shapely.geometry.point.Point]:
+        return [self.topology.points[node] for node in self.forest.downstream(self.__node(point))]
+
+    def drains_through(self, point: shapely.geometry.point.Point, through: shapely.geometry.point.Point) -> bool:
+        return bool(self.forest.drains_through(self.__node(point), self.__node(through)))
+
+    def terminal(self, point: shapely.geometry.point.Point) -> shapely.geometry.point.Point:
+        return self.topology.points[self.forest.terminal[self.__node(point)]]
+
+    def contributing_road(self, point: shapely.geometry.point.Point) -> tuple[float, float]:
+        # Road area and length upstream of the node if every flowpath connected
+        node = self.__node(point)
+        return float(self.upstream_area[node]), float(self.upstream_length[node])
@@ -1,7 +1,103 @@
-from model.base import Model
+import argparse
+from pathlib import Path
+from typing import Callable, Dict
+import model
+from utils import profiling
+from preprocess import main as preprocess
 
-def main():
-        Model()
+# Only the standard library, utils and the package metadata are imported up front, so --help,
+# --version and validate start instantly. The model (and its input files) load when it runs.
+
+def banner() -> None:
+    print(f"Welcome to RoadConnect version {model.__version__}.")
+    print(f"This program has been written by {model.__author__} ({model.__email__}, or {model.__secondary_email__}) as part of an undergraduate capstone research project at the University of Texas at Austin.")
+    print(f"This version of the program is licensed under {model.__license__}.")
+    print("Thank you to Professor Carlos E. Ramos Scharrón for his mentorship and the foundational field studies that supported this research.")
+    print("Thank you to Protectores de Cuencas Inc. for supporting me in this project with a stipend.")
+
+def run(args: argparse.Namespace) -> int:
+    banner()
+    with profiling.stage('import'): # Importing the model is most of the startup time
+        from model.base import Model
+    Model()
+    return 0
+
+def validate(args: argparse.Namespace) -> int:
+    # Every configuration value the run would read, and with --data the input files themselves
+    from utils import config
+
+    checks: Dict[str, Callable[[], object]] = {
+        'road_types': config.get_road_types,
+        'travel_cost': config.get_flowpath_travel_cost,
+        'simulation_mode': config.get_simulation_mode,
+        'rainfall': lambda: config.get_rainfall_source() or config.get_rainfall_values(),
+        'checkpoint': config.get_checkpoint_settings,
+        **{f"datapaths.{name}": getattr(config, f"resolve_{name}_data_path") for name in ('roads', 'flowpaths', 'drains', 'ponds', 'elevation')},
+    }
+
+    failed = 0
+    def check(name: str, function: Callable[[], object], errors: tuple = (KeyError, ValueError, TypeError, OSError)) -> object:
+        nonlocal failed
+        try:
+            result = function()
+        except errors as error:
+            failed += 1
+            print(f"{name}: {error}")
+            return None
+        print(f"{name}: ok")
+        return result
+
+    for name, function in checks.items():
+        mode = check(name, function)
+        if name == 'simulation_mode' and mode is not None:
+            checks_for_mode = {
+                'continuous': {'sediment_bulk_density': config.get_sediment_bulk_density},
+                'ensemble': {'uncertainty': config.get_uncertainty_settings},
+                'sensitivity': {'sensitivity': config.get_sensitivity_settings},
+            }.get(mode, {})
+            for mode_name, mode_function in checks_for_mode.items():
+                check(mode_name, mode_function)
+
+    if args.data and not failed:
+        # The data modules validate their files as they load, anything that goes wrong is an invalid input
+        from model import data
+        check('rainfall source', lambda: data.rainfall.open_source(), (Exception,))
+        check('input files', lambda: (data.drains, data.ponds), (Exception,))
+
+    print("Configuration is valid" if not failed else f"{failed} problem{'s' if failed > 1 else ''} found")
+    return 1 if failed else 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='roadconnect', description="A road runoff and sediment model")
+    parser.add_argument('--version', action='version', version=f"RoadConnect {model.__version__}")
+    parser.add_argument('--profile', type=Path, metavar='REPORT', help="write the wall/CPU time and peak memory of every stage and hot function as JSON")
+    parser.add_argument('--pstats', type=Path, metavar='FILE', help="also run cProfile and write its stats (python -m pstats FILE)")
+    parser.add_argument('--speedscope', type=Path, metavar='FILE', help="write the stage timeline for https://www.speedscope.app")
+    parser.set_defaults(command=run)
+
+    commands = parser.add_subparsers(title='commands')
+    commands.add_parser('run', help="run the model as configured in config/config.json (the default)").set_defaults(command=run)
+    validate_parser = commands.add_parser('validate', help="check config/config.json without running the model")
+    validate_parser.add_argument('--data', action='store_true', help="also load and validate the input files")
+    validate_parser.set_defaults(command=validate)
+    preprocess.add_parser(commands)
+
+    args = parser.parse_args()
+    profiler = None
+    if args.profile or args.pstats or args.speedscope:
+        profiler = profiling.enable(use_cprofile=args.pstats is not None)
+
+    try:
+        return args.command(args)
+    finally:
+        if profiler is not None:
+            profiling.disable()
+            if args.profile:
+                profiler.write(args.profile)
+            if args.pstats:
+                profiler.write_pstats(args.pstats)
+            if args.speedscope:
+                profiler.write_speedscope(args.speedscope)
 
 if __name__ == '__main__':
-    main()
+    raise SystemExit(main())
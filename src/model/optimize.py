@@ -0,0 +1,108 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, List
+import shapely.geometry
+import numpy as np
+
+from model.scenario import Scenario
+
+if TYPE_CHECKING: # Only needed for export, imported where it's used
+    import pandas as pd
+
+# Pond siting picks ponds one at a time, each time the candidate that adds the most trapped sediment
+# over the rainfall ensemble. A pond mostly takes sediment away from ponds below it, so a candidate's
+# gain only shrinks as others get picked (diminishing returns). Lazy greedy uses that: gains from earlier
+# rounds are upper bounds, and a candidate is only re-evaluated when it comes out on top of the queue.
+# Every evaluation is an incremental what-if on the scenario, so no full runs are needed.
+
+@dataclass(frozen=True)
+class Candidate:
+    node: int
+    max_capacity: float
+    cost: float = 1.0
+
+@dataclass
+class Selection:
+    candidate: Candidate
+    point: shapely.geometry.point.Point
+    gain: float # Trapped sediment the pond added over the ensemble when it was picked
+
+@dataclass
+class SitingResult:
+    selected: List[Selection]
+    trapped_sediment: float # Over the ensemble, with the selected ponds in place
+    evaluations: int
+
+    @property
+    def cost(self) -> float: return sum(selection.candidate.cost for selection in self.selected)
+
+    def to_frame(self) -> 'pd.DataFrame':
+        import pandas as pd
+        return pd.DataFrame({
+            'node': [s.point for s in self.selected],
+            'max_capacity': [s.candidate.max_capacity for s in self.selected],
+            'cost': [s.candidate.cost for s in self.selected],
+            'gain': [s.gain for s in self.selected],
+        })
+
+def candidate_grid(scenario: Scenario, capacities: Iterable[float], nodes: Iterable[int] | None = None, cost_per_volume: float | None = None) -> List[Candidate]:
+    # Every node/capacity pair, nodes default to everything that isn't a pond yet (drains and flowpath ends).
+    # Without cost_per_volume every pond costs 1, so a budget is a number of ponds.
+    if nodes is None:
+        nodes = np.flatnonzero(~scenario.topology.is_pond)
+    return [
+        Candidate(int(node), float(capacity), 1.0 if cost_per_volume is None else float(capacity) * cost_per_volume)
+        for node in nodes for capacity in capacities
+    ]
+
+def _gain(scenario: Scenario, candidate: Candidate) -> float:
+    change = scenario.propose_pond(candidate.node, candidate.max_capacity)
+    return float(scenario.delta(change, 'trapped_sediment').sum())
+
+def site_ponds(scenario: Scenario, candidates: List[Candidate], k: int | None = None, budget: float | None = None, workers: int | None = None) -> SitingResult:
+    # Picks up to k ponds and/or up to `budget` total cost, at most one per node. With a budget candidates
+    # are ranked by gain per cost. The selected ponds are applied to the scenario.
+    if k is None and budget is None:
+        raise ValueError("Pond siting needs k, a budget or both")
+    if any(candidate.cost <= 0 for candidate in candidates):
+        raise ValueError("Candidate costs must be positive numbers")
+
+    def score(gain: float, candidate: Candidate) -> float:
+        return gain / candidate.cost if budget is not None else gain
+
+    # First round evaluates everything against the same scenario, which is read-only and runs in parallel
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        gains = list(executor.map(lambda candidate: _gain(scenario, candidate), candidates))
+    evaluations = len(candidates)
+
+    # (-score, candidate, number of ponds selected when the score was computed)
+    queue = [(-score(gain, candidate), i, 0) for i, (gain, candidate) in enumerate(zip(gains, candidates))]
+    heapq.heapify(queue)
+
+    selected: List[Selection] = []
+    taken = set(np.flatnonzero(scenario.topology.is_pond))
+    remaining = float('inf') if budget is None else budget
+
+    while queue and (k is None or len(selected) < k):
+        negative_score, i, stamp = heapq.heappop(queue)
+        candidate = candidates[i]
+        if candidate.node in taken or candidate.cost > remaining:
+            continue
+        if -negative_score <= 0:
+            break # Nothing left that adds trapped sediment
+
+        if stamp < len(selected):
+            gain = _gain(scenario, candidate)
+            evaluations += 1
+            heapq.heappush(queue, (-score(gain, candidate), i, len(selected)))
+            continue
+
+        change = scenario.propose_pond(candidate.node, candidate.max_capacity)
+        gain = float(scenario.delta(change, 'trapped_sediment').sum())
+        scenario.apply(change)
+        selected.append(Selection(candidate, scenario.topology.points[candidate.node], gain))
+        taken.add(candidate.node)
+        remaining -= candidate.cost
+
+    return SitingResult(selected=selected, trapped_sediment=float(scenario.trapped_sediment.sum()), evaluations=evaluations)
@@ -0,0 +1,273 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List
+import numpy as np
+
+from model.engine import Topology, run_events
+
+if TYPE_CHECKING: # Only needed for export
+    import networkx as nx
+    import pandas as pd
+
+# For a fixed graph and a single rainfall depth R over the whole watershed, the runoff reaching every
+# node is a piecewise-linear function of R: local runoff is linear in R, a flowpath passes max(0, S - cost)
+# and a pond passes max(0, S - available capacity), and sums/clips of convex non-decreasing piecewise-linear
+# functions stay convex, non-decreasing and piecewise-linear. The breakpoints are the depths where an edge
+# connects or a pond fills. These are derived once, after which any depth is answered by evaluating the
+# functions instead of running the graph.
+#
+# Sediment is scaled by the share of runoff that gets through (a ratio of piecewise-linear functions) and
+# by the pond efficiency curve, so it isn't piecewise-linear. It is tabulated once on a rainfall grid with
+# the batched engine and interpolated, the error shrinks with the grid resolution.
+
+@dataclass
+class PiecewiseLinear:
+    # f(x) for x >= 0, linear between the breakpoints xs (xs[0] == 0) and with slope `slope` after xs[-1]
+    xs: np.ndarray
+    ys: np.ndarray
+    slope: float
+
+    @classmethod
+    def linear(cls, slope: float) -> 'PiecewiseLinear':
+        return cls(xs=np.zeros(1), ys=np.zeros(1), slope=slope)
+
+    @classmethod
+    def pruned(cls, xs: np.ndarray, ys: np.ndarray, slope: float) -> 'PiecewiseLinear':
+        # Without the breakpoints where the slope doesn't change, up to 1e-12 of the steepest slope, so
+        # sums and clips only keep real kinks. Dropping one moves f by less than 1e-12 of the steepest
+        # slope times the length of the segments around it.
+        slopes = np.append(np.diff(ys) / np.diff(xs), slope)
+        kinks = np.abs(np.diff(slopes)) > 1e-12 * np.abs(slopes).max()
+        keep = np.r_[True, kinks]
+        return cls(xs=xs[keep], ys=ys[keep], slope=slope)
+
+    def __call__(self, x: float | np.ndarray) -> np.ndarray:
+        x = np.asarray(x, dtype=float)
+        return np.where(
+            x <= self.xs[-1],
+            np.interp(x, self.xs, self.ys),
+            self.ys[-1] + self.slope * (x - self.xs[-1])
+        )
+
+    def __add__(self, other: 'PiecewiseLinear') -> 'PiecewiseLinear':
+        xs = np.union1d(self.xs, other.xs)
+        return PiecewiseLinear.pruned(xs, self(xs) + other(xs), self.slope + other.slope)
+
+    def root(self, value: float) -> float:
+        # Largest x with f(x) <= value, f is non-decreasing so f(x) > value exactly for x > root.
+        # inf if f never exceeds value.
+        above = np.flatnonzero(self.ys > value)
+        if len(above):
+            k = above[0] # ys[0] == 0 <= value so k >= 1
+            return float(self.xs[k - 1] + (value - self.ys[k - 1]) * (self.xs[k] - self.xs[k - 1]) / (self.ys[k] - self.ys[k - 1]))
+        if self.slope > 0:
+            return float(self.xs[-1] + (value - self.ys[-1]) / self.slope)
+        return float('inf')
+
+    def clipped(self, value: float) -> 'PiecewiseLinear':
+        # max(0, f(x) - value)
+        if value <= 0:
+            return self
+        root = self.root(value)
+        if root == float('inf'):
+            return PiecewiseLinear.linear(0.0)
+        after = self.xs > root
+        return PiecewiseLinear.pruned(
+            np.concatenate([[0.0, root], self.xs[after]]),
+            np.concatenate([[0.0, 0.0], self.ys[after] - value]),
+            self.slope
+        )
+
+@dataclass
+class ResponseQuery:
+    rainfall: float
+    runoff: np.ndarray                  # (N,) runoff leaving each node (after pond trapping), exact
+    volume_reaching_child: np.ndarray   # (N,) exact
+    connected: np.ndarray               # (N,) exact
+    trapped_runoff: np.ndarray          # (N,) exact
+    sediment: np.ndarray                # (N,) interpolated
+    sediment_reaching_child: np.ndarray # (N,) interpolated
+    trapped_sediment: np.ndarray        # (N,) interpolated
+
+@dataclass
+class ResponseCurves:
+    topology: Topology
+
+    # Runoff entering every node as a function of rainfall, packed as one array of breakpoints
+    # with node i's breakpoints at starts[i]:starts[i + 1] and the slope of the segment after each.
+    xs: np.ndarray
+    ys: np.ndarray
+    slopes: np.ndarray
+    starts: np.ndarray
+
+    connect_depth: np.ndarray   # (N,) rainfall above which the node reaches its child, inf if never/no child
+    fill_depth: np.ndarray      # (N,) rainfall above which a pond overflows, inf for anything that isn't a pond
+
+    # Tabulated sediment
+    grid: np.ndarray                    # (G,)
+    sediment: np.ndarray                # (G, N)
+    sediment_reaching_child: np.ndarray # (G, N)
+    trapped_sediment: np.ndarray        # (G, N)
+
+    def runoff_in(self, rainfall: float) -> np.ndarray:
+        # Every node's segment is found by counting its breakpoints at or below the rainfall
+        below = np.add.reduceat(self.xs <= rainfall, self.starts)
+        segment = self.starts + below - 1
+        return self.ys[segment] + self.slopes[segment] * (rainfall - self.xs[segment])
+
+    def __interpolate(self, table: np.ndarray, rainfall: float) -> np.ndarray:
+        # Linear in between grid points, and extrapolated from the last grid interval past the grid
+        k = int(np.clip(np.searchsorted(self.grid, rainfall) - 1, 0, len(self.grid) - 2))
+        weight = (rainfall - self.grid[k]) / (self.grid[k + 1] - self.grid[k])
+        return np.maximum(0, table[k] + weight * (table[k + 1] - table[k]))
+
+    def evaluate(self, rainfall: float) -> ResponseQuery:
+        if rainfall < 0:
+            raise ValueError("rainfall must be zero or a positive number")
+
+        topology = self.topology
+        runoff_in = self.runoff_in(rainfall)
+        available = topology.max_capacity - topology.used_capacity
+        runoff = np.where(topology.is_pond, np.maximum(0, runoff_in - available), runoff_in)
+        volume = np.where(topology.child >= 0, np.maximum(0, runoff - topology.cost_to_connect_child), 0)
+
+        return ResponseQuery(
+            rainfall=rainfall,
+            runoff=runoff,
+            volume_reaching_child=volume,
+            connected=volume > 0,
+            trapped_runoff=runoff_in - runoff,
+            sediment=self.__interpolate(self.sediment, rainfall),
+            sediment_reaching_child=self.__interpolate(self.sediment_reaching_child, rainfall),
+            trapped_sediment=self.__interpolate(self.trapped_sediment, rainfall),
+        )
+
+def build_runoff_functions(topology: Topology) -> List[PiecewiseLinear]:
+    # Runoff entering every node as a function of rainfall, in topology order
+    local = topology.local_area @ topology.runoff_coefficient / 1000 # Runoff per mm of rainfall
+    available = topology.max_capacity - topology.used_capacity
+
+    runoff_in = [PiecewiseLinear.linear(float(slope)) for slope in local]
+    for node in range(topology.n_nodes): # Topological order, parents come before their child
+        child = topology.child[node]
+        if child < 0:
+            continue
+        runoff = runoff_in[node].clipped(float(available[node])) if topology.is_pond[node] else runoff_in[node]
+        runoff_in[child] = runoff_in[child] + runoff.clipped(float(topology.cost_to_connect_child[node]))
+    return runoff_in
+
+def critical_depths(topology: Topology, functions: List[PiecewiseLinear]) -> tuple[np.ndarray, np.ndarray]:
+    # Rainfall above which every node reaches its child, and above which every pond overflows (inf if never)
+    available = topology.max_capacity - topology.used_capacity
+    connect_depth = np.full(topology.n_nodes, np.inf)
+    fill_depth = np.full(topology.n_nodes, np.inf)
+    for node, function in enumerate(functions):
+        if topology.is_pond[node]:
+            fill_depth[node] = function.root(float(available[node]))
+            runoff = function.clipped(float(available[node]))
+        else:
+            runoff = function
+        if topology.child[node] >= 0:
+            connect_depth[node] = runoff.root(float(topology.cost_to_connect_child[node]))
+    return connect_depth, fill_depth
+
+@dataclass
+class ConnectivityIndex:
+    # Edges (node -> child) sorted by the uniform rainfall depth above which they connect. The edges of
+    # a storm are a prefix of that order, found with one binary search.
+    topology: Topology
+    depth: np.ndarray   # (E,) ascending, inf for edges that never connect
+    edges: np.ndarray   # (E,) node of every edge
+
+    def n_connected(self, rainfall: float | np.ndarray) -> np.ndarray:
+        # Connected edges for every depth, i.e. the connectivity-vs-rainfall curve
+        return np.searchsorted(self.depth, rainfall, side='left')
+
+    def connected_edges(self, rainfall: float) -> np.ndarray:
+        return self.edges[:int(self.n_connected(rainfall))]
+
+    def connected(self, rainfall: float) -> np.ndarray:
+        # (N,) same as EventResults.connected for a uniform storm
+        mask = np.zeros(self.topology.n_nodes, dtype=bool)
+        mask[self.connected_edges(rainfall)] = True
+        return mask
+
+    def connected_area(self, rainfall: float | np.ndarray) -> np.ndarray:
+        # (R, N) road area connected to every node for every depth
+        masks = np.stack([self.connected(depth) for depth in np.atleast_1d(rainfall)])
+        return self.topology.forest.connected_upstream_sum(self.topology.local_area.sum(axis=1)[:, None], masks)[..., 0]
+
+    def curve(self) -> 'pd.DataFrame':
+        # Steps of the connectivity-vs-rainfall curve, above `rainfall` there are `connected_edges` edges
+        import pandas as pd
+        steps = np.unique(self.depth[np.isfinite(self.depth)])
+        connected = np.searchsorted(self.depth, steps, side='right')
+        return pd.DataFrame({
+            'rainfall': steps,
+            'connected_edges': connected,
+            'connected_fraction': connected / max(len(self.edges), 1),
+        })
+
+    def subgraph(self, rainfall: float) -> 'nx.DiGraph':
+        # The connected edges as a NetworkX graph keyed by point, without processing the graph
+        import networkx as nx
+        points, child = self.topology.points, self.topology.child
+        subgraph = nx.DiGraph()
+        subgraph.add_nodes_from(points)
+        subgraph.add_edges_from((points[node], points[child[node]]) for node in self.connected_edges(rainfall))
+        return subgraph
+
+    def to_frame(self) -> 'pd.DataFrame':
+        import pandas as pd
+        points, child = self.topology.points, self.topology.child
+        return pd.DataFrame({
+            'node': [points[node] for node in self.edges],
+            'child': [points[child[node]] for node in self.edges],
+            'critical_depth': self.depth,
+        })
+
+def build_connectivity_index(topology: Topology) -> ConnectivityIndex:
+    # Only holds for a rainfall depth shared by the whole watershed, spatially variable storms need the engine
+    connect_depth, _ = critical_depths(topology, build_runoff_functions(topology))
+    edges = np.flatnonzero(topology.child >= 0)
+    edges = edges[np.argsort(connect_depth[edges], kind='stable')]
+    return ConnectivityIndex(topology=topology, depth=connect_depth[edges], edges=edges)
+
+def build_response_curves(topology: Topology, max_depth: float = 500.0, resolution: float = 1.0, chunk_size: int = 256) -> ResponseCurves:
+    # max_depth/resolution only set the sediment table, runoff is exact for any depth
+    if max_depth <= 0 or resolution <= 0:
+        raise ValueError("max_depth and resolution must be positive numbers")
+
+    functions = build_runoff_functions(topology)
+    connect_depth, fill_depth = critical_depths(topology, functions)
+
+    # Sediment has kinks where runoff does, so the critical depths go into the grid as well. It jumps
+    # where a pond overflows (a full pond traps everything, one letting runoff out follows the efficiency
+    # curve), so the grid gets points just before and past every fill depth too, whichever side of the
+    # jump the engine puts the fill depth itself on.
+    critical = np.concatenate([connect_depth, fill_depth * (1 - 1e-9), fill_depth, fill_depth * (1 + 1e-9)])
+    grid = np.union1d(np.arange(0, max_depth + resolution, resolution), critical[critical <= max_depth])
+    tables = [np.zeros((len(grid), topology.n_nodes)) for _ in range(3)]
+    for first in range(0, len(grid), chunk_size):
+        results = run_events(topology, grid[first:first + chunk_size])
+        rows = slice(first, first + len(results.rainfall))
+        tables[0][rows] = results.sediment_sum
+        tables[1][rows] = results.sediment_reaching_child
+        tables[2][rows] = results.trapped_sediment
+
+    slopes = []
+    for function in functions:
+        slopes.append(np.append(np.diff(function.ys) / np.diff(function.xs), function.slope))
+
+    return ResponseCurves(
+        topology=topology,
+        xs=np.concatenate([function.xs for function in functions]),
+        ys=np.concatenate([function.ys for function in functions]),
+        slopes=np.concatenate(slopes),
+        starts=np.cumsum([0] + [len(function.xs) for function in functions[:-1]]),
+        connect_depth=connect_depth,
+        fill_depth=fill_depth,
+        grid=grid,
+        sediment=tables[0],
+        sediment_reaching_child=tables[1],
+        trapped_sediment=tables[2],
+    )
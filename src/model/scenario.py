@@ -0,0 +1,301 @@
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Dict, List
+import shapely.geometry
+import numpy as np
+
+from model.graph import NodeType
+from model.engine import EventAggregates, Topology, batch_size, run_events, trap_in_ponds, route_to_children
+
+if TYPE_CHECKING: # Any DataFrame with the roads' columns (e.g. a GeoDataFrame)
+    import pandas as pd
+
+# A scenario keeps one full run of a batch of rainfall events and the runoff/sediment every node
+# receives from its parents. Every node has at most one child, so placing, removing or resizing a
+# pond, or re-typing a road segment, only changes what that node sends downstream: the change is
+# pushed down the child pointers as a difference, re-evaluating one node at a time against its
+# cached upstream inflow. A what-if is O(path length x events x road types) instead of a full run.
+
+@dataclass
+class SegmentTable:
+    # The road segments behind topology.local_area/local_length, so segments can be re-typed
+    node: np.ndarray        # (S,) node the segment drains to, -1 if unroutable
+    road_type: np.ndarray   # (S,) index into topology.road_types
+    area: np.ndarray        # (S,)
+    length: np.ndarray      # (S,)
+
+    @classmethod
+    def from_roads(cls, roads: 'pd.DataFrame', topology: Topology) -> 'SegmentTable':
+        position = topology.index
+        type_index = {name: i for i, name in enumerate(topology.road_types)}
+        return cls(
+            node=roads['DRAIN_IDX'].map(lambda drain: position.get(drain, -1)).to_numpy(dtype=np.int64),
+            road_type=roads['TYPE'].map(type_index).to_numpy(dtype=np.int64),
+            area=roads['AREA'].to_numpy(dtype=float),
+            length=roads['LENGTH'].to_numpy(dtype=float),
+        )
+
+@dataclass
+class NodeResults:
+    # One node's results for every event
+    runoff: np.ndarray                  # (E, T) after pond trapping
+    sediment: np.ndarray                # (E, T) after pond trapping
+    volume_reaching_child: np.ndarray   # (E,)
+    sediment_reaching_child: np.ndarray # (E,)
+    connected: np.ndarray               # (E,)
+    trapped_runoff: np.ndarray          # (E,)
+    trapped_sediment: np.ndarray        # (E,)
+    percent: np.ndarray                 # (E,) share of runoff/sediment reaching the child
+
+@dataclass
+class NodeParameters:
+    node_type: int
+    max_capacity: float
+    used_capacity: float
+    local_area: np.ndarray      # (T,)
+    local_length: np.ndarray    # (T,)
+
+@dataclass
+class Change:
+    # A what-if that hasn't necessarily been applied: the new parameters of `node` and the new
+    # results of every node down its path, path[0] == node.
+    node: int
+    parameters: NodeParameters
+    segment: int | None                 # Re-typed road segment, if any
+    road_type: int | None
+    path: np.ndarray                    # (P,)
+    ancestor_runoff: np.ndarray         # (E, P, T)
+    ancestor_sediment: np.ndarray       # (E, P, T)
+    results: List[NodeResults]          # (P,)
+
+class Scenario:
+    def __init__(self, topology: Topology, rainfall: np.ndarray, segments: SegmentTable | None = None) -> None:
+        # Edited arrays are copied, the topology that was passed in is left alone
+        self.topology = replace(
+            topology,
+            node_type=topology.node_type.copy(),
+            local_area=topology.local_area.copy(),
+            local_length=topology.local_length.copy(),
+            max_capacity=topology.max_capacity.copy(),
+            used_capacity=topology.used_capacity.copy(),
+            levels=list(topology.levels),
+        )
+        self.rainfall = np.asarray(rainfall, dtype=float)
+        self.segments = None if segments is None else replace(segments, road_type=segments.road_type.copy())
+        self.recompute()
+
+    def recompute(self) -> None:
+        # Full run of the current scenario, the caches every incremental change starts from. The events go
+        # through the engine in batches of engine.batch_size, as in Model.run, each one written into its
+        # rows of the caches and added to the per-node totals.
+        topology = self.topology
+        n_events, n_nodes, n_types = self.n_events, topology.n_nodes, len(topology.road_types)
+        routed = np.flatnonzero(topology.child >= 0)
+        self.runoff, self.sediment = np.zeros((n_events, n_nodes, n_types)), np.zeros((n_events, n_nodes, n_types))
+        self.ancestor_runoff, self.ancestor_sediment = np.zeros_like(self.runoff), np.zeros_like(self.sediment)
+        for name in ('volume_reaching_child', 'sediment_reaching_child', 'trapped_runoff', 'trapped_sediment', 'percent'):
+            setattr(self, name, np.zeros((n_events, n_nodes)))
+        self.connected = np.zeros((n_events, n_nodes), dtype=bool)
+        self.aggregates = EventAggregates.empty(n_nodes)
+
+        size = batch_size(topology)
+        for first in range(0, n_events, size):
+            events = slice(first, first + size)
+            results = run_events(topology, self.rainfall[events])
+            self.aggregates.add(results)
+            runoff_sum = results.runoff_sum
+            percent = np.divide(results.volume_reaching_child, runoff_sum, out=np.zeros_like(runoff_sum), where=results.connected)
+            np.add.at(self.ancestor_runoff[events], (slice(None), topology.child[routed]), results.runoff[:, routed] * percent[:, routed, None])
+            np.add.at(self.ancestor_sediment[events], (slice(None), topology.child[routed]), results.sediment[:, routed] * percent[:, routed, None])
+            for name in ('runoff', 'sediment', 'volume_reaching_child', 'sediment_reaching_child', 'connected', 'trapped_runoff', 'trapped_sediment'):
+                getattr(self, name)[events] = getattr(results, name)
+            self.percent[events] = percent
+
+    @property
+    def n_events(self) -> int: return self.rainfall.shape[0]
+
+    def node(self, point: shapely.geometry.point.Point) -> int:
+        if (index := self.topology.index.get(point)) is None:
+            raise KeyError(f"{point} is not a node of the scenario")
+        return index
+
+    def parameters(self, node: int) -> NodeParameters:
+        topology = self.topology
+        return NodeParameters(
+            node_type=int(topology.node_type[node]),
+            max_capacity=float(topology.max_capacity[node]),
+            used_capacity=float(topology.used_capacity[node]),
+            local_area=topology.local_area[node].copy(),
+            local_length=topology.local_length[node].copy(),
+        )
+
+    def __evaluate(self, node: int, parameters: NodeParameters, ancestor_runoff: np.ndarray, ancestor_sediment: np.ndarray) -> NodeResults:
+        topology = self.topology
+        depth = (self.rainfall if self.rainfall.ndim == 1 else self.rainfall[:, node])[:, None] / 1000
+        runoff = ancestor_runoff + parameters.local_area * topology.runoff_coefficient * depth
+        sediment = ancestor_sediment + parameters.local_area * topology.erosion_rate * depth
+
+        n_events = self.n_events
+        trapped_runoff, trapped_sediment = np.zeros(n_events), np.zeros(n_events)
+        if parameters.node_type == NodeType.POND.value:
+            available = np.full(n_events, parameters.max_capacity - parameters.used_capacity)
+            runoff_scale, sediment_scale, trapped_runoff, trapped_sediment = trap_in_ponds(runoff, sediment, available)
+            runoff = runoff * runoff_scale[:, None]
+            sediment = sediment * sediment_scale[:, None]
+
+        if topology.child[node] >= 0:
+            volume, percent = route_to_children(runoff, np.full(n_events, topology.cost_to_connect_child[node]))
+        else:
+            volume, percent = np.zeros(n_events), np.zeros(n_events)
+
+        return NodeResults(
+            runoff=runoff,
+            sediment=sediment,
+            volume_reaching_child=volume,
+            sediment_reaching_child=sediment.sum(axis=-1) * percent,
+            connected=volume > 0,
+            trapped_runoff=trapped_runoff,
+            trapped_sediment=trapped_sediment,
+            percent=percent,
+        )
+
+    def __cached(self, node: int) -> NodeResults:
+        return NodeResults(
+            runoff=self.runoff[:, node],
+            sediment=self.sediment[:, node],
+            volume_reaching_child=self.volume_reaching_child[:, node],
+            sediment_reaching_child=self.sediment_reaching_child[:, node],
+            connected=self.connected[:, node],
+            trapped_runoff=self.trapped_runoff[:, node],
+            trapped_sediment=self.trapped_sediment[:, node],
+            percent=self.percent[:, node],
+        )
+
+    def propose(self, node: int, parameters: NodeParameters, segment: int | None = None, road_type: int | None = None) -> Change:
+        # New results of `node` with `parameters`, pushed down its path until nothing changes anymore
+        child = self.topology.child
+        path = [node]
+        ancestor_runoff = [self.ancestor_runoff[:, node]]
+        ancestor_sediment = [self.ancestor_sediment[:, node]]
+
+        old = self.__cached(node)
+        new = self.__evaluate(node, parameters, ancestor_runoff[0], ancestor_sediment[0])
+        results = [new]
+
+        current = node
+        while child[current] >= 0:
+            delta_runoff = new.runoff * new.percent[:, None] - old.runoff * old.percent[:, None]
+            delta_sediment = new.sediment * new.percent[:, None] - old.sediment * old.percent[:, None]
+            if not (delta_runoff.any() or delta_sediment.any()):
+                break
+
+            current = child[current]
+            path.append(current)
+            ancestor_runoff.append(self.ancestor_runoff[:, current] + delta_runoff)
+            ancestor_sediment.append(self.ancestor_sediment[:, current] + delta_sediment)
+
+            old = self.__cached(current)
+            new = self.__evaluate(current, self.parameters(current), ancestor_runoff[-1], ancestor_sediment[-1])
+            results.append(new)
+
+        return Change(
+            node=node,
+            parameters=parameters,
+            segment=segment,
+            road_type=road_type,
+            path=np.array(path, dtype=np.int64),
+            ancestor_runoff=np.stack(ancestor_runoff, axis=1),
+            ancestor_sediment=np.stack(ancestor_sediment, axis=1),
+            results=results,
+        )
+
+    def delta(self, change: Change, quantity: str) -> np.ndarray:
+        # (E,) change of a per-node quantity summed over the path, e.g. 'trapped_sediment'
+        old = getattr(self, quantity)[:, change.path]
+        new = np.stack([getattr(results, quantity) for results in change.results], axis=1)
+        if new.ndim == 3:
+            old, new = old.sum(axis=-1), new.sum(axis=-1)
+        return (new - old).sum(axis=1)
+
+    def apply(self, change: Change) -> None:
+        topology = self.topology
+        node, parameters = change.node, change.parameters
+
+        was_pond = topology.is_pond[node]
+        topology.node_type[node] = parameters.node_type
+        topology.max_capacity[node] = parameters.max_capacity
+        topology.used_capacity[node] = parameters.used_capacity
+        topology.local_area[node] = parameters.local_area
+        topology.local_length[node] = parameters.local_length
+        if change.segment is not None:
+            self.segments.road_type[change.segment] = change.road_type
+
+        if was_pond != topology.is_pond[node]:
+            # Only the node's level changes its pond list
+            level = topology.levels[topology.depth[node]]
+            topology.levels[topology.depth[node]] = replace(level, ponds=level.nodes[topology.is_pond[level.nodes]])
+
+        path = change.path
+        self.ancestor_runoff[:, path] = change.ancestor_runoff
+        self.ancestor_sediment[:, path] = change.ancestor_sediment
+        for name in ('runoff', 'sediment', 'volume_reaching_child', 'sediment_reaching_child', 'connected', 'trapped_runoff', 'trapped_sediment', 'percent'):
+            getattr(self, name)[:, path] = np.stack([getattr(results, name) for results in change.results], axis=1)
+        # Totals of the nodes on the path, from their new rows
+        aggregates = self.aggregates
+        aggregates.runoff[path] = self.runoff[:, path].sum(axis=(0, 2))
+        aggregates.sediment[path] = self.sediment[:, path].sum(axis=(0, 2))
+        aggregates.volume_reaching_child[path] = self.volume_reaching_child[:, path].sum(axis=0)
+        aggregates.sediment_reaching_child[path] = self.sediment_reaching_child[:, path].sum(axis=0)
+        aggregates.trapped_sediment[path] = self.trapped_sediment[:, path].sum(axis=0)
+        aggregates.events_connected[path] = self.connected[:, path].sum(axis=0)
+
+    def propose_pond(self, node: int, max_capacity: float, used_capacity: float = 0.0) -> Change:
+        # Inserts a pond at the node, or resizes the pond that is already there
+        if max_capacity <= 0 or not 0 <= used_capacity <= max_capacity:
+            raise ValueError("a pond needs a positive max_capacity and a used_capacity between 0 and max_capacity")
+        parameters = replace(self.parameters(node), node_type=NodeType.POND.value, max_capacity=float(max_capacity), used_capacity=float(used_capacity))
+        return self.propose(node, parameters)
+
+    def propose_pond_removal(self, node: int) -> Change:
+        if not self.topology.is_pond[node]:
+            raise ValueError(f"Node {node} is not a pond")
+        return self.propose(node, replace(self.parameters(node), node_type=NodeType.DRAIN.value, max_capacity=0.0, used_capacity=0.0))
+
+    def propose_road_type(self, segment: int, road_type: str) -> Change:
+        if self.segments is None:
+            raise ValueError("Re-typing roads needs the scenario's road segments")
+        if road_type not in self.topology.road_types:
+            raise ValueError(f"Unknown road type '{road_type}', expected one of {self.topology.road_types}")
+
+        node = int(self.segments.node[segment])
+        if node < 0:
+            raise ValueError(f"Road segment {segment} doesn't drain to any node")
+
+        old_type, new_type = self.segments.road_type[segment], self.topology.road_types.index(road_type)
+        parameters = self.parameters(node)
+        parameters.local_area[old_type] -= self.segments.area[segment]
+        parameters.local_area[new_type] += self.segments.area[segment]
+        parameters.local_length[old_type] -= self.segments.length[segment]
+        parameters.local_length[new_type] += self.segments.length[segment]
+        return self.propose(node, parameters, segment=segment, road_type=new_type)
+
+    def set_pond(self, node: int, max_capacity: float, used_capacity: float = 0.0) -> Change:
+        self.apply(change := self.propose_pond(node, max_capacity, used_capacity))
+        return change
+
+    def remove_pond(self, node: int) -> Change:
+        self.apply(change := self.propose_pond_removal(node))
+        return change
+
+    def set_road_type(self, segment: int, road_type: str) -> Change:
+        self.apply(change := self.propose_road_type(segment, road_type))
+        return change
+
+    def summary(self) -> Dict[str, np.ndarray]:
+        # (E,) totals per event over the watershed
+        terminal = self.topology.child < 0
+        return {
+            'runoff_out': self.runoff[:, terminal].sum(axis=(1, 2)),
+            'sediment_out': self.sediment[:, terminal].sum(axis=(1, 2)),
+            'trapped_sediment': self.trapped_sediment.sum(axis=1),
+            'connected_edges': self.connected.sum(axis=1),
+        }
@@ -0,0 +1,176 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, List
+import numpy as np
+
+from model.engine import Topology
+from model.ensemble import ParameterSamples, EnsembleResults, run_ensemble
+from model.checkpoint import save_atomically
+
+if TYPE_CHECKING: # model.data reads the input files on import, pandas is only needed for export
+    import pandas as pd
+    from model.data.rainfall import RainfallSource
+
+# Global sensitivity analysis runs the model at many parameter points. Every point is a sample of the
+# ensemble machinery, so a whole design goes through the batched engine at once. Outputs are cached
+# per parameter point (in memory, and on disk when a cache directory is set), a point that was run
+# before, in this design or in an earlier analysis of the same inputs, is never run again.
+
+# Watershed outputs, per-event means over the rainfall series
+OUTPUTS = ['sediment_out', 'runoff_out', 'trapped_sediment', 'connected_edges']
+
+def watershed_outputs(topology: Topology, results: EnsembleResults) -> np.ndarray:
+    # (S, len(OUTPUTS))
+    terminal = topology.child < 0
+    return np.stack([
+        results.sediment[:, terminal].sum(axis=1),
+        results.runoff[:, terminal].sum(axis=1),
+        results.trapped_sediment.sum(axis=1),
+        results.events_connected.sum(axis=1),
+    ], axis=1) / max(results.n_events, 1)
+
+class ResultCache:
+    def __init__(self, path: Path | None, fingerprint: str, n_parameters: int) -> None:
+        self.path = path
+        self.fingerprint = fingerprint
+        self.results: Dict[bytes, np.ndarray] = {}
+
+        if path is not None and path.is_file():
+            with np.load(path) as saved:
+                # Outputs of different inputs (or a different set of parameters) are just not reused
+                if str(saved['fingerprint']) == fingerprint and saved['points'].shape[1] == n_parameters:
+                    self.store(saved['points'], saved['outputs'])
+
+    @staticmethod
+    def __key(point: np.ndarray) -> bytes: return np.ascontiguousarray(point, dtype=float).tobytes()
+
+    def lookup(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Cached outputs (NaN where missing) and which points were found
+        found = np.array([self.__key(point) in self.results for point in points], dtype=bool)
+        outputs = np.full((len(points), len(OUTPUTS)), np.nan)
+        for i in np.flatnonzero(found):
+            outputs[i] = self.results[self.__key(points[i])]
+        return outputs, found
+
+    def store(self, points: np.ndarray, outputs: np.ndarray) -> None:
+        for point, output in zip(points, outputs):
+            self.results[self.__key(point)] = output
+
+    def save(self) -> None:
+        if self.path is None or not self.results:
+            return
+        save_atomically(self.path, {
+            'fingerprint': np.array(self.fingerprint),
+            'points': np.stack([np.frombuffer(key) for key in self.results]),
+            'outputs': np.stack(list(self.results.values())),
+        })
+
+class Evaluator:
+    # Watershed outputs at parameter points (M, D), every row sets the parameters in `names`
+    def __init__(self, topology: Topology, rainfall: 'RainfallSource', travel_cost: float, names: List[str], cache: ResultCache, workers: int | None = None) -> None:
+        self.topology = topology
+        self.rainfall = rainfall
+        self.travel_cost = travel_cost
+        self.names = names
+        self.cache = cache
+        self.workers = workers
+        self.n_runs = 0 # Parameter points actually run (not cached)
+
+    def __call__(self, points: np.ndarray) -> np.ndarray:
+        unique, inverse = np.unique(points, axis=0, return_inverse=True)
+        outputs, found = self.cache.lookup(unique)
+
+        missing = unique[~found]
+        if len(missing):
+            samples = ParameterSamples.constant(self.topology, self.travel_cost, len(missing))
+            for d, name in enumerate(self.names):
+                samples.set(name, self.topology.road_types, missing[:, d])
+
+            results = EnsembleResults.empty(samples, self.topology.n_nodes)
+            for chunk in self.rainfall.chunks(points=self.topology.points):
+                run_ensemble(self.topology, chunk.depth, results, workers=self.workers)
+
+            outputs[~found] = watershed_outputs(self.topology, results)
+            self.cache.store(missing, outputs[~found])
+            self.cache.save()
+            self.n_runs += len(missing)
+
+        return outputs[inverse.reshape(-1)]
+
+@dataclass
+class SensitivityIndices:
+    method: str
+    parameters: List[str]
+    indices: Dict[str, np.ndarray]  # Index name -> (D, len(OUTPUTS))
+    n_points: int                   # Parameter points in the design
+
+    def to_frame(self) -> 'pd.DataFrame':
+        # One row per output and parameter, one column per index
+        import pandas as pd
+        rows = pd.MultiIndex.from_product([OUTPUTS, self.parameters], names=['output', 'parameter'])
+        return pd.DataFrame({name: values.T.reshape(-1) for name, values in self.indices.items()}, index=rows)
+
+def _scaled(unit: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    return bounds[:, 0] + unit * (bounds[:, 1] - bounds[:, 0])
+
+def _ratio(numerator: np.ndarray, variance: np.ndarray) -> np.ndarray:
+    # Outputs that don't vary at all get indices of 0
+    return np.divide(numerator, variance, out=np.zeros(np.broadcast_shapes(numerator.shape, variance.shape)), where=variance > 0)
+
+def sobol(evaluate: Callable[[np.ndarray], np.ndarray], names: List[str], bounds: np.ndarray, n: int, rng: np.random.Generator) -> SensitivityIndices:
+    # First-order (Saltelli) and total (Jansen) indices from n * (D + 2) points
+    d = len(names)
+    a, b = rng.random((n, d)), rng.random((n, d))
+    ab = np.repeat(a[None], d, axis=0)
+    ab[np.arange(d), :, np.arange(d)] = b.T # ab[i] is a with column i from b
+
+    y = evaluate(_scaled(np.concatenate([a, b, ab.reshape(-1, d)]), bounds))
+    y_a, y_b, y_ab = y[:n], y[n:2 * n], y[2 * n:].reshape(d, n, -1)
+    variance = np.var(np.concatenate([y_a, y_b]), axis=0)
+
+    return SensitivityIndices(
+        method='sobol',
+        parameters=names,
+        indices={
+            'S1': _ratio(np.mean(y_b * (y_ab - y_a), axis=1), variance),
+            'ST': _ratio(0.5 * np.mean((y_a - y_ab) ** 2, axis=1), variance),
+        },
+        n_points=len(y),
+    )
+
+def morris(evaluate: Callable[[np.ndarray], np.ndarray], names: List[str], bounds: np.ndarray, trajectories: int, levels: int, rng: np.random.Generator) -> SensitivityIndices:
+    # Elementary effects from trajectories * (D + 1) points on a `levels` grid, in units of each parameter's range
+    d = len(names)
+    delta = levels / (2 * (levels - 1))
+    grid = np.arange(levels) / (levels - 1)
+
+    sign = rng.choice([-1.0, 1.0], size=(trajectories, d))
+    start = np.where(
+        sign > 0,
+        rng.choice(grid[grid <= 1 - delta + 1e-12], size=(trajectories, d)),
+        rng.choice(grid[grid >= delta - 1e-12], size=(trajectories, d))
+    )
+    order = np.argsort(rng.random((trajectories, d)), axis=1) # Order the parameters are moved in
+
+    unit = np.repeat(start[:, None], d + 1, axis=1)
+    for step in range(d):
+        moved = order[:, step]
+        unit[np.arange(trajectories), step + 1:, moved] += (sign[np.arange(trajectories), moved] * delta)[:, None]
+
+    y = evaluate(_scaled(unit.reshape(-1, d), bounds)).reshape(trajectories, d + 1, -1)
+
+    effects = np.zeros((trajectories, d, y.shape[-1]))
+    for step in range(d):
+        moved = order[:, step]
+        effects[np.arange(trajectories), moved] = (y[:, step + 1] - y[:, step]) / (sign[np.arange(trajectories), moved] * delta)[:, None]
+
+    return SensitivityIndices(
+        method='morris',
+        parameters=names,
+        indices={
+            'mu': effects.mean(axis=0),
+            'mu_star': np.abs(effects).mean(axis=0),
+            'sigma': effects.std(axis=0, ddof=1) if trajectories > 1 else np.zeros((d, y.shape[-1])),
+        },
+        n_points=trajectories * (d + 1),
+    )
@@ -0,0 +1,4 @@
+# Stages turning raw layers (road centrelines, DEM tiles, LiDAR, imagery) into the files the model
+# reads, run with `roadconnect preprocess <stage>`. Every stage works on whole layers with array
+# operations, so a stage is a function from input arrays/frames to output arrays/frames plus a
+# command in preprocess.main that reads and writes the files.
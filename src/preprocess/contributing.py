@@ -0,0 +1,101 @@
+from typing import Tuple
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from utils import profiling
+from preprocess.drains import adjacency
+
+# The road segments draining to every drain, and their dissolved area. Runoff on a segment runs to the
+# lowest segment it touches, if that is lower (as model.data.roads routes segments to drains), which
+# makes one directed edge per segment. Drain segments keep their runoff. The edges are reversed once
+# into a CSR of upstream segments, and all drains are walked up it at the same time, one vectorized
+# step per segment of the longest path, so every segment is visited once and gets the drain it ends up
+# at. Segments ending at a local minimum without a drain, or on a flat, get none.
+
+def receivers(indptr: np.ndarray, indices: np.ndarray, elevation: np.ndarray) -> np.ndarray:
+    # Lowest neighbour of every node where it is strictly lower (the first one on ties), else -1
+    result = np.full(len(elevation), -1)
+    if len(indices) == 0:
+        return result
+    node = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    order = np.lexsort((indices, elevation[indices], node))
+    first = order[np.r_[True, node[order][1:] != node[order][:-1]]]
+    lower = elevation[indices[first]] < elevation[node[first]]
+    result[node[first][lower]] = indices[first][lower]
+    return result
+
+def _gather(indptr: np.ndarray, indices: np.ndarray, nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Neighbours of `nodes` and which of them (position in `nodes`) every one belongs to
+    counts = indptr[nodes + 1] - indptr[nodes]
+    owner = np.repeat(np.arange(len(nodes)), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(indptr[nodes], counts)
+    return indices[position], owner
+
+def drain_labels(receiver: np.ndarray, sources: np.ndarray) -> np.ndarray:
+    # Position in `sources` of the source every node drains to, -1 for none. Sources are sinks.
+    receiver = receiver.copy()
+    receiver[sources] = -1
+    flowing = np.flatnonzero(receiver >= 0)
+    order = flowing[np.argsort(receiver[flowing], kind='stable')]
+    upstream_ptr = np.zeros(len(receiver) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(receiver[flowing], minlength=len(receiver)), out=upstream_ptr[1:])
+
+    label = np.full(len(receiver), -1)
+    label[sources] = np.arange(len(sources))
+    frontier = sources
+    while len(frontier):
+        upstream, owner = _gather(upstream_ptr, order, frontier)
+        label[upstream] = label[frontier[owner]]
+        frontier = upstream
+    return label
+
+def contributing_segments(
+    roads: gpd.GeoDataFrame,
+    drains: gpd.GeoSeries,
+    elevation_column: str = 'ELEVATION',
+    tolerance: float = 1e-6,
+) -> np.ndarray:
+    # Row of the drain every road segment drains to, -1 for none. A drain is on the segment within
+    # `tolerance` of it, and the first of several drains on a segment gets it.
+    if elevation_column not in roads.columns:
+        raise ValueError(f"Road segments have no '{elevation_column}' attribute, see the elevation stage")
+    geometries = roads.geometry.to_numpy()
+    elevation = roads[elevation_column].to_numpy(dtype=float)
+
+    with profiling.stage('segment adjacency'):
+        indptr, indices = adjacency(geometries)
+        receiver = receivers(indptr, indices, elevation)
+    drain, segment = shapely.STRtree(geometries).query_nearest(drains.to_crs(roads.crs).to_numpy(), max_distance=tolerance, all_matches=False)
+    if len(drain) < len(drains):
+        missing = np.setdiff1d(np.arange(len(drains)), drain)
+        raise ValueError(f"{len(missing)} drains are not on a road segment, e.g. indices {missing[:10].tolist()}")
+    segment, first = np.unique(segment, return_index=True)
+
+    with profiling.stage('drain traversal'):
+        label = drain_labels(receiver, segment)
+    return np.where(label >= 0, drain[first][label], -1)
+
+def contributing_areas(roads: gpd.GeoDataFrame, drain: np.ndarray, buffer: float | None = None) -> gpd.GeoDataFrame:
+    # One dissolved polygon per drain with segments (road lines buffered by half their WIDTH, or `buffer`)
+    # with its DRAIN row, number of SEGMENTS, and their total LENGTH and AREA (the attributes, or of the
+    # geometries)
+    geometries = roads.geometry.to_numpy()
+    lines = np.isin(shapely.get_type_id(geometries), [1, 5])
+    if lines.any():
+        if buffer is None and 'WIDTH' not in roads.columns:
+            raise ValueError("Road lines need a WIDTH attribute or a buffer distance")
+        distance = np.full(len(roads), buffer) if buffer is not None else roads['WIDTH'].to_numpy(dtype=float) / 2
+        geometries = np.where(lines, shapely.buffer(geometries, distance, cap_style='flat'), geometries)
+    length = roads['LENGTH'].to_numpy(dtype=float) if 'LENGTH' in roads.columns else shapely.length(roads.geometry.to_numpy())
+    area = roads['AREA'].to_numpy(dtype=float) if 'AREA' in roads.columns else shapely.area(geometries)
+
+    drained = np.flatnonzero(drain >= 0)
+    segments = gpd.GeoDataFrame({
+        'DRAIN': drain[drained],
+        'SEGMENTS': 1,
+        'LENGTH': length[drained],
+        'AREA': area[drained],
+    }, geometry=geometries[drained], crs=roads.crs)
+    with profiling.stage('dissolve areas'):
+        return segments.dissolve(by='DRAIN', aggfunc='sum').reset_index()
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from pathlib import Path
+from typing import List
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+import rasterio.shutil
+import rasterio.windows
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, transform_bounds
+
+from utils import profiling
+from preprocess.mask import raster_tiles
+
+# A DEM for an extent from a collection of tiles: the tiles intersecting the extent are fetched into a
+# local store (several at a time, streamed to disk), then warped window by window onto the output grid
+# on worker threads, clipped to the extent and written as a tiled, compressed Cloud Optimized GeoTIFF
+# with overviews. The result is cached in the store by its tiles, extent, CRS and resolution, so asking
+# for the same DEM again is free. Where tiles overlap the later one in the source's order wins, as in
+# a VRT.
+
+NODATA = -9999.0
+BLOCK_SIZE = 512
+
+@dataclass
+class Tile:
+    name: str
+    location: str               # URL or path
+    footprint: shapely.Geometry # In the source's CRS
+
+class TileSource(ABC):
+    crs: CRS
+
+    @abstractmethod
+    def tiles(self, extent: shapely.Geometry, crs: CRS) -> List[Tile]:
+        # Tiles intersecting `extent` (in `crs`), in mosaic order
+        ...
+
+class DirectoryTiles(TileSource):
+    # GeoTIFFs in a local directory, e.g. a mirror of the web service
+    def __init__(self, directory: Path) -> None:
+        paths = sorted(path for path in directory.rglob('*') if path.suffix.lower() in ('.tif', '.tiff'))
+        if not paths:
+            raise ValueError(f"No GeoTIFF tiles in {directory}")
+        footprints, crs = [], None
+        for path in paths:
+            with rasterio.open(path) as src:
+                crs = crs or src.crs
+                footprints.append(shapely.box(*transform_bounds(src.crs, crs, *src.bounds)))
+        self.crs = crs
+        self.index = [Tile(path.name, str(path), footprint) for path, footprint in zip(paths, footprints)]
+
+    def tiles(self, extent: shapely.Geometry, crs: CRS) -> List[Tile]:
+        extent = _to_crs(extent, crs, self.crs)
+        return [tile for tile in self.index if tile.footprint.intersects(extent)]
+
+class IndexedTiles(TileSource):
+    # A tile index (any vector file or URL geopandas reads) with the URL or path of every tile in a column.
+    # Relative paths are relative to the index.
+    def __init__(self, index: str, url_column: str = 'url') -> None:
+        table = gpd.read_file(index)
+        if url_column not in table.columns:
+            raise ValueError(f"Tile index {index} has no '{url_column}' column")
+        self.crs = table.crs
+        self.index = [
+            Tile(Path(urllib.parse.urlparse(location).path).name, self.__resolve(index, location), footprint)
+            for location, footprint in zip(table[url_column], table.geometry)
+        ]
+        self.tree = shapely.STRtree([tile.footprint for tile in self.index])
+
+    @staticmethod
+    def __resolve(index: str, location: str) -> str:
+        if '://' in location or os.path.isabs(location):
+            return location
+        return urllib.parse.urljoin(index, location) if '://' in index else str(Path(index).resolve().parent / location)
+
+    def tiles(self, extent: shapely.Geometry, crs: CRS) -> List[Tile]:
+        hits = self.tree.query(_to_crs(extent, crs, self.crs), predicate='intersects')
+        # Duplicate rows of the same tile (the notebook's drop_duplicates on the URL column)
+        return list({self.index[i].location: self.index[i] for i in np.sort(hits)}.values())
+
+def open_source(location: str, url_column: str = 'url') -> TileSource:
+    return DirectoryTiles(Path(location)) if os.path.isdir(location) else IndexedTiles(location, url_column)
+
+def _to_crs(geometry: shapely.Geometry, crs: CRS, to: CRS) -> shapely.Geometry:
+    return geometry if crs == to else gpd.GeoSeries([geometry], crs=crs).to_crs(to).iloc[0]
+
+def fetch(tile: Tile, store: Path, retries: int = 3, chunk_size: int = 2 ** 20) -> Path:
+    # Local path of a tile's raster: local tiles are used in place, remote ones streamed into the store
+    # (via a .part file, so an interrupted download is never taken for a cached tile). Zipped tiles are
+    # extracted into the store. Store paths start with a hash of the location, as tiles under different
+    # paths can share a file name.
+    key = hashlib.sha256(tile.location.encode()).hexdigest()[:16]
+    if '://' not in tile.location or tile.location.startswith('file://'):
+        path = Path(urllib.parse.urlparse(tile.location).path if tile.location.startswith('file://') else tile.location)
+    else:
+        path = store / f"{key}-{tile.name}"
+        if not path.is_file():
+            partial = path.with_name(path.name + '.part')
+            for attempt in range(retries):
+                try:
+                    with urllib.request.urlopen(tile.location, timeout=60) as response, open(partial, 'wb') as file:
+                        shutil.copyfileobj(response, file, chunk_size)
+                    break
+                except OSError:
+                    if attempt == retries - 1:
+                        raise
+                    time.sleep(2 ** attempt)
+            os.replace(partial, path)
+
+    if path.suffix.lower() != '.zip':
+        return path
+    extracted = store / f"{key}-{Path(tile.name).stem}"
+    with zipfile.ZipFile(path) as archive:
+        rasters = [name for name in archive.namelist() if name.lower().endswith(('.tif', '.tiff'))]
+        if not rasters:
+            raise ValueError(f"No GeoTIFF in tile archive {path}")
+        if not (extracted / rasters[0]).is_file():
+            archive.extractall(extracted)
+    return extracted / rasters[0]
+
+def fetch_all(tiles: List[Tile], store: Path, workers: int = 8) -> List[Path]:
+    store.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda tile: fetch(tile, store), tiles))
+
+def mosaic(
+    paths: List[Path],
+    extent: shapely.Geometry,
+    crs: CRS,
+    resolution: float,
+    output: Path,
+    resampling: Resampling = Resampling.nearest,
+    workers: int = 8,
+    window_size: int = 4 * BLOCK_SIZE,
+) -> None:
+    # Warps `paths` onto a grid of `resolution` covering `extent` (in `crs`), NODATA outside the extent.
+    # Windows are warped on worker threads, at most 2 * workers at a time, and written in order.
+    left, bottom, right, top = extent.bounds
+    left, bottom = np.floor(left / resolution) * resolution, np.floor(bottom / resolution) * resolution
+    right, top = np.ceil(right / resolution) * resolution, np.ceil(top / resolution) * resolution
+    width, height = max(1, round((right - left) / resolution)), max(1, round((top - bottom) / resolution))
+    transform = from_origin(left, top, resolution, resolution)
+
+    footprints = []
+    for path in paths:
+        with rasterio.open(path) as src:
+            footprints.append(shapely.box(*transform_bounds(src.crs, crs, *src.bounds)))
+    tree = shapely.STRtree(footprints)
+    shapely.prepare(extent)
+
+    def warp(window: rasterio.windows.Window) -> np.ndarray:
+        window_transform = rasterio.windows.transform(window, transform)
+        box = shapely.box(*rasterio.windows.bounds(window, transform))
+        array = np.full((window.height, window.width), NODATA, dtype='float32')
+        if not extent.intersects(box):
+            return array
+        for i in np.sort(tree.query(box, predicate='intersects')):
+            with rasterio.open(paths[i]) as src:
+                reproject(
+                    source=rasterio.band(src, 1),
+                    destination=array,
+                    src_nodata=src.nodata,
+                    dst_transform=window_transform,
+                    dst_crs=crs,
+                    dst_nodata=NODATA,
+                    init_dest_nodata=False, # Keeps what earlier tiles wrote where this one has no data
+                    resampling=resampling,
+                )
+        if not extent.contains(box):
+            array[rasterio.features.geometry_mask([extent], array.shape, window_transform)] = NODATA
+        return array
+
+    profile = {
+        'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'dtype': 'float32', 'crs': crs,
+        'transform': transform, 'nodata': NODATA, 'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE,
+        'compress': 'deflate', 'predictor': 3, 'BIGTIFF': 'IF_SAFER',
+    }
+    windows = raster_tiles(width, height, window_size)
+    with rasterio.open(output, 'w', **profile) as dst, ThreadPoolExecutor(max_workers=workers) as executor:
+        while batch := list(islice(windows, 2 * workers)):
+            for window, array in zip(batch, executor.map(warp, batch)):
+                dst.write(array, 1, window=window)
+
+def prepare_dem(
+    source: TileSource,
+    extent: shapely.Geometry,
+    crs: CRS,
+    resolution: float,
+    store: Path,
+    resampling: Resampling = Resampling.nearest,
+    workers: int = 8,
+) -> Path:
+    # Path of the COG of `extent` in the store, built unless it's already there
+    with profiling.stage('find tiles'):
+        tiles = source.tiles(extent, crs)
+    if not tiles:
+        raise ValueError("No DEM tiles intersect the extent")
+
+    key = hashlib.sha256(json.dumps([
+        [tile.location for tile in tiles], shapely.to_wkb(extent, hex=True), crs.to_wkt(), resolution, resampling.name
+    ]).encode()).hexdigest()[:16]
+    output = store / f"dem_{key}.tif"
+    if output.is_file():
+        return output
+
+    with profiling.stage('fetch tiles'):
+        paths = fetch_all(tiles, store / 'tiles', workers)
+    mosaicked = store / f"dem_{key}.mosaic.tif"
+    with profiling.stage('warp tiles'):
+        mosaic(paths, extent, crs, resolution, mosaicked, resampling, workers)
+    with profiling.stage('write cog'):
+        partial = store / f"dem_{key}.part.tif"
+        rasterio.shutil.copy(
+            mosaicked, partial, driver='COG', COMPRESS='DEFLATE', PREDICTOR='YES', BLOCKSIZE=str(BLOCK_SIZE),
+            BIGTIFF='IF_SAFER', NUM_THREADS=str(workers), OVERVIEW_RESAMPLING='AVERAGE',
+        )
+        os.replace(partial, output)
+        mosaicked.unlink()
+    return output
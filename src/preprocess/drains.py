@@ -0,0 +1,55 @@
+from typing import Tuple
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from utils import profiling
+
+# Natural drains: the road segments lower than every segment they touch, where runoff running along the
+# road collects. Which segments touch is found once with a bulk STRtree query and kept as a CSR
+# adjacency (neighbours of segment i are indices[indptr[i]:indptr[i + 1]]), so the lowest neighbour of
+# every segment is a single reduction over it. A flat run of equally low segments has no drain, as
+# nothing in it is strictly lower than its neighbours.
+
+def adjacency(geometries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # CSR (indptr, indices) of the geometries touching every geometry, neighbours in index order
+    i, j = shapely.STRtree(geometries).query(geometries, predicate='touches')
+    order = np.lexsort((j, i))
+    i, j = i[order], j[order]
+    indptr = np.zeros(len(geometries) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(i, minlength=len(geometries)), out=indptr[1:])
+    return indptr, j
+
+def local_minima(indptr: np.ndarray, indices: np.ndarray, elevation: np.ndarray) -> np.ndarray:
+    # Whether every node is strictly lower than all of its neighbours (and has any)
+    degree = np.diff(indptr)
+    connected = np.flatnonzero(degree > 0)
+    lowest = np.full(len(elevation), np.inf)
+    lowest[connected] = np.minimum.reduceat(elevation[indices], indptr[connected])
+    return (degree > 0) & (elevation < lowest)
+
+def natural_drains(roads: gpd.GeoDataFrame, elevation_column: str = 'ELEVATION') -> gpd.GeoDataFrame:
+    # A drain at the middle of every local minimum segment of `roads` (a drains layer), with the row of
+    # its SEGMENT and its ELEVATION
+    if elevation_column not in roads.columns:
+        raise ValueError(f"Road segments have no '{elevation_column}' attribute, see the elevation stage")
+    geometries = roads.geometry.to_numpy()
+    elevation = roads[elevation_column].to_numpy(dtype=float)
+    if np.isnan(elevation).any():
+        raise ValueError(f"{np.isnan(elevation).sum()} road segments have no elevation")
+
+    with profiling.stage('segment adjacency'):
+        indptr, indices = adjacency(geometries)
+    with profiling.stage('local minima'):
+        segment = np.flatnonzero(local_minima(indptr, indices, elevation))
+
+    lines = np.isin(shapely.get_type_id(geometries[segment]), [1, 5])
+    points = np.where(
+        lines,
+        shapely.line_interpolate_point(np.where(lines, geometries[segment], None), 0.5, normalized=True),
+        shapely.point_on_surface(np.where(lines, None, geometries[segment])),
+    )
+    return gpd.GeoDataFrame({
+        'SEGMENT': segment,
+        'ELEVATION': elevation[segment],
+    }, geometry=points, crs=roads.crs)
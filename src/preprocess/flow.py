@@ -0,0 +1,192 @@
+import heapq
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+from affine import Affine
+
+from utils import profiling
+
+# Flowpaths from drains (and ponds) down the DEM to the next road, the flowpaths layer model.data.flowpaths
+# reads. The DEM's depressions are filled first (priority flood with a small gradient over flats, Barnes et
+# al. 2014, so every cell drains to the edge of the DEM), then every cell's receiver is computed for the
+# whole raster at once: the steepest of its 8 neighbours (D8), or the neighbour getting most of the flow
+# along the steepest facet (D-infinity). Every start point is then walked down the receivers at the same time, one
+# vectorized step per cell of the longest path, until it reaches a road cell after having left its own road.
+#
+# Cells are flat indices into the raster padded by one cell, so the 8 neighbours of every cell are fixed
+# offsets and the padding (like nodata) is never a receiver.
+
+# Neighbours as (row, column) offsets: E, NE, N, NW, W, SW, S, SE
+NEIGHBOURS = np.array([(0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1)])
+# D-infinity facets as (cardinal, diagonal) neighbours, Tarboton (1997)
+FACETS = [(0, 1), (2, 1), (2, 3), (4, 3), (4, 5), (6, 5), (6, 7), (0, 7)]
+
+def _padded(array: np.ndarray, value: float) -> np.ndarray:
+    return np.pad(array.astype(float), 1, constant_values=value)
+
+def _offsets(width: int) -> np.ndarray:
+    return NEIGHBOURS[:, 0] * (width + 2) + NEIGHBOURS[:, 1]
+
+def fill_depressions(elevation: np.ndarray, valid: np.ndarray, epsilon: float = 1e-5) -> np.ndarray:
+    # Depression-filled elevation (padded, -inf outside the valid cells). A cell next to the edge or to
+    # nodata is an outlet. Every other cell ends up at least epsilon above its lowest neighbour, so there
+    # are no pits or flats left. Cells are flooded from the outlets up, lowest first: every cell popped off
+    # the heap raises its unvisited neighbours to at least epsilon above itself. O(N log N), one visit per
+    # cell however wide the depressions are. The loop indexes memoryviews, which is several times faster
+    # than indexing the arrays from Python.
+    z = _padded(np.where(valid, elevation, -np.inf), -np.inf).reshape(-1)
+    inside = _padded(valid, 0).astype(bool)
+    height, width = elevation.shape
+    surrounded = np.all([inside[1 + r:height + 1 + r, 1 + c:width + 1 + c] for r, c in NEIGHBOURS], axis=0)
+    outlet = np.zeros(inside.shape, dtype=bool)
+    outlet[1:-1, 1:-1] = valid & ~surrounded
+    inside, outlet = inside.reshape(-1), outlet.reshape(-1)
+    offsets = _offsets(width).tolist()
+
+    filled = z.copy()
+    unvisited = inside & ~outlet
+    water, pending = memoryview(filled), memoryview(unvisited)
+    cells = np.flatnonzero(outlet)
+    queue = list(zip(z[cells].tolist(), cells.tolist()))
+    heapq.heapify(queue)
+    pop, push = heapq.heappop, heapq.heappush
+    while queue:
+        level, cell = pop(queue)
+        level += epsilon
+        for offset in offsets:
+            neighbour = cell + offset
+            if pending[neighbour]: # Never the padding, which isn't inside
+                pending[neighbour] = False
+                if water[neighbour] < level:
+                    water[neighbour] = level
+                push(queue, (water[neighbour], neighbour))
+    return filled.reshape(height + 2, width + 2)
+
+def receivers(filled: np.ndarray, transform: Affine, method: str = 'd8', block_rows: int = 1024) -> np.ndarray:
+    # Flat (padded) index of every cell's receiver, -1 where there is none (outlets, nodata, padding).
+    # Computed in blocks of rows to bound the memory of the (8, rows, columns) slopes.
+    height, width = filled.shape[0] - 2, filled.shape[1] - 2
+    dx, dy = abs(transform.a), abs(transform.e)
+    distance = np.hypot(NEIGHBOURS[:, 1] * dx, NEIGHBOURS[:, 0] * dy)
+    offsets = _offsets(width)
+    result = np.full(filled.size, -1, dtype=np.int64)
+    neighbour_z = np.where(np.isfinite(filled), filled, np.inf) # Never flow into nodata or the padding
+
+    for first in range(0, height, block_rows):
+        rows = slice(first + 1, min(first + block_rows, height) + 1)
+        centre = filled[rows, 1:-1]
+        shifted = np.stack([neighbour_z[rows.start + r:rows.stop + r, 1 + c:width + 1 + c] for r, c in NEIGHBOURS])
+
+        if method == 'd8':
+            slope = (centre - shifted) / distance[:, None, None]
+            best = np.argmax(slope, axis=0)
+            steepest = np.take_along_axis(slope, best[None], axis=0)[0]
+        elif method == 'dinf':
+            best, steepest = _dinf(centre, shifted, dx, dy)
+        else:
+            raise ValueError(f"Unknown flow routing method '{method}', expected 'd8' or 'dinf'")
+
+        index = (np.arange(rows.start, rows.stop)[:, None] * (width + 2) + np.arange(1, width + 1)).reshape(-1)
+        downhill = (np.isfinite(centre) & (steepest > 0)).reshape(-1)
+        result[index[downhill]] = index[downhill] + offsets[best.reshape(-1)[downhill]]
+    return result
+
+def _dinf(centre: np.ndarray, shifted: np.ndarray, dx: float, dy: float) -> tuple[np.ndarray, np.ndarray]:
+    # The steepest facet's neighbour receiving the larger share of the flow, and the facet's slope
+    best = np.zeros(centre.shape, dtype=np.int64)
+    steepest = np.full(centre.shape, -np.inf)
+    with np.errstate(invalid='ignore'):
+        for cardinal, diagonal in FACETS:
+            # d1 along the cardinal direction, d2 from the cardinal to the diagonal neighbour
+            d1, d2 = (dx, dy) if NEIGHBOURS[cardinal][0] == 0 else (dy, dx)
+            s1 = (centre - shifted[cardinal]) / d1
+            s2 = (shifted[cardinal] - shifted[diagonal]) / d2
+            angle, limit = np.arctan2(s2, s1), np.arctan2(d2, d1)
+            slope = np.hypot(s1, s2)
+            slope = np.where(angle < 0, s1, np.where(angle > limit, (centre - shifted[diagonal]) / np.hypot(d1, d2), slope))
+            # A facet entirely off the DEM or on nodata (inf - inf is NaN, whose hypot is inf)
+            slope = np.where(np.isinf(shifted[cardinal]) & np.isinf(shifted[diagonal]), -np.inf, slope)
+            angle = np.clip(angle, 0, limit)
+            steeper = np.nan_to_num(slope, nan=-np.inf) > steepest
+            best = np.where(steeper, np.where(angle < limit / 2, cardinal, diagonal), best)
+            steepest = np.where(steeper, slope, steepest)
+    return best, steepest
+
+def trace(receiver: np.ndarray, start: np.ndarray, stop: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Walks every start cell down the receivers at once. A path ends at the first `stop` cell after it
+    # has been on a cell that isn't one (it starts on a road and ends at the next), or where a cell has no
+    # receiver. Returns the cells after the start cell of all paths, path by path, the number of them in
+    # every path and whether every path ended at a stop cell.
+    path_of, cells = [], []
+    current, active = start.copy(), np.arange(len(start))
+    left = ~stop[start]
+    stopped = np.zeros(len(start), dtype=bool)
+    while len(active):
+        following = receiver[current]
+        moving = following >= 0
+        active, current = active[moving], following[moving]
+        path_of.append(active)
+        cells.append(current)
+
+        reached = left[active] & stop[current]
+        stopped[active[reached]] = True
+        left[active] |= ~stop[current]
+        active, current = active[~reached], current[~reached]
+
+    path_of = np.concatenate(path_of) if path_of else np.array([], dtype=np.int64)
+    cells = np.concatenate(cells) if cells else np.array([], dtype=np.int64)
+    order = np.argsort(path_of, kind='stable') # Steps were recorded in order
+    return cells[order], np.bincount(path_of, minlength=len(start)), stopped
+
+def trace_flowpaths(
+    starts: gpd.GeoSeries,
+    roads: gpd.GeoSeries,
+    dem: rasterio.DatasetReader,
+    method: str = 'd8',
+    epsilon: float = 1e-5,
+) -> gpd.GeoDataFrame:
+    # One flowpath per start point (that isn't in a pit or on the edge of the DEM) from the point itself
+    # through the centres of the cells below it. START is the row of the start point, TO_ROAD whether it
+    # ended at a road rather than an outlet of the DEM.
+    transform = dem.transform
+    if starts.crs != dem.crs or roads.crs != dem.crs:
+        starts, roads = starts.to_crs(dem.crs), roads.to_crs(dem.crs)
+
+    with profiling.stage('fill depressions'):
+        elevation = dem.read(1, masked=True)
+        valid = ~np.ma.getmaskarray(elevation) & np.isfinite(elevation.filled(np.nan))
+        filled = fill_depressions(elevation.filled(np.nan), valid, epsilon)
+    with profiling.stage('flow directions'):
+        receiver = receivers(filled, transform, method)
+
+    with profiling.stage('trace flowpaths'):
+        width = dem.width
+        road_cells = rasterio.features.rasterize(
+            ((road, 1) for road in roads if road is not None and not road.is_empty),
+            out_shape=dem.shape, transform=transform, all_touched=True, dtype='uint8'
+        )
+        stop = _padded(road_cells, 0).astype(bool).reshape(-1)
+
+        points = shapely.get_coordinates(starts.to_numpy())
+        col, row = ~transform * (points[:, 0], points[:, 1])
+        row, col = np.floor(row).astype(np.int64), np.floor(col).astype(np.int64)
+        on_dem = (row >= 0) & (row < dem.height) & (col >= 0) & (col < width)
+        start = (row[on_dem] + 1) * (width + 2) + col[on_dem] + 1
+        cells, lengths, stopped = trace(receiver, start, stop)
+
+    # Cell centres after the start point, which replaces its cell's centre
+    cell_row, cell_col = np.divmod(cells, width + 2)
+    x, y = transform * (cell_col - 1 + 0.5, cell_row - 1 + 0.5)
+    kept = lengths > 0
+    path = np.repeat(np.arange(len(start)), lengths)
+    xy = np.concatenate([points[on_dem][kept], np.column_stack([x, y])])
+    line = np.concatenate([np.flatnonzero(kept), path])
+    order = np.argsort(line, kind='stable') # Start points first in every path
+    lines = shapely.linestrings(xy[order], indices=np.searchsorted(np.flatnonzero(kept), line[order]))
+
+    return gpd.GeoDataFrame({
+        'START': np.flatnonzero(on_dem)[kept],
+        'TO_ROAD': stopped[kept],
+    }, geometry=lines, crs=dem.crs)
@@ -0,0 +1,276 @@
+import os
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence
+import numpy as np
+import geopandas as gpd
+import pyproj
+import shapely
+import rasterio
+import rasterio.features
+import rasterio.windows
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+
+from utils import profiling
+from preprocess.dem import BLOCK_SIZE, NODATA
+from preprocess.mask import raster_tiles
+
+# A road surface DEM straight from a LiDAR collection too large for memory. The output grid covers the
+# road polygons and is processed in two passes on a process pool. The first one streams every cloud once
+# in chunks, keeps only the ground and road surface points on or next to a road, and spools every chunk
+# to disk by output tile as soon as it's read. The second one grids every tile (with a halo of a few
+# cells) from the spools of the tiles its window reaches. The surface of a cell is the median of its
+# points, grouped with one sort. A cell differing from the median of its neighbours by more than
+# `max_step` (a car, a kerb, a stray return) is dropped, and road cells without points get the mean of
+# their neighbours. Only one chunk of a cloud or the road points of one tile per worker are ever in
+# memory, and the spools are removed at the end.
+
+GROUND, ROAD_SURFACE = 2, 11 # ASPRS classes
+
+def _laspy():
+    try:
+        import laspy
+    except ImportError:
+        raise ImportError("Reading LiDAR requires laspy, and lazrs for LAZ (pip install 'RoadConnect[lidar]')")
+    return laspy
+
+@dataclass
+class Cloud:
+    path: Path
+    crs: CRS | None             # None when the header has none, taken to be the DEM's
+    footprint: shapely.Geometry # In the DEM's CRS
+
+def open_clouds(paths: Sequence[Path], crs: CRS, cloud_crs: CRS | None = None) -> List[Cloud]:
+    # The LAS/LAZ files among `paths` (directories are searched) with their header bounds in `crs`.
+    # `cloud_crs` overrides the CRS of every header.
+    laspy = _laspy()
+    files = []
+    for path in paths:
+        files += sorted(p for p in path.rglob('*') if p.suffix.lower() in ('.las', '.laz')) if path.is_dir() else [path]
+    if not files:
+        raise ValueError("No LAS or LAZ files found")
+    clouds = []
+    for path in files:
+        with laspy.open(path) as reader:
+            header = reader.header
+            source = cloud_crs or header.parse_crs()
+            bounds = (*header.mins[:2], *header.maxs[:2])
+        if source is not None:
+            source = CRS.from_user_input(source)
+            bounds = transform_bounds(source, crs, *bounds) if source != crs else bounds
+        clouds.append(Cloud(path, source, shapely.box(*bounds)))
+    return clouds
+
+def grouped_median(cells: np.ndarray, z: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Distinct cells, their median z and number of points
+    order = np.lexsort((z, cells))
+    cells, z = cells[order], z[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    count = np.diff(np.r_[starts, len(cells)])
+    median = (z[starts + (count - 1) // 2] + z[starts + count // 2]) / 2
+    return cells[starts], median, count
+
+def _neighbours(grid: np.ndarray) -> np.ndarray:
+    # (8, rows, columns) of the 8 neighbours of every cell, NaN beyond the edge
+    padded = np.pad(grid, 1, constant_values=np.nan)
+    rows, cols = grid.shape
+    return np.stack([padded[1 + r:rows + 1 + r, 1 + c:cols + 1 + c] for r in (-1, 0, 1) for c in (-1, 0, 1) if r or c])
+
+def _spool_cloud(
+    cloud: Cloud,
+    name: str,
+    crs: CRS,
+    window: rasterio.windows.Window,
+    transform: rasterio.Affine,
+    width: int,
+    height: int,
+    halo: int,
+    roads: np.ndarray,
+    classes: Sequence[int],
+    chunk_size: int,
+    tile_size: int,
+    spool: Path,
+) -> List[tuple[int, Path]]:
+    # Streams `cloud` once and writes the points of every chunk on the WKB `roads` within `window` (its
+    # footprint on the grid and its halo) to one spool file per tile and chunk, the halo beyond the grid
+    # going to the tiles at its edge, as cells of the grid with its halo and heights. Returns the tile and
+    # path of every file written.
+    laspy = _laspy()
+    road = rasterio.features.rasterize(
+        ((polygon, 1) for polygon in shapely.from_wkb(roads)),
+        out_shape=(window.height, window.width), transform=rasterio.windows.transform(window, transform), all_touched=True, dtype='uint8'
+    ).astype(bool)
+    # A cell more, the tiles pick their road cells themselves and all_touched can differ by a cell between windows
+    road = np.pad(road, 1)
+    road = np.any([road[1 + r:window.height + 1 + r, 1 + c:window.width + 1 + c] for r in (-1, 0, 1) for c in (-1, 0, 1)], axis=0)
+    to_grid = ~transform
+    tile_rows, tile_columns = -(-height // tile_size), -(-width // tile_size)
+    transformer = pyproj.Transformer.from_crs(cloud.crs, crs, always_xy=True) if cloud.crs is not None and cloud.crs != crs else None
+
+    written = []
+    with laspy.open(cloud.path) as reader:
+        for chunk, points in enumerate(reader.chunk_iterator(chunk_size)):
+            kept = np.isin(np.asarray(points.classification), classes)
+            x, y, z = np.asarray(points.x)[kept], np.asarray(points.y)[kept], np.asarray(points.z)[kept]
+            if transformer is not None:
+                x, y = transformer.transform(x, y)
+            col, row = to_grid * (x, y)
+            col, row = np.floor(col).astype(np.int64) - window.col_off, np.floor(row).astype(np.int64) - window.row_off
+            inside = (row >= 0) & (row < window.height) & (col >= 0) & (col < window.width)
+            row, col, z = row[inside], col[inside], z[inside]
+            on_road = road[row, col]
+            if not on_road.any():
+                continue
+
+            cells = (row[on_road] + window.row_off + halo) * (width + 2 * halo) + col[on_road] + window.col_off + halo
+            heights = z[on_road].astype('float32')
+            row, col = np.divmod(cells, width + 2 * halo)
+            tile = np.clip((row - halo) // tile_size, 0, tile_rows - 1) * tile_columns + np.clip((col - halo) // tile_size, 0, tile_columns - 1)
+            order = np.argsort(tile, kind='stable')
+            tile, cells, heights = tile[order], cells[order], heights[order]
+            starts = np.flatnonzero(np.r_[True, tile[1:] != tile[:-1]])
+            for first, last in zip(starts, np.r_[starts[1:], len(tile)]):
+                path = spool / f"{tile[first]}-{name}-{chunk}.npz"
+                np.savez(path, cells=cells[first:last], heights=heights[first:last])
+                written.append((int(tile[first]), path))
+    return written
+
+def _surface_tile(
+    spools: List[Path],
+    tile: rasterio.windows.Window,
+    window: rasterio.windows.Window,
+    transform: rasterio.Affine,
+    width: int,
+    halo: int,
+    roads: np.ndarray,
+    min_points: int,
+    max_step: float,
+) -> np.ndarray:
+    # Surface of `tile` from the spooled points in `window` (the tile with its halo) under the WKB `roads`
+    road = rasterio.features.rasterize(
+        ((polygon, 1) for polygon in shapely.from_wkb(roads)),
+        out_shape=(window.height, window.width), transform=rasterio.windows.transform(window, transform), all_touched=True, dtype='uint8'
+    ).astype(bool)
+
+    cells, heights = [], []
+    for path in spools:
+        with np.load(path) as spooled:
+            row, col = np.divmod(spooled['cells'], width + 2 * halo)
+            row, col = row - halo - window.row_off, col - halo - window.col_off
+            inside = (row >= 0) & (row < window.height) & (col >= 0) & (col < window.width)
+            row, col, z = row[inside], col[inside], spooled['heights'][inside]
+            on_road = road[row, col]
+            cells.append(row[on_road] * window.width + col[on_road])
+            heights.append(z[on_road])
+
+    surface = np.full((window.height, window.width), np.nan)
+    if cells:
+        cell, median, count = grouped_median(np.concatenate(cells), np.concatenate(heights))
+        surface.reshape(-1)[cell[count >= min_points]] = median[count >= min_points]
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # All-NaN neighbourhoods
+        neighbourhood = np.nanmedian(_neighbours(surface), axis=0)
+        surface[np.abs(surface - neighbourhood) > max_step] = np.nan
+        missing = road & np.isnan(surface)
+        surface[missing] = np.nanmean(_neighbours(surface), axis=0)[missing]
+
+    rows = slice(tile.row_off - window.row_off, tile.row_off - window.row_off + tile.height)
+    cols = slice(tile.col_off - window.col_off, tile.col_off - window.col_off + tile.width)
+    return np.nan_to_num(surface[rows, cols], nan=NODATA).astype('float32')
+
+def road_surface(
+    clouds: List[Cloud],
+    roads: gpd.GeoSeries,
+    output: Path,
+    resolution: float = 1.0,
+    classes: Sequence[int] = (GROUND, ROAD_SURFACE),
+    tile_size: int = 1024,
+    halo: int = 2,
+    workers: int | None = None,
+    chunk_size: int = 2_000_000,
+    min_points: int = 1,
+    max_step: float = 0.5,
+) -> int:
+    # Writes the road surface DEM of the road polygons `roads` (in the DEM's CRS) at `resolution` to
+    # `output`, NODATA off the roads, and returns the number of cells with a surface. Clouds and then
+    # tiles run on `workers` processes (default: every CPU), at most 2 * workers at a time, tiles are
+    # written in order. The spools go to a temporary directory next to `output`.
+    crs = CRS.from_user_input(roads.crs)
+    geometries = roads.to_numpy()
+    geometries = geometries[~(shapely.is_missing(geometries) | shapely.is_empty(geometries))]
+    if not np.all(np.isin(shapely.get_type_id(geometries), [3, 6])):
+        raise ValueError("The road surface needs road polygons, buffer the road lines first")
+    left, bottom, right, top = shapely.total_bounds(geometries)
+    left, bottom = np.floor(left / resolution) * resolution, np.floor(bottom / resolution) * resolution
+    right, top = np.ceil(right / resolution) * resolution, np.ceil(top / resolution) * resolution
+    width, height = max(1, round((right - left) / resolution)), max(1, round((top - bottom) / resolution))
+    transform = from_origin(left, top, resolution, resolution)
+
+    road_tree = shapely.STRtree(geometries)
+    grid = rasterio.windows.Window(-halo, -halo, width + 2 * halo, height + 2 * halo)
+    tile_columns = -(-width // tile_size)
+
+    def cloud_tasks() -> Iterator[tuple]:
+        for i, cloud in enumerate(clouds):
+            box = cloud.footprint
+            left, bottom, right, top = box.bounds
+            (first_col, last_col), (first_row, last_row) = np.floor(~transform * (np.array([left, right]), np.array([top, bottom]))).astype(np.int64)
+            window = rasterio.windows.Window(first_col, first_row, last_col - first_col + 1, last_row - first_row + 1)
+            if not rasterio.windows.intersect([window, grid]):
+                continue
+            window = window.intersection(grid)
+            cloud_roads = geometries[np.sort(road_tree.query(shapely.box(*rasterio.windows.bounds(window, transform)), predicate='intersects'))]
+            if len(cloud_roads):
+                yield cloud, str(i), window, shapely.to_wkb(cloud_roads)
+
+    def tile_tasks(spooled: Dict[int, List[Path]]) -> Iterator[tuple]:
+        for tile in raster_tiles(width, height, tile_size):
+            window = rasterio.windows.Window(tile.col_off - halo, tile.row_off - halo, tile.width + 2 * halo, tile.height + 2 * halo)
+            tile_rows = range(max(tile.row_off - halo, 0) // tile_size, (min(tile.row_off + tile.height + halo, height) - 1) // tile_size + 1)
+            tile_cols = range(max(tile.col_off - halo, 0) // tile_size, (min(tile.col_off + tile.width + halo, width) - 1) // tile_size + 1)
+            spools = [path for r in tile_rows for c in tile_cols for path in spooled.get(r * tile_columns + c, [])]
+            tile_roads = geometries[np.sort(road_tree.query(shapely.box(*rasterio.windows.bounds(window, transform)), predicate='intersects'))]
+            yield tile, window, shapely.to_wkb(tile_roads), spools
+
+    profile = {
+        'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'dtype': 'float32', 'crs': crs,
+        'transform': transform, 'nodata': NODATA, 'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE,
+        'compress': 'deflate', 'predictor': 3, 'BIGTIFF': 'IF_SAFER',
+    }
+    cells = 0
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory(prefix='spool-', dir=output.parent) as directory, ProcessPoolExecutor(max_workers=workers) as executor:
+        # Pass 1: every cloud streamed once, the road points of every chunk spooled by tile
+        spool, spooled = Path(directory), {}
+        with profiling.stage('spool clouds'):
+            pending = cloud_tasks()
+            while batch := list(islice(pending, 2 * workers)):
+                futures = [
+                    executor.submit(_spool_cloud, cloud, name, crs, window, transform, width, height, halo, wkb, list(classes), chunk_size, tile_size, spool)
+                    for cloud, name, window, wkb in batch
+                ]
+                for future in futures:
+                    for tile, path in future.result():
+                        spooled.setdefault(tile, []).append(path)
+
+        # Pass 2: every tile from the spools of the tiles its window reaches
+        with profiling.stage('road surface tiles'), rasterio.open(output, 'w', **profile) as dst:
+            pending = tile_tasks(spooled)
+            while batch := list(islice(pending, 2 * workers)):
+                futures = [
+                    executor.submit(_surface_tile, spools, tile, window, transform, width, halo, wkb, min_points, max_step)
+                    if len(wkb) and spools else None
+                    for tile, window, wkb, spools in batch
+                ]
+                for (tile, *_), future in zip(batch, futures):
+                    surface = future.result() if future is not None else np.full((tile.height, tile.width), NODATA, dtype='float32')
+                    dst.write(surface, 1, window=tile)
+                    cells += int((surface != NODATA).sum())
+    return cells
@@ -0,0 +1,130 @@
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, Sequence, Tuple
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+import rasterio.windows
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+
+from utils import profiling
+from preprocess.mask import overlap_layers, raster_tiles
+
+# Road TYPE from imagery: a pixel classifier (e.g. the random forest trained on Sentinel-2 bands in the
+# exploration notebook, saved with joblib) predicts the class of every pixel under a road, and a road
+# gets its most common class. The bands are read block by block on the grid of the first one (the
+# others warped onto it), every block's road pixels are predicted once in batches, and the (road, class)
+# pairs of every road layer (see mask.overlap_layers, so a pixel counts for every road on it) are added
+# up in one table. Nothing but a block of the bands is ever in memory.
+
+def _joblib():
+    try:
+        import joblib
+    except ImportError:
+        raise ImportError("Loading a road type classifier requires scikit-learn (pip install 'RoadConnect[classify]')")
+    return joblib
+
+def load_classifier(path: Path) -> Any:
+    # A fitted classifier with predict() and classes_, as saved by joblib.dump
+    classifier = _joblib().load(path)
+    if not hasattr(classifier, 'predict') or not hasattr(classifier, 'classes_'):
+        raise ValueError(f"{path} is not a fitted classifier")
+    return classifier
+
+def classify_roads(
+    roads: gpd.GeoSeries,
+    bands: Sequence[Path],
+    classifier: Any,
+    block_size: int = 2048,
+    batch_size: int = 2 ** 18,
+    all_touched: bool = True,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Most common predicted class of every road (None without a valid pixel, the first class in
+    # classifier.classes_ on ties) and its number of pixels. The features of a pixel are the bands of
+    # every raster in `bands`, in order, as in training. Pixels with nodata, or 0 in every band, are
+    # skipped.
+    classes = np.asarray(classifier.classes_)
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(path)) for path in bands]
+        grid = sources[0]
+        sources = [
+            src if (src.crs, src.transform, src.shape) == (grid.crs, grid.transform, grid.shape)
+            else stack.enter_context(WarpedVRT(src, crs=grid.crs, transform=grid.transform, width=grid.width, height=grid.height, resampling=Resampling.bilinear))
+            for src in sources
+        ]
+        geometries = roads.to_crs(grid.crs).to_numpy() if roads.crs != grid.crs else roads.to_numpy()
+        present = np.flatnonzero(~(shapely.is_missing(geometries) | shapely.is_empty(geometries)))
+        tree = shapely.STRtree(geometries[present])
+        with profiling.stage('road layers'):
+            layer = overlap_layers(geometries[present], np.hypot(grid.transform.a, grid.transform.e))
+
+        counts = np.zeros((len(geometries), len(classes)), dtype=np.int64)
+        for block in raster_tiles(grid.width, grid.height, block_size):
+            block_transform = rasterio.windows.transform(block, grid.transform)
+            hits = np.sort(tree.query(shapely.box(*rasterio.windows.bounds(block, grid.transform))))
+            if not len(hits):
+                continue
+            road, road_layer = present[hits], layer[hits]
+            with profiling.stage('rasterize roads'):
+                labels = [
+                    rasterio.features.rasterize(
+                        zip(geometries[road[road_layer == current]], road[road_layer == current] + 1),
+                        out_shape=(block.height, block.width),
+                        transform=block_transform,
+                        fill=0,
+                        all_touched=all_touched,
+                        dtype='int64',
+                    )
+                    for current in np.unique(road_layer)
+                ]
+                on_road = np.any([label > 0 for label in labels], axis=0)
+            if not on_road.any():
+                continue
+
+            with profiling.stage('read features'):
+                features, valid = [], on_road.copy()
+                for src in sources:
+                    values = src.read(window=block, masked=True)
+                    valid &= ~np.ma.getmaskarray(values).any(axis=0)
+                    features.append(values.filled(0).astype('float64')[:, on_road])
+                features = np.concatenate(features).T # (road pixels, features)
+                valid_pixels = valid[on_road] & np.isfinite(features).all(axis=1) & (features != 0).any(axis=1)
+
+            with profiling.stage('predict'):
+                code = np.full(len(features), -1)
+                rows = np.flatnonzero(valid_pixels)
+                for first in range(0, len(rows), batch_size):
+                    batch = rows[first:first + batch_size]
+                    code[batch] = np.searchsorted(classes, classifier.predict(features[batch]))
+
+            # Class of every road pixel back on the block, then counted for every road on it
+            pixel_code = np.full(on_road.shape, -1)
+            pixel_code[on_road] = code
+            for label in labels:
+                counted = (label > 0) & (pixel_code >= 0)
+                np.add.at(counts, (label[counted] - 1, pixel_code[counted]), 1)
+
+    pixels = counts.sum(axis=1)
+    majority = np.where(pixels > 0, classes[np.argmax(counts, axis=1)].astype(object), None)
+    return majority, pixels
+
+def assign_types(
+    roads: gpd.GeoDataFrame,
+    classes: np.ndarray,
+    mapping: Dict[str, str] | None = None,
+    default: str | None = None,
+) -> gpd.GeoDataFrame:
+    # Roads with their predicted class as LITHOLOGY and TYPE, through `mapping` where a class isn't a road
+    # type itself. Roads without a prediction keep their TYPE, or get `default`.
+    mapping = mapping or {}
+    result = roads.copy()
+    result['LITHOLOGY'] = classes
+    predicted = pd.Series([mapping.get(str(value), str(value)) if value is not None else None for value in classes], index=result.index, dtype=object)
+    if 'TYPE' in result.columns:
+        predicted = predicted.fillna(result['TYPE'])
+    result['TYPE'] = predicted.fillna(default) if default is not None else predicted
+    return result
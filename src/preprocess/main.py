@@ -0,0 +1,298 @@
+import argparse
+from pathlib import Path
+from utils import profiling
+
+# `roadconnect preprocess <stage>`. Stages import geopandas, rasterio and their own module when they
+# run, so registering them here keeps --help instant.
+
+def __roads(args: argparse.Namespace) -> int:
+    import geopandas as gpd
+    from preprocess import roads
+
+    with profiling.stage('read roads'):
+        centrelines = gpd.read_file(args.input)
+    with profiling.stage('segment roads'):
+        segments = roads.segment_roads(
+            centrelines,
+            target_length=args.segment_length,
+            width=args.width,
+            width_column=args.width_column,
+            type_column=args.type_column,
+            road_type=args.type,
+            simplify=args.simplify,
+        )
+    if args.dem is not None:
+        from preprocess import zonal
+        segments = zonal.segment_elevation(segments, args.dem)
+    with profiling.stage('write roads'):
+        segments.to_file(args.output)
+    print(f"{len(centrelines)} roads cut into {len(segments)} segments, {segments['LENGTH'].sum():.1f} total length")
+    return 0
+
+def __elevation(args: argparse.Namespace) -> int:
+    import geopandas as gpd
+    from preprocess import zonal
+
+    with profiling.stage('read roads'):
+        segments = gpd.read_file(args.roads)
+    segments = zonal.segment_elevation(segments, args.dem, buffer=args.buffer, tile_size=args.tile_size)
+    with profiling.stage('write roads'):
+        segments.to_file(args.output)
+    print(f"Elevation of {len(segments)} segments, {(segments['ELE_COUNT'] == 0).sum()} from the pixel under their centroid")
+    return 0
+
+def __dem(args: argparse.Namespace) -> int:
+    import shutil
+    import geopandas as gpd
+    import shapely
+    from rasterio.crs import CRS
+    from rasterio.enums import Resampling
+    from preprocess import dem
+
+    areas = gpd.read_file(args.extent)
+    crs = CRS.from_user_input(args.crs) if args.crs is not None else areas.crs
+    if crs is None or crs.is_geographic:
+        raise ValueError(f"The DEM needs a projected CRS (--crs), got {crs}")
+    extent = shapely.union_all(areas.to_crs(crs).geometry.to_numpy()).buffer(args.buffer)
+
+    source = dem.open_source(args.tiles, args.url_column)
+    cached = dem.prepare_dem(source, extent, crs, args.resolution, args.store, Resampling[args.resampling], args.workers)
+    if args.output is not None and args.output.resolve() != cached.resolve():
+        shutil.copyfile(cached, args.output)
+    print(f"DEM of {args.extent} at {args.resolution} in {crs.to_string()}: {args.output or cached}")
+    return 0
+
+def __flowpaths(args: argparse.Namespace) -> int:
+    import pandas as pd
+    import geopandas as gpd
+    import rasterio
+    from preprocess import flow
+
+    with profiling.stage('read layers'):
+        roads = gpd.read_file(args.roads)
+        starts = pd.concat([gpd.read_file(path).to_crs(roads.crs) for path in args.starts], ignore_index=True)
+    with rasterio.open(args.dem) as dem:
+        flowpaths = flow.trace_flowpaths(starts.geometry, roads.geometry, dem, args.method, args.epsilon)
+    with profiling.stage('write flowpaths'):
+        flowpaths.to_file(args.output)
+    print(f"{len(flowpaths)} flowpaths from {len(starts)} points, {(~flowpaths['TO_ROAD']).sum()} leave the DEM without reaching a road")
+    return 0
+
+def __trim(args: argparse.Namespace) -> int:
+    import pandas as pd
+    import geopandas as gpd
+    import rasterio
+    from contextlib import nullcontext
+    from preprocess import trim
+
+    with profiling.stage('read layers'):
+        flowpaths = gpd.read_file(args.flowpaths)
+        roads = gpd.read_file(args.roads).to_crs(flowpaths.crs)
+        starts = pd.concat([gpd.read_file(path).to_crs(flowpaths.crs) for path in args.starts], ignore_index=True)
+    with rasterio.open(args.dem) if args.dem is not None else nullcontext() as dem:
+        trimmed = trim.trim_flowpaths(flowpaths.geometry, starts.geometry, roads.geometry, dem, args.tolerance, args.min_distance, args.snap)
+    with profiling.stage('write flowpaths'):
+        trimmed.to_file(args.output)
+    print(f"{len(trimmed)} of {len(flowpaths)} flowpaths kept, {trimmed['TO_ROAD'].sum()} cut at a road")
+    return 0
+
+def __mask(args: argparse.Namespace) -> int:
+    import geopandas as gpd
+    from preprocess import mask
+
+    with profiling.stage('read roads'):
+        roads = gpd.read_file(args.roads).geometry
+    if args.buffer is not None:
+        roads = roads.buffer(args.buffer, cap_style='flat')
+    cells = mask.road_mask(roads, args.dem, args.output, args.tolerance, args.decimals, args.tile_size, args.workers)
+    print(f"Road mask of {len(roads)} polygons: {cells} road cells")
+    return 0
+
+def __lidar(args: argparse.Namespace) -> int:
+    import geopandas as gpd
+    from rasterio.crs import CRS
+    from preprocess import lidar
+
+    with profiling.stage('read roads'):
+        roads = gpd.read_file(args.roads).geometry
+    if args.buffer is not None:
+        roads = roads.buffer(args.buffer, cap_style='flat')
+    with profiling.stage('read cloud headers'):
+        clouds = lidar.open_clouds(args.clouds, CRS.from_user_input(roads.crs), CRS.from_user_input(args.cloud_crs) if args.cloud_crs else None)
+    cells = lidar.road_surface(
+        clouds,
+        roads,
+        args.output,
+        resolution=args.resolution,
+        classes=args.classes,
+        tile_size=args.tile_size,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        min_points=args.min_points,
+        max_step=args.max_step,
+    )
+    print(f"Road surface from {len(clouds)} point clouds: {cells} cells")
+    return 0
+
+def __lithology(args: argparse.Namespace) -> int:
+    import os
+    import geopandas as gpd
+    from utils import config
+    from preprocess import lithology
+
+    mapping = dict(pair.split('=', 1) for pair in args.map)
+    classifier = lithology.load_classifier(args.model)
+    with profiling.stage('read roads'):
+        roads = gpd.read_file(args.roads)
+    classes, pixels = lithology.classify_roads(roads.geometry, args.bands, classifier, args.block_size, args.batch_size)
+    classified = lithology.assign_types(roads, classes, mapping, args.default)
+
+    # The types data/roads.py accepts, when there is a configuration to check them against
+    if os.path.isfile(config.CONFIG_PATH):
+        unknown = set(classified['TYPE'].dropna()) - set(config.get_road_types())
+        if unknown:
+            raise ValueError(f"Predicted road types not in the configuration: {unknown}, map them with --map CLASS=TYPE")
+    if classified['TYPE'].isna().any():
+        raise ValueError(f"{classified['TYPE'].isna().sum()} roads have no valid pixels and no TYPE, give them one with --default")
+    with profiling.stage('write roads'):
+        classified.to_file(args.output)
+    print(f"Road types of {len(roads)} roads, {(pixels == 0).sum()} without valid pixels: {classified['TYPE'].value_counts().to_dict()}")
+    return 0
+
+def __drains(args: argparse.Namespace) -> int:
+    import geopandas as gpd
+    from preprocess import drains
+
+    with profiling.stage('read roads'):
+        roads = gpd.read_file(args.roads)
+    natural = drains.natural_drains(roads, args.elevation_column)
+    with profiling.stage('write drains'):
+        natural.to_file(args.output)
+    print(f"{len(natural)} drains at the local minima of {len(roads)} road segments")
+    return 0
+
+def __contributing(args: argparse.Namespace) -> int:
+    import geopandas as gpd
+    from preprocess import contributing
+
+    with profiling.stage('read layers'):
+        roads = gpd.read_file(args.roads)
+        drains = gpd.read_file(args.drains)
+    drain = contributing.contributing_segments(roads, drains.geometry, args.elevation_column, args.tolerance)
+    areas = contributing.contributing_areas(roads, drain, args.buffer)
+    with profiling.stage('write areas'):
+        areas.to_file(args.output)
+        if args.segments is not None:
+            roads.assign(DRAIN=drain).to_file(args.segments)
+    print(f"Contributing areas of {len(areas)} of {len(drains)} drains, {(drain < 0).sum()} of {len(roads)} segments drain to none")
+    return 0
+
+def add_parser(commands: argparse._SubParsersAction) -> None:
+    parser = commands.add_parser('preprocess', help="prepare the model's input files from raw layers")
+    stages = parser.add_subparsers(title='stages', required=True)
+
+    roads = stages.add_parser('roads', help="cut road centrelines into equal-length segments (the roads layer)")
+    roads.add_argument('input', type=Path, help="road centrelines, any format geopandas reads")
+    roads.add_argument('output', type=Path, help="segmented roads, e.g. user_data/roads.shp")
+    roads.add_argument('--segment-length', type=float, default=2.0, help="target segment length in CRS units (default: 2)")
+    roads.add_argument('--width', type=float, help="road width, or the width of roads missing --width-column")
+    roads.add_argument('--width-column', help="attribute with the width of every road")
+    roads.add_argument('--type-column', help="attribute with the road type, written as TYPE")
+    roads.add_argument('--type', help="road type of roads without one")
+    roads.add_argument('--simplify', type=float, default=0.0, help="simplify the centrelines with this tolerance first")
+    roads.add_argument('--dem', type=Path, help="also fill ELEVATION from this DEM, as the elevation stage does")
+    roads.set_defaults(command=__roads)
+
+    elevation = stages.add_parser('elevation', help="fill the ELEVATION of road segments from a DEM")
+    elevation.add_argument('roads', type=Path, help="road segments with a WIDTH attribute (see --buffer)")
+    elevation.add_argument('dem', type=Path, help="elevation raster")
+    elevation.add_argument('output', type=Path, help="road segments with ELEVATION and the ELE_* statistics")
+    elevation.add_argument('--buffer', type=float, help="buffer every segment by this distance instead of half its WIDTH")
+    elevation.add_argument('--tile-size', type=int, default=2048, help="DEM pixels per tile side (default: 2048)")
+    elevation.set_defaults(command=__elevation)
+
+    drains = stages.add_parser('drains', help="place drains at the road segments lower than all their neighbours")
+    drains.add_argument('roads', type=Path, help="road segments with an elevation, e.g. from the elevation stage")
+    drains.add_argument('output', type=Path, help="drain points, e.g. user_data/drains.shp")
+    drains.add_argument('--elevation-column', default='ELEVATION', help="attribute with the segment elevations (default: ELEVATION)")
+    drains.set_defaults(command=__drains)
+
+    areas = stages.add_parser('contributing', help="dissolve the road segments draining to every drain into its contributing area")
+    areas.add_argument('roads', type=Path, help="road segments with an elevation")
+    areas.add_argument('drains', type=Path, help="drain points on the road segments, e.g. from the drains stage")
+    areas.add_argument('output', type=Path, help="one contributing area polygon per drain")
+    areas.add_argument('--segments', type=Path, help="also write the road segments with the DRAIN they drain to (-1 for none)")
+    areas.add_argument('--buffer', type=float, help="buffer road lines by this distance instead of half their WIDTH")
+    areas.add_argument('--elevation-column', default='ELEVATION', help="attribute with the segment elevations (default: ELEVATION)")
+    areas.add_argument('--tolerance', type=float, default=1e-6, help="distance within which a drain is on a segment (default: 1e-6)")
+    areas.set_defaults(command=__contributing)
+
+    dem = stages.add_parser('dem', help="mosaic, reproject and clip DEM tiles to an extent (the elevation raster)")
+    dem.add_argument('extent', type=Path, help="vector file whose geometries (buffered by --buffer) are the extent")
+    dem.add_argument('output', type=Path, nargs='?', help="copy of the DEM, e.g. user_data/elevation.tif (default: only the cached DEM in --store)")
+    dem.add_argument('--tiles', required=True, help="directory of GeoTIFF tiles, or a tile index (file or URL) with the URL of every tile")
+    dem.add_argument('--url-column', default='url', help="column of the tile index with the tile URLs (default: url)")
+    dem.add_argument('--crs', help="CRS of the DEM, e.g. EPSG:6566 (default: the extent's)")
+    dem.add_argument('--resolution', type=float, default=1.0, help="pixel size in CRS units (default: 1)")
+    dem.add_argument('--buffer', type=float, default=0.0, help="grow the extent by this distance")
+    dem.add_argument('--resampling', default='nearest', choices=['nearest', 'bilinear', 'cubic', 'average'])
+    dem.add_argument('--store', type=Path, default=Path('cache/dem'), help="downloaded tiles and finished DEMs (default: cache/dem)")
+    dem.add_argument('--workers', type=int, default=8, help="concurrent downloads and warping threads (default: 8)")
+    dem.set_defaults(command=__dem)
+
+    mask = stages.add_parser('mask', help="mask the road surface on the DEM (the flow accumulation weights)")
+    mask.add_argument('roads', type=Path, help="road polygons, e.g. the buffered road edges")
+    mask.add_argument('dem', type=Path, help="elevation raster, the mask is on its grid")
+    mask.add_argument('output', type=Path, help="road mask raster, 1 on the road surface")
+    mask.add_argument('--buffer', type=float, help="buffer the roads by this distance first (for road lines)")
+    mask.add_argument('--tolerance', type=float, default=0.3, help="largest difference from a road's majority elevation (default: 0.3)")
+    mask.add_argument('--decimals', type=int, default=1, help="round elevations to this many decimals for the majority (default: 1)")
+    mask.add_argument('--tile-size', type=int, default=2048, help="DEM pixels per tile side (default: 2048)")
+    mask.add_argument('--workers', type=int, help="worker processes (default: every CPU)")
+    mask.set_defaults(command=__mask)
+
+    lidar = stages.add_parser('lidar', help="grid a road surface DEM from LiDAR point clouds")
+    lidar.add_argument('roads', type=Path, help="road polygons, the DEM covers them in their CRS")
+    lidar.add_argument('output', type=Path, help="road surface DEM, nodata off the roads")
+    lidar.add_argument('--clouds', type=Path, nargs='+', required=True, help="LAS/LAZ files or directories of them")
+    lidar.add_argument('--cloud-crs', help="CRS of the point clouds (default: their headers', or the roads' where they have none)")
+    lidar.add_argument('--buffer', type=float, help="buffer the roads by this distance first (for road lines)")
+    lidar.add_argument('--resolution', type=float, default=1.0, help="cell size in CRS units (default: 1)")
+    lidar.add_argument('--classes', type=int, nargs='+', default=[2, 11], help="point classes on the road surface (default: 2 11, ground and road)")
+    lidar.add_argument('--min-points', type=int, default=1, help="fewest points for a cell to have a surface (default: 1)")
+    lidar.add_argument('--max-step', type=float, default=0.5, help="drop cells further than this from the median of their neighbours (default: 0.5)")
+    lidar.add_argument('--tile-size', type=int, default=1024, help="cells per tile side (default: 1024)")
+    lidar.add_argument('--chunk-size', type=int, default=2_000_000, help="points read at a time (default: 2000000)")
+    lidar.add_argument('--workers', type=int, help="worker processes (default: every CPU)")
+    lidar.set_defaults(command=__lidar)
+
+    lithology = stages.add_parser('lithology', help="classify the road surface (TYPE) from imagery with a trained pixel classifier")
+    lithology.add_argument('roads', type=Path, help="roads, e.g. the centrelines before the roads stage (see its --type-column)")
+    lithology.add_argument('output', type=Path, help="roads with TYPE and the predicted LITHOLOGY")
+    lithology.add_argument('--bands', type=Path, nargs='+', required=True, help="rasters with the classifier's features, in training order (warped onto the first)")
+    lithology.add_argument('--model', type=Path, required=True, help="fitted classifier saved with joblib, e.g. a scikit-learn random forest")
+    lithology.add_argument('--map', nargs='*', default=[], metavar='CLASS=TYPE', help="road type of a predicted class, where it isn't one itself")
+    lithology.add_argument('--default', help="road type of roads without valid pixels and TYPE")
+    lithology.add_argument('--block-size', type=int, default=2048, help="pixels per block side (default: 2048)")
+    lithology.add_argument('--batch-size', type=int, default=2 ** 18, help="pixels per prediction (default: 262144)")
+    lithology.set_defaults(command=__lithology)
+
+    flowpaths = stages.add_parser('flowpaths', help="trace flowpaths from drains and ponds down the DEM to the next road")
+    flowpaths.add_argument('dem', type=Path, help="elevation raster")
+    flowpaths.add_argument('roads', type=Path, help="road segments, a flowpath ends at the first road it reaches")
+    flowpaths.add_argument('output', type=Path, help="flowpaths, e.g. user_data/flowpaths.shp")
+    flowpaths.add_argument('--starts', type=Path, nargs='+', required=True, help="point layers to start from (drains, ponds)")
+    flowpaths.add_argument('--method', choices=['d8', 'dinf'], default='d8', help="flow routing (default: d8)")
+    flowpaths.add_argument('--epsilon', type=float, default=1e-5, help="gradient imposed on filled depressions and flats (default: 1e-5)")
+    flowpaths.set_defaults(command=__flowpaths)
+
+    trim = stages.add_parser('trim', help="cut flowpaths at the first road they cross")
+    trim.add_argument('flowpaths', type=Path, help="flowpaths starting or ending at a drain or pond")
+    trim.add_argument('roads', type=Path, help="road segments")
+    trim.add_argument('output', type=Path, help="trimmed flowpaths, e.g. user_data/flowpaths.shp")
+    trim.add_argument('--starts', type=Path, nargs='+', required=True, help="point layers the flowpaths start from (drains, ponds)")
+    trim.add_argument('--dem', type=Path, help="drop flowpaths that don't go downhill on this DEM")
+    trim.add_argument('--tolerance', type=float, default=0.01, help="distance within which a flowpath end is at a start point (default: 0.01)")
+    trim.add_argument('--min-distance', type=float, default=0.5, help="ignore road crossings closer than this to the start (default: 0.5)")
+    trim.add_argument('--snap', type=float, default=0.0, help="extend paths crossing no road to one within this distance of their end, e.g. the DEM pixel size")
+    trim.set_defaults(command=__trim)
@@ -0,0 +1,216 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, List, Tuple
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+import rasterio.windows
+
+from utils import profiling
+
+# The road mask the flow accumulation weights come from: the DEM cells under every road polygon within
+# `tolerance` of the polygon's majority elevation (the DEM rounded to `decimals`), i.e. the road surface
+# without the ditches and banks its buffer takes in. The raster is processed in tiles on a process pool,
+# twice. Road polygons overlap, and a cell counts towards every polygon it is under, so the polygons
+# are split into layers none of which can share a cell, and every layer is burnt into one label raster
+# per tile. The first pass counts the (polygon, rounded value) pairs of every tile, which add up across
+# tiles however far a polygon reaches, and gives every polygon its majority. The second pass compares
+# every tile's cells with the majorities of the polygons on them. No tile is read with a halo.
+
+def value_counts(labels: np.ndarray, values: np.ndarray, counts: np.ndarray | None = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Distinct (label, value) pairs, sorted, and how often each one occurs (the sum of `counts`)
+    order = np.lexsort((values, labels))
+    labels, values = labels[order], values[order]
+    counts = np.ones(len(labels), dtype=np.int64) if counts is None else counts[order]
+    if len(labels) == 0:
+        return labels, values, counts
+    starts = np.flatnonzero(np.r_[True, (labels[1:] != labels[:-1]) | (values[1:] != values[:-1])])
+    return labels[starts], values[starts], np.add.reduceat(counts, starts)
+
+def group_majority(labels: np.ndarray, values: np.ndarray, n_labels: int, counts: np.ndarray | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Most common value of every label 0 .. n_labels - 1 (the smallest one on ties) and whether it has one.
+    # `counts` weighs every (label, value) pair, e.g. counts from value_counts.
+    majority = np.zeros(n_labels, dtype=values.dtype)
+    found = np.zeros(n_labels, dtype=bool)
+    if len(labels) == 0:
+        return majority, found
+    run_label, run_value, count = value_counts(labels, values, counts)
+    # Runs by label, most common first, then by value
+    best = np.lexsort((run_value, -count, run_label))
+    first = best[np.r_[True, run_label[best][1:] != run_label[best][:-1]]]
+    majority[run_label[first]] = run_value[first]
+    found[run_label[first]] = True
+    return majority, found
+
+def overlap_layers(geometries: np.ndarray, distance: float, seed: int = 0) -> np.ndarray:
+    # Layer of every geometry such that geometries within `distance` of each other are in different
+    # layers: every layer is a maximal independent set of the rest, found in parallel rounds (Luby) where
+    # every candidate with no candidate neighbour of a higher random priority is taken.
+    i, j = shapely.STRtree(geometries).query(geometries, predicate='dwithin', distance=distance)
+    i, j = i[i != j], j[i != j]
+    priority = np.random.default_rng(seed).permutation(len(geometries))
+    layer = np.full(len(geometries), -1)
+    current = 0
+    while (remaining := layer < 0).any():
+        candidate = remaining
+        while candidate.any():
+            both = candidate[i] & candidate[j]
+            beaten = np.zeros(len(geometries), dtype=bool)
+            beaten[i[both & (priority[j] > priority[i])]] = True
+            taken = candidate & ~beaten
+            layer[taken] = current
+            candidate = candidate & ~taken
+            candidate[j[taken[i]]] = False # Neighbours of the taken ones wait for the next layer
+        current += 1
+    return layer
+
+def raster_tiles(width: int, height: int, size: int) -> Iterator[rasterio.windows.Window]:
+    # Windows of at most size x size covering a width x height raster, row by row
+    for row in range(0, height, size):
+        for col in range(0, width, size):
+            yield rasterio.windows.Window(col, row, min(size, width - col), min(size, height - row))
+
+def _burn(
+    path: Path,
+    band: int,
+    tile: rasterio.windows.Window,
+    polygons: np.ndarray,
+    layer: np.ndarray,
+    decimals: int,
+    all_touched: bool,
+) -> Tuple[np.ndarray, List[np.ndarray], List[np.ndarray]]:
+    # Rounded elevations of `tile` as integers (so the majority and the tolerance are exact), and per layer
+    # the position of the polygon on every cell among the WKB `polygons` and which cells have one and a value
+    with rasterio.open(path) as dataset:
+        values = dataset.read(band, window=tile)
+        nodata = dataset.nodatavals[band - 1]
+        transform = rasterio.windows.transform(tile, dataset.transform)
+    geometries = shapely.from_wkb(polygons)
+    labels = [
+        rasterio.features.rasterize(
+            zip(geometries[layer == current], np.flatnonzero(layer == current) + 1),
+            out_shape=(tile.height, tile.width),
+            transform=transform,
+            fill=0,
+            all_touched=all_touched,
+            dtype='int32',
+        ) - 1
+        for current in np.unique(layer)
+    ]
+    valid = np.isfinite(values)
+    if nodata is not None:
+        valid &= values != nodata
+    rounded = np.zeros(values.shape, dtype=np.int64)
+    rounded[valid] = np.round(values[valid].astype(float) * 10 ** decimals).astype(np.int64)
+    return rounded, labels, [valid & (label >= 0) for label in labels]
+
+def _count_tile(
+    path: Path,
+    band: int,
+    tile: rasterio.windows.Window,
+    polygons: np.ndarray,
+    layer: np.ndarray,
+    decimals: int,
+    all_touched: bool,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # value_counts of the (polygon position, rounded value) pairs of `tile`
+    rounded, labels, burnt = _burn(path, band, tile, polygons, layer, decimals, all_touched)
+    return value_counts(
+        np.concatenate([label[cells] for label, cells in zip(labels, burnt)]).astype(np.int64),
+        np.concatenate([rounded[cells] for cells in burnt]),
+    )
+
+def _mask_tile(
+    path: Path,
+    band: int,
+    tile: rasterio.windows.Window,
+    polygons: np.ndarray,
+    layer: np.ndarray,
+    majority: np.ndarray,
+    found: np.ndarray,
+    decimals: int,
+    tolerance: int,
+    all_touched: bool,
+) -> np.ndarray:
+    # Mask of `tile` from the WKB, layers and majorities of the polygons intersecting it
+    rounded, labels, burnt = _burn(path, band, tile, polygons, layer, decimals, all_touched)
+    matched = np.zeros(rounded.shape, dtype=bool)
+    for label, cells in zip(labels, burnt):
+        matched |= cells & found[label] & (np.abs(rounded - majority[label]) <= tolerance)
+    return matched.astype('uint8')
+
+def road_mask(
+    polygons: gpd.GeoSeries,
+    dem_path: Path,
+    output: Path,
+    tolerance: float = 0.3,
+    decimals: int = 1,
+    tile_size: int = 2048,
+    workers: int | None = None,
+    all_touched: bool = True,
+    band: int = 1,
+) -> int:
+    # Writes the road mask of `polygons` on the DEM's grid to `output` (uint8, 1 on the road surface) and
+    # returns the number of road cells. Both passes run on `workers` processes (default: every CPU), at
+    # most 2 * workers tiles at a time, and the mask is written in order.
+    with rasterio.open(dem_path) as dataset:
+        if dataset.crs is not None and polygons.crs != dataset.crs:
+            polygons = polygons.to_crs(dataset.crs)
+        transform, width, height = dataset.transform, dataset.width, dataset.height
+        profile = {
+            'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'dtype': 'uint8', 'crs': dataset.crs,
+            'transform': transform, 'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate',
+        }
+
+    geometries = polygons.to_numpy()
+    geometries = geometries[~(shapely.is_missing(geometries) | shapely.is_empty(geometries))]
+    if not np.all(np.isin(shapely.get_type_id(geometries), [3, 6])):
+        raise ValueError("The road mask needs road polygons, buffer the road lines first")
+    tree = shapely.STRtree(geometries)
+    with profiling.stage('overlap layers'):
+        layer = overlap_layers(geometries, np.hypot(transform.a, transform.e))
+    step = round(tolerance * 10 ** decimals)
+
+    def tasks() -> Iterator[tuple]:
+        for tile in raster_tiles(width, height, tile_size):
+            burnt = np.sort(tree.query(shapely.box(*rasterio.windows.bounds(tile, transform))))
+            yield tile, burnt, shapely.to_wkb(geometries[burnt])
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Pass 1: (polygon, value) counts of every tile, added up into the majority of every polygon
+        counts = value_counts(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        with profiling.stage('majority elevations'):
+            pending = tasks()
+            while batch := list(islice(pending, 2 * workers)):
+                futures = [
+                    (burnt, executor.submit(_count_tile, dem_path, band, tile, wkb, layer[burnt], decimals, all_touched))
+                    for tile, burnt, wkb in batch if len(burnt)
+                ]
+                labels, values, count = [counts[0]], [counts[1]], [counts[2]]
+                for burnt, future in futures:
+                    label, value, n = future.result()
+                    labels.append(burnt[label])
+                    values.append(value)
+                    count.append(n)
+                counts = value_counts(np.concatenate(labels), np.concatenate(values), np.concatenate(count))
+            majority, found = group_majority(*counts[:2], len(geometries), counts[2])
+
+        # Pass 2: every tile's cells against the majorities of the polygons on them
+        cells = 0
+        with profiling.stage('mask tiles'), rasterio.open(output, 'w', **profile) as dst:
+            pending = tasks()
+            while batch := list(islice(pending, 2 * workers)):
+                futures = [
+                    executor.submit(_mask_tile, dem_path, band, tile, wkb, layer[burnt], majority[burnt], found[burnt], decimals, step, all_touched) if len(burnt) else None
+                    for tile, burnt, wkb in batch
+                ]
+                for (tile, *_), future in zip(batch, futures):
+                    mask = future.result() if future is not None else np.zeros((tile.height, tile.width), dtype='uint8')
+                    dst.write(mask, 1, window=tile)
+                    cells += int(mask.sum())
+    return cells
@@ -0,0 +1,101 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+
+# Cuts road centrelines into segments of roughly equal length, the road layer schema model.data.roads
+# expects (TYPE, LENGTH, AREA, ELEVATION comes from preprocess.zonal). Every line of length L gets
+# n = max(1, round(L / target)) segments of length L / n. All lines are cut at once: vertices and cut
+# points are measured along their line, sorted into segments and turned back into linestrings by
+# offset, no Python loop over lines or segments.
+
+def segment_lines(lines: np.ndarray, target_length: float) -> tuple[np.ndarray, np.ndarray]:
+    # LineStrings -> (segments, line every segment was cut from). Empty and zero-length lines are dropped.
+    if target_length <= 0:
+        raise ValueError(f"Segment length has to be positive, got {target_length}")
+    xy, line = shapely.get_coordinates(lines, return_index=True)
+
+    # Distance along its line of every vertex, steps between lines don't count
+    step = np.zeros(len(xy))
+    step[1:] = np.where(line[1:] == line[:-1], np.hypot(*(xy[1:] - xy[:-1]).T), 0.0)
+    along = np.cumsum(step)
+    first = np.searchsorted(line, np.arange(len(lines)))
+    last = np.searchsorted(line, np.arange(len(lines)), side='right') - 1
+    has_vertices = last >= first
+    start, length = np.zeros(len(lines)), np.zeros(len(lines))
+    start[has_vertices] = along[first[has_vertices]]
+    length[has_vertices] = along[last[has_vertices]] - start[has_vertices]
+
+    kept = length > 0
+    n_segments = np.where(kept, np.maximum(1, np.round(length / target_length)), 0).astype(np.int64)
+    segment_length = np.divide(length, n_segments, out=np.zeros_like(length), where=kept)
+    base = np.cumsum(n_segments) - n_segments # Output index of every line's first segment
+
+    # Cut points k * segment_length for k = 1 .. n - 1, interpolated on the vertex step they fall on.
+    # Cuts are strictly inside their line, so they're sorted by distance across all lines too.
+    n_cuts = np.maximum(n_segments - 1, 0)
+    cut_base = np.cumsum(n_cuts) - n_cuts
+    cut_line = np.repeat(np.arange(len(lines)), n_cuts)
+    k = np.arange(len(cut_line)) - cut_base[cut_line] + 1
+    cut_along = start[cut_line] + k * segment_length[cut_line]
+    vertex = np.clip(np.searchsorted(along, cut_along, side='right') - 1, first[cut_line], last[cut_line] - 1)
+    t = (cut_along - along[vertex]) / np.where(step[vertex + 1] > 0, step[vertex + 1], 1.0)
+    cut_xy = xy[vertex] + t[:, None] * (xy[vertex + 1] - xy[vertex])
+
+    # Vertices belong to the segment their distance falls in, a cut point ends one segment and starts the next
+    on_kept = kept[line]
+    vertex_k = np.searchsorted(cut_along, along[on_kept], side='right') - cut_base[line[on_kept]]
+    vertex_segment = base[line[on_kept]] + vertex_k
+    cut_segment = base[cut_line] + k
+    segment = np.concatenate([vertex_segment, cut_segment - 1, cut_segment])
+    position = np.concatenate([along[on_kept], cut_along, cut_along])
+    points = np.concatenate([xy[on_kept], cut_xy, cut_xy])
+
+    order = np.lexsort((position, segment))
+    segment, points = segment[order], points[order]
+    # A vertex exactly on a cut repeats it
+    distinct = np.ones(len(points), dtype=bool)
+    distinct[1:] = (segment[1:] != segment[:-1]) | np.any(points[1:] != points[:-1], axis=1)
+    segments = shapely.linestrings(points[distinct], indices=segment[distinct])
+    return segments, np.repeat(np.arange(len(lines)), n_segments)
+
+def segment_roads(
+    roads: gpd.GeoDataFrame,
+    target_length: float = 2.0,
+    width: float | None = None,
+    width_column: str | None = None,
+    type_column: str | None = None,
+    road_type: str | None = None,
+    simplify: float = 0.0,
+) -> gpd.GeoDataFrame:
+    # Road centrelines (LineString or MultiLineString) -> segments with TYPE, WIDTH, LENGTH and AREA.
+    # Every other attribute of a line is kept on its segments, SOURCE is the row it came from.
+    if roads.crs is None or roads.crs.is_geographic:
+        raise ValueError(f"Roads need a projected CRS to be cut into segments by length, got {roads.crs}")
+    if width is None and width_column is None:
+        raise ValueError("Either a road width or a column with the width of every road is needed for AREA")
+
+    roads = roads.reset_index(drop=True)
+    roads['SOURCE'] = np.arange(len(roads))
+    roads = roads[roads.geometry.notna() & ~roads.geometry.is_empty].explode(index_parts=False, ignore_index=True)
+    lines = roads.geometry.to_numpy()
+    if not np.all(shapely.get_type_id(lines) == shapely.GeometryType.LINESTRING):
+        raise ValueError("Roads have to be lines")
+    if simplify > 0:
+        lines = shapely.simplify(lines, simplify)
+
+    segments, line = segment_lines(lines, target_length)
+    result = gpd.GeoDataFrame(roads.drop(columns=roads.geometry.name).iloc[line].reset_index(drop=True), geometry=segments, crs=roads.crs)
+
+    if type_column is not None and type_column != 'TYPE':
+        result = result.rename(columns={type_column: 'TYPE'})
+    if road_type is not None:
+        result['TYPE'] = result['TYPE'].fillna(road_type) if 'TYPE' in result.columns else road_type
+    if width_column is None:
+        result['WIDTH'] = width
+    else:
+        result['WIDTH'] = result[width_column] if width is None else result[width_column].fillna(width)
+    if (result['WIDTH'].isna() | (result['WIDTH'] <= 0)).any():
+        raise ValueError(f"Missing or non-positive road widths at source rows: {sorted(set(result.loc[result['WIDTH'].isna() | (result['WIDTH'] <= 0), 'SOURCE']))}")
+    result['LENGTH'] = shapely.length(segments)
+    result['AREA'] = result['LENGTH'] * result['WIDTH']
+    return result
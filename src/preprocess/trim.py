@@ -0,0 +1,150 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+
+from utils import profiling
+
+# Cuts every flowpath at the first road it crosses after leaving the drain (or pond) it starts from, so
+# that model.data.flowpaths routes it into that road's drain. All crossings are found with one bulk
+# STRtree query of the flowpaths against the roads, located by their distance along the flowpath, and
+# the lines are cut on their coordinate arrays. Flowpaths come out starting exactly at their point,
+# simple, and (given a DEM) downhill, which is what model.data.flowpaths checks when it loads them.
+
+def _along(xy: np.ndarray, line: np.ndarray) -> np.ndarray:
+    # Distance of every vertex from the start of its line
+    step = np.zeros(len(xy))
+    step[1:] = np.where(line[1:] == line[:-1], np.hypot(*(xy[1:] - xy[:-1]).T), 0.0)
+    along = np.cumsum(step)
+    first = np.searchsorted(line, line) # Index of every vertex's line's first vertex
+    return along - along[first]
+
+def _sample(dem: rasterio.DatasetReader, xy: np.ndarray) -> np.ndarray:
+    values = np.array([value[0] for value in dem.sample(xy)], dtype=float)
+    if dem.nodata is not None:
+        values[values == dem.nodata] = np.nan
+    return values
+
+def cut_lines(lines: np.ndarray, distance: np.ndarray) -> np.ndarray:
+    # Every line up to `distance` along it (NaN or beyond its end keeps it whole)
+    xy, line = shapely.get_coordinates(lines, return_index=True)
+    along = _along(xy, line)
+    cut = np.isfinite(distance) & (distance < shapely.length(lines))
+    kept = ~cut[line] | (along < distance[line])
+    ends = shapely.get_coordinates(shapely.line_interpolate_point(lines[cut], distance[cut]))
+
+    points = np.concatenate([xy[kept], ends])
+    index = np.concatenate([line[kept], np.flatnonzero(cut)])
+    order = np.argsort(index, kind='stable') # Cut points after the vertices of their line
+    return shapely.linestrings(points[order], indices=index[order])
+
+def _erase_loops(line: shapely.LineString) -> shapely.LineString:
+    # A path crossing itself goes straight from the first crossing to where it leaves the loop
+    coordinates = shapely.get_coordinates(line)
+    j = 2
+    while j < len(coordinates) - 1:
+        segment = shapely.LineString(coordinates[j:j + 2])
+        earlier = shapely.linestrings(np.stack([coordinates[:j - 1], coordinates[1:j]], axis=1))
+        crossed = np.flatnonzero(shapely.intersects(earlier, segment))
+        if len(crossed):
+            i = crossed[0]
+            crossing = shapely.get_coordinates(shapely.intersection(earlier[i], segment))[:1]
+            coordinates = np.concatenate([coordinates[:i + 1], crossing, coordinates[j + 1:]])
+            j = i + 2
+        else:
+            j += 1
+    return shapely.LineString(coordinates)
+
+def trim_flowpaths(
+    flowpaths: gpd.GeoSeries,
+    starts: gpd.GeoSeries,
+    roads: gpd.GeoSeries,
+    dem: rasterio.DatasetReader | None = None,
+    tolerance: float = 0.01,
+    min_distance: float = 0.5,
+    snap: float = 0.0,
+) -> gpd.GeoDataFrame:
+    # Flowpaths with an end within `tolerance` of a start point, oriented away from it and cut at their
+    # first crossing of a road after leaving the one they start on, further than `min_distance` along.
+    # Paths crossing no road but ending within `snap` of one are extended to it. START is the row of the
+    # start point (one flowpath per point, the first), TO_ROAD whether the path ends on a road. Paths not
+    # going downhill on `dem` are dropped, those ending off it are kept.
+    lines, points, road_lines = flowpaths.to_numpy(), starts.to_numpy(), roads.to_numpy()
+    point_tree = shapely.STRtree(points)
+
+    with profiling.stage('orient flowpaths'):
+        # Start point at either end, the first end that has one. A path can also end at another drain, so
+        # given a DEM the higher end is the start where both have one.
+        ends = np.stack([shapely.get_point(lines, 0), shapely.get_point(lines, -1)], axis=1)
+        end_index, start = point_tree.query_nearest(ends.reshape(-1), max_distance=tolerance, all_matches=False)
+        start_of = np.full(2 * len(lines), -1)
+        start_of[end_index] = start
+        start_of = start_of.reshape(-1, 2)
+        reverse = (start_of[:, 0] < 0) & (start_of[:, 1] >= 0)
+        if dem is not None:
+            both = np.flatnonzero((start_of >= 0).all(axis=1))
+            elevation = _sample(dem, shapely.get_coordinates(ends[both].reshape(-1))).reshape(-1, 2)
+            reverse[both] = elevation[:, 1] > elevation[:, 0]
+        start_of = np.where(reverse, start_of[:, 1], start_of[:, 0])
+
+        kept = np.flatnonzero(start_of >= 0)
+        kept = kept[np.unique(start_of[kept], return_index=True)[1]] # One flowpath per start point
+        lines, start_of, reverse = lines[kept], start_of[kept], reverse[kept]
+        lines = np.where(reverse, shapely.reverse(lines), lines)
+        # Exactly at the start point, model.data.flowpaths matches on equality
+        xy, line = shapely.get_coordinates(lines, return_index=True)
+        xy[np.searchsorted(line, np.arange(len(lines)))] = shapely.get_coordinates(points[start_of])
+        lines = shapely.linestrings(xy, indices=line)
+
+    with profiling.stage('find road crossings'):
+        road_tree = shapely.STRtree(road_lines)
+        # Crossings only count once the path has left the road it drains from: after its first vertex
+        # that isn't on a road
+        xy, line = shapely.get_coordinates(lines, return_index=True)
+        on_road = np.zeros(len(xy), dtype=bool)
+        on_road[road_tree.query(shapely.points(xy), predicate='dwithin', distance=tolerance)[0]] = True
+        left = np.full(len(lines), np.inf)
+        np.minimum.at(left, line[~on_road], _along(xy, line)[~on_road])
+        path, road = road_tree.query(lines, predicate='intersects')
+
+        # Every vertex of every intersection, located along the path
+        crossings = shapely.intersection(lines[path], road_lines[road])
+        parts, part_of = shapely.get_parts(crossings, return_index=True)
+        part_xy, part_index = shapely.get_coordinates(parts, return_index=True)
+        crossed = path[part_of[part_index]]
+        along = shapely.line_locate_point(lines[crossed], shapely.points(part_xy))
+        beyond = (along > min_distance) & (along >= left[crossed])
+        first = np.full(len(lines), np.inf)
+        np.minimum.at(first, crossed[beyond], along[beyond])
+
+    with profiling.stage('cut flowpaths'):
+        to_road = np.isfinite(first)
+        lines = cut_lines(lines, np.where(to_road, first, np.nan))
+
+        if snap > 0 and not to_road.all():
+            # Extend paths ending just short of a road to their nearest point on it
+            loose = np.flatnonzero(~to_road)
+            end = shapely.get_point(lines[loose], -1)
+            found, nearest = road_tree.query_nearest(end, max_distance=snap, all_matches=False)
+            away = shapely.distance(points[start_of[loose[found]]], road_lines[nearest]) > tolerance
+            found, nearest = found[away], nearest[away]
+            target = shapely.get_coordinates(shapely.line_interpolate_point(road_lines[nearest], shapely.line_locate_point(road_lines[nearest], end[found])))
+            xy, line = shapely.get_coordinates(lines, return_index=True)
+            extended = loose[found]
+            points_xy = np.concatenate([xy, target])
+            index = np.concatenate([line, extended])
+            order = np.argsort(index, kind='stable')
+            lines = shapely.linestrings(points_xy[order], indices=index[order])
+            to_road[extended] = True
+
+        # Repeated vertices (a cut on a vertex) and loops
+        lines = shapely.remove_repeated_points(lines)
+        looping = np.flatnonzero(~shapely.is_simple(lines))
+        lines[looping] = [_erase_loops(line) for line in lines[looping]]
+
+    result = gpd.GeoDataFrame({'START': start_of, 'TO_ROAD': to_road}, geometry=lines, crs=flowpaths.crs)
+    result['LENGTH'] = shapely.length(lines)
+    if dem is not None:
+        elevation = _sample(dem, shapely.get_coordinates(np.stack([shapely.get_point(lines, 0), shapely.get_point(lines, -1)], axis=1).reshape(-1))).reshape(-1, 2)
+        result = result[(elevation[:, 0] > elevation[:, 1]) | np.isnan(elevation[:, 1])] # Or off the DEM
+    return result[result['LENGTH'] > 0].reset_index(drop=True)
@@ -0,0 +1,142 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+import rasterio.windows
+
+from utils import profiling
+from preprocess.mask import overlap_layers, raster_tiles
+
+# Elevation statistics of road segment polygons, the ELEVATION attribute model.data.roads needs.
+# The DEM is read once, tile by tile in rows. Road polygons overlap and a pixel counts towards every
+# polygon it is under (as when every polygon is rasterized on its own), so the polygons are split into
+# layers none of which can share a pixel (see mask.overlap_layers) and every layer is burnt into one
+# label raster per tile. The (polygon, value) pairs are kept until the last tile row a polygon reaches,
+# then the pixels of all polygons done are grouped with a single sort, which gives every statistic (and
+# the quartiles of the IQR-filtered mean) as reductions over contiguous runs. Only the pixels of the
+# polygons crossing the current tile row are ever in memory, however long a polygon is.
+
+STATISTICS = ['count', 'min', 'max', 'std', 'mean', 'fmean']
+
+def group_statistics(labels: np.ndarray, values: np.ndarray, n_labels: int) -> np.ndarray:
+    # (n_labels, len(STATISTICS)) of labels 0 .. n_labels - 1, NaN (count 0) where a label has no values.
+    # fmean is the mean of the values within 1.5 IQR of the quartiles (numpy's linear percentiles).
+    result = np.full((n_labels, len(STATISTICS)), np.nan)
+    result[:, 0] = 0
+    if len(labels) == 0:
+        return result
+    order = np.lexsort((values, labels))
+    labels, values = labels[order], values[order].astype(float)
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    group = labels[starts]
+    count = np.diff(np.r_[starts, len(labels)])
+
+    total = np.add.reduceat(values, starts)
+    mean = total / count
+    deviation = values - np.repeat(mean, count)
+    std = np.sqrt(np.add.reduceat(deviation * deviation, starts) / count)
+
+    def quantile(q: float) -> np.ndarray:
+        position = (count - 1) * q
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, count - 1)
+        return values[starts + low] + (position - low) * (values[starts + high] - values[starts + low])
+
+    q1, q3 = quantile(0.25), quantile(0.75)
+    iqr = q3 - q1
+    kept = (values >= np.repeat(q1 - 1.5 * iqr, count)) & (values <= np.repeat(q3 + 1.5 * iqr, count))
+    run = np.repeat(np.arange(len(starts)), count)
+    fmean = np.bincount(run, np.where(kept, values, 0.0), len(starts)) / np.bincount(run, kept, len(starts))
+
+    result[group] = np.column_stack([count, values[starts], values[starts + count - 1], std, mean, fmean])
+    return result
+
+def zonal_statistics(polygons: np.ndarray, dataset: rasterio.DatasetReader, tile_size: int = 2048, all_touched: bool = False, band: int = 1) -> pd.DataFrame:
+    # STATISTICS of the band under every polygon (in the raster's CRS), one row per polygon
+    transform = dataset.transform
+    n = len(polygons)
+    result = np.full((n, len(STATISTICS)), np.nan)
+    result[:, 0] = 0
+
+    # Last tile row of every polygon, its pixels are complete once that row is done
+    bounds = shapely.bounds(polygons)
+    _, bottom = ~transform * (bounds[:, 0], np.where(transform.e < 0, bounds[:, 1], bounds[:, 3]))
+    last_row = np.clip(np.floor(np.nan_to_num(bottom) / tile_size), 0, None).astype(np.int64)
+    tree = shapely.STRtree(polygons)
+    with profiling.stage('overlap layers'):
+        layer = overlap_layers(polygons, np.hypot(transform.a, transform.e))
+    nodata = dataset.nodatavals[band - 1]
+    done = np.zeros(n, dtype=bool)
+
+    pending_labels, pending_values = [], []
+    tiles = list(raster_tiles(dataset.width, dataset.height, tile_size))
+    for i, tile in enumerate(tiles):
+        burnt = np.sort(tree.query(shapely.box(*rasterio.windows.bounds(tile, transform))))
+        if len(burnt):
+            values = dataset.read(band, window=tile)
+            valid = np.isfinite(values)
+            if nodata is not None:
+                valid &= values != nodata
+            tile_transform = rasterio.windows.transform(tile, transform)
+            for current in np.unique(layer[burnt]):
+                members = burnt[layer[burnt] == current]
+                labels = rasterio.features.rasterize(
+                    zip(polygons[members], members + 1),
+                    out_shape=(tile.height, tile.width),
+                    transform=tile_transform,
+                    fill=0,
+                    all_touched=all_touched,
+                    dtype='int64' if n >= 2 ** 31 - 1 else 'int32',
+                )
+                counted = valid & (labels > 0)
+                pending_labels.append(labels[counted].astype(np.int64) - 1)
+                pending_values.append(values[counted])
+
+        # At the end of a tile row, the polygons ending in it get their statistics
+        if i + 1 == len(tiles) or tiles[i + 1].row_off != tile.row_off:
+            labels, values = np.concatenate(pending_labels or [np.zeros(0, dtype=np.int64)]), np.concatenate(pending_values or [np.zeros(0)])
+            row = tile.row_off // tile_size
+            finished = np.flatnonzero(~done & ((last_row <= row) | (i + 1 == len(tiles))))
+            done[finished] = True
+            complete = done[labels]
+            member = np.searchsorted(finished, labels[complete])
+            result[finished] = group_statistics(member, values[complete], len(finished))
+            pending_labels, pending_values = [labels[~complete]], [values[~complete]]
+
+    return pd.DataFrame(result, columns=STATISTICS).astype({'count': np.int64})
+
+def segment_elevation(roads: gpd.GeoDataFrame, dem_path: Path, buffer: float | None = None, tile_size: int = 2048) -> gpd.GeoDataFrame:
+    # Road segments -> the same segments with ELEVATION (the IQR-filtered mean) and ELE_COUNT, ELE_MIN,
+    # ELE_MAX, ELE_STD, ELE_MEAN of the DEM under the segment buffered by half its WIDTH (or `buffer`).
+    # A segment too small to cover a pixel centre gets the pixel under its centroid.
+    if buffer is None and 'WIDTH' not in roads.columns:
+        raise ValueError("Road segments need a WIDTH attribute or a buffer distance")
+    with rasterio.open(dem_path) as dataset:
+        segments = roads.geometry if dataset.crs is None or roads.crs == dataset.crs else roads.geometry.to_crs(dataset.crs)
+        distance = np.full(len(roads), buffer) if buffer is not None else roads['WIDTH'].to_numpy(dtype=float) / 2
+        with profiling.stage('buffer segments'):
+            polygons = shapely.buffer(segments.to_numpy(), distance, cap_style='flat')
+        with profiling.stage('zonal statistics'):
+            statistics = zonal_statistics(polygons, dataset, tile_size)
+
+        empty = np.flatnonzero(statistics['count'].to_numpy() == 0)
+        if len(empty):
+            points = shapely.get_coordinates(shapely.centroid(segments.to_numpy()[empty]))
+            sampled = np.array([value[0] for value in dataset.sample(points)], dtype=float)
+            if dataset.nodata is not None:
+                sampled[sampled == dataset.nodata] = np.nan
+            for name in ('min', 'max', 'mean', 'fmean'):
+                statistics.loc[empty, name] = sampled
+
+    missing = np.flatnonzero(statistics['fmean'].isna().to_numpy())
+    if len(missing):
+        raise ValueError(f"{len(missing)} road segments have no elevation (outside the DEM or on nodata), e.g. indices {missing[:10].tolist()}")
+
+    result = roads.copy()
+    result['ELEVATION'] = statistics['fmean'].to_numpy()
+    for name in STATISTICS[:-1]:
+        result[f"ELE_{name.upper()}"] = statistics[name].to_numpy()
+    return result
@@ -1,5 +1,6 @@
 import os
 import json
+import math
 from pathlib import Path
 from typing import List, Dict, TypedDict
 
@@ -25,6 +26,55 @@ def get_rainfall_values() -> List[float]:
     except KeyError:
         raise KeyError("'rainfall_values' not found in the configuration file")
 
+class RainfallSourceSettings(TypedDict):
+    path: Path
+    column: str | None # Rainfall column (CSV/Parquet) or variable (NetCDF), raster stacks use every band
+    timestamp_column: str | None
+    storm_id_column: str | None
+    chunk_size: int
+
+def get_rainfall_source() -> RainfallSourceSettings | None:
+    with open(CONFIG_PATH, 'r') as config_file:
+        config_data = json.load(config_file)
+
+        # Optional, 'rainfall_values' is used when there is no rainfall file
+        source = config_data.get('rainfall_source')
+        if source is None:
+            return None
+
+        if not isinstance(source, dict):
+            raise ValueError("rainfall_source must be a dictionary")
+
+        unknown_keys = set(source) - set(RainfallSourceSettings.__annotations__)
+        if unknown_keys:
+            raise ValueError(f"Unknown rainfall_source keys: {unknown_keys}")
+
+        if not isinstance(source.get('path'), str):
+            raise ValueError("rainfall_source path must be a string")
+
+        if not isinstance(source.get('column'), str) and Path(source['path']).suffix.lower() not in ('.tif', '.tiff'):
+            raise ValueError("rainfall_source column must be a string")
+
+        for key in ('column', 'timestamp_column', 'storm_id_column'):
+            if not isinstance(source.get(key), str | None):
+                raise ValueError(f"rainfall_source {key} must be a string")
+
+        chunk_size = source.get('chunk_size', 10000)
+        if not isinstance(chunk_size, int) or isinstance(chunk_size, bool) or chunk_size <= 0:
+            raise ValueError("rainfall_source chunk_size must be a positive integer (number of events)")
+
+        path = Path(source['path'])
+        if not path.is_file():
+            raise FileNotFoundError(f"rainfall_source file:{path} does not exist!")
+
+        return {
+            'path': path,
+            'column': source.get('column'),
+            'timestamp_column': source.get('timestamp_column'),
+            'storm_id_column': source.get('storm_id_column'),
+            'chunk_size': chunk_size
+        }
+
 def get_flowpath_travel_cost() -> float:
     try:
         with open(CONFIG_PATH, 'r') as config_file:
@@ -49,6 +99,242 @@ def get_flowpath_travel_cost() -> float:
     except KeyError:
         raise KeyError("'travel_cost' not found in the configuration file")
 
+def get_simulation_mode() -> str:
+    with open(CONFIG_PATH, 'r') as config_file:
+        config_data = json.load(config_file)
+
+        # Optional, rainfall events are independent of each other unless asked otherwise
+        simulation_mode = config_data.get('simulation_mode', 'independent')
+
+        if simulation_mode not in ('independent', 'continuous', 'ensemble', 'sensitivity'):
+            raise ValueError("simulation_mode must be one of 'independent', 'continuous', 'ensemble' or 'sensitivity'")
+
+        return simulation_mode
+
+def get_sediment_bulk_density() -> float:
+    try:
+        with open(CONFIG_PATH, 'r') as config_file:
+            config_data = json.load(config_file)
+
+            # Extract bulk density (mass per cubic meter, in the same mass unit as erosion_rate)
+            bulk_density = config_data['sediment_bulk_density']
+
+            # Validate type (must be int or float)
+            if not isinstance(bulk_density, (int, float)):
+                raise ValueError("sediment_bulk_density must be a number (int or float)")
+
+            # Validate positive, trapped sediment is divided by it
+            if bulk_density <= 0:
+                raise ValueError("sediment_bulk_density must be a positive number")
+
+            return float(bulk_density)
+
+    except KeyError:
+        raise KeyError("'sediment_bulk_density' not found in the configuration file")
+
+class CheckpointSettings(TypedDict):
+    directory: Path
+    interval: int
+
+def get_checkpoint_settings() -> CheckpointSettings | None:
+    with open(CONFIG_PATH, 'r') as config_file:
+        config_data = json.load(config_file)
+
+        # Optional, runs are only checkpointed when asked to
+        checkpoint = config_data.get('checkpoint')
+        if checkpoint is None:
+            return None
+
+        if not isinstance(checkpoint, dict) or set(checkpoint.keys()) != {'directory', 'interval'}:
+            raise ValueError("checkpoint must have exactly 'directory' and 'interval' keys")
+
+        if not isinstance(checkpoint['directory'], str):
+            raise ValueError("checkpoint directory must be a string")
+
+        # bool is a subclass of int, don't let it through
+        if not isinstance(checkpoint['interval'], int) or isinstance(checkpoint['interval'], bool) or checkpoint['interval'] <= 0:
+            raise ValueError("checkpoint interval must be a positive integer (number of events)")
+
+        return {
+            'directory': Path(checkpoint['directory']),
+            'interval': checkpoint['interval']
+        }
+
+# Coefficients of the pond trapping efficiency curve, see model.graph.EfficiencyCurve
+POND_EFFICIENCY_COEFFICIENTS = ('offset', 'scale', 'shift', 'slope')
+
+def get_model_parameters() -> List[str]:
+    # Names of the model parameters that ensembles and sensitivity analyses can vary.
+    # pond_capacity is a multiplier of every pond's max capacity.
+    return [
+        *(f"{road_type}.{name}" for road_type in get_road_types() for name in RoadTypeData.__annotations__),
+        'travel_cost',
+        'pond_capacity',
+        *(f"pond_efficiency.{name}" for name in POND_EFFICIENCY_COEFFICIENTS),
+    ]
+
+# Parameters of every distribution an uncertain parameter can be sampled from
+DISTRIBUTIONS: Dict[str, set] = {
+    'uniform': {'low', 'high'},
+    'normal': {'mean', 'std'},          # Truncated at 0, mean >= 0
+    'lognormal': {'median', 'sigma'},   # sigma of the underlying normal
+    'triangular': {'low', 'mode', 'high'},
+}
+
+class DistributionData(TypedDict):
+    distribution: str
+    parameters: Dict[str, float]
+
+class UncertaintySettings(TypedDict):
+    samples: int
+    seed: int | None
+    percentiles: List[float]
+    parameters: Dict[str, DistributionData] # See get_model_parameters()
+
+def get_uncertainty_settings() -> UncertaintySettings:
+    try:
+        with open(CONFIG_PATH, 'r') as config_file:
+            config_data = json.load(config_file)
+
+            uncertainty = config_data['uncertainty']
+
+            if not isinstance(uncertainty, dict):
+                raise ValueError("uncertainty must be a dictionary")
+
+            unknown_keys = set(uncertainty) - set(UncertaintySettings.__annotations__)
+            if unknown_keys:
+                raise ValueError(f"Unknown uncertainty keys: {unknown_keys}")
+
+            # bool is a subclass of int, don't let it through
+            samples = uncertainty.get('samples')
+            if not isinstance(samples, int) or isinstance(samples, bool) or samples <= 0:
+                raise ValueError("uncertainty samples must be a positive integer")
+
+            seed = uncertainty.get('seed')
+            if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+                raise ValueError("uncertainty seed must be an integer")
+
+            percentiles = uncertainty.get('percentiles', [5, 50, 95])
+            if not isinstance(percentiles, list) or not all(isinstance(p, (int, float)) and 0 <= p <= 100 for p in percentiles):
+                raise ValueError("uncertainty percentiles must be a list of numbers between 0 and 100")
+
+            parameters = uncertainty.get('parameters', {})
+            if not isinstance(parameters, dict):
+                raise ValueError("uncertainty parameters must be a dictionary")
+
+            known_parameters = get_model_parameters()
+            validated_parameters: Dict[str, DistributionData] = {}
+            for name, distribution in parameters.items():
+                if name not in known_parameters:
+                    raise ValueError(f"Unknown uncertain parameter '{name}', expected one of {known_parameters}")
+
+                if not isinstance(distribution, dict) or distribution.get('distribution') not in DISTRIBUTIONS:
+                    raise ValueError(f"'{name}' must have a 'distribution', one of {list(DISTRIBUTIONS)}")
+
+                kind = distribution['distribution']
+                values = {key: value for key, value in distribution.items() if key != 'distribution'}
+                if set(values) != DISTRIBUTIONS[kind]:
+                    raise ValueError(f"A {kind} distribution for '{name}' must have exactly {sorted(DISTRIBUTIONS[kind])}")
+
+                if not all(isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) for value in values.values()):
+                    raise ValueError(f"The {kind} distribution parameters of '{name}' must be finite numbers")
+
+                # Ranges numpy would reject deep inside a run, or sample NaN from
+                if kind in ('uniform', 'triangular') and values['low'] > values['high']:
+                    raise ValueError(f"The {kind} distribution of '{name}' must have low <= high")
+
+                if kind == 'triangular' and not (values['low'] <= values['mode'] <= values['high'] and values['low'] < values['high']):
+                    raise ValueError(f"The triangular distribution of '{name}' must have low <= mode <= high and low < high")
+
+                if kind == 'normal' and (values['mean'] < 0 or values['std'] < 0):
+                    raise ValueError(f"The normal distribution of '{name}' (truncated at 0) must have mean >= 0 and std >= 0")
+
+                if kind == 'lognormal' and (values['median'] <= 0 or values['sigma'] < 0):
+                    raise ValueError(f"The lognormal distribution of '{name}' must have median > 0 and sigma >= 0")
+
+                validated_parameters[name] = {
+                    'distribution': kind,
+                    'parameters': {key: float(value) for key, value in values.items()}
+                }
+
+            return {
+                'samples': samples,
+                'seed': seed,
+                'percentiles': [float(p) for p in percentiles],
+                'parameters': validated_parameters
+            }
+
+    except KeyError:
+        raise KeyError("'uncertainty' not found in the configuration file")
+
+class SensitivitySettings(TypedDict):
+    method: str     # 'sobol' or 'morris'
+    samples: int    # Base samples (Sobol) or trajectories (Morris)
+    levels: int     # Grid levels of the Morris design
+    seed: int | None
+    parameters: Dict[str, List[float]] # [low, high] of every varied parameter, see get_model_parameters()
+    cache: Path | None
+
+def get_sensitivity_settings() -> SensitivitySettings:
+    try:
+        with open(CONFIG_PATH, 'r') as config_file:
+            config_data = json.load(config_file)
+
+            sensitivity = config_data['sensitivity']
+
+            if not isinstance(sensitivity, dict):
+                raise ValueError("sensitivity must be a dictionary")
+
+            unknown_keys = set(sensitivity) - set(SensitivitySettings.__annotations__)
+            if unknown_keys:
+                raise ValueError(f"Unknown sensitivity keys: {unknown_keys}")
+
+            method = sensitivity.get('method', 'sobol')
+            if method not in ('sobol', 'morris'):
+                raise ValueError("sensitivity method must be either 'sobol' or 'morris'")
+
+            # bool is a subclass of int, don't let it through
+            for key, minimum, default in (('samples', 1, 64), ('levels', 2, 4)):
+                value = sensitivity.get(key, default)
+                if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+                    raise ValueError(f"sensitivity {key} must be an integer of at least {minimum}")
+
+            seed = sensitivity.get('seed')
+            if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+                raise ValueError("sensitivity seed must be an integer")
+
+            parameters = sensitivity.get('parameters')
+            if not isinstance(parameters, dict) or not parameters:
+                raise ValueError("sensitivity parameters must be a dictionary of at least one parameter")
+
+            known_parameters = get_model_parameters()
+            for name, bounds in parameters.items():
+                if name not in known_parameters:
+                    raise ValueError(f"Unknown sensitivity parameter '{name}', expected one of {known_parameters}")
+
+                if (
+                    not isinstance(bounds, list) or len(bounds) != 2
+                    or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in bounds)
+                    or bounds[0] >= bounds[1]
+                ):
+                    raise ValueError(f"sensitivity bounds of '{name}' must be [low, high] with low < high")
+
+            cache = sensitivity.get('cache')
+            if cache is not None and not isinstance(cache, str):
+                raise ValueError("sensitivity cache must be a string (directory)")
+
+            return {
+                'method': method,
+                'samples': sensitivity.get('samples', 64),
+                'levels': sensitivity.get('levels', 4),
+                'seed': seed,
+                'parameters': {name: [float(low), float(high)] for name, (low, high) in parameters.items()},
+                'cache': None if cache is None else Path(cache)
+            }
+
+    except KeyError:
+        raise KeyError("'sensitivity' not found in the configuration file")
+
 class RoadTypeData(TypedDict):
     runoff_coefficient: float
     erosion_rate: float
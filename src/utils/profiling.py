@@ -0,0 +1,205 @@
+import cProfile
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, ContextManager, Dict, Iterator, List, TypeVar
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Stage and hot-function instrumentation, off unless enable() is called (roadconnect --profile).
+# Stages are nested blocks (loading a data layer, tracing flowpaths, a batch of events) with wall
+# time, CPU time and peak RSS. Hot functions are decorated with @timed and only count calls and time.
+# Both cost nothing but a check of a global when profiling is off.
+#
+# Peak RSS is per stage on Linux, where the high-water mark can be reset when a stage starts.
+# Elsewhere it's the process' high-water mark at the end of the stage.
+
+F = TypeVar('F', bound=Callable)
+
+def _peak_rss() -> float | None:
+    # High-water mark of the resident set size in MiB
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, KiB elsewhere
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+@dataclass
+class StageRecord:
+    name: str
+    parent: int | None          # Index of the enclosing stage
+    depth: int
+    start: float                # Seconds since profiling started
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0    # Process CPU time, every thread
+    peak_rss_mb: float | None = None
+
+@dataclass
+class FunctionRecord:
+    calls: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+
+@dataclass
+class Profiler:
+    cprofile: cProfile.Profile | None = None
+    started: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    start_wall: float = field(default_factory=time.perf_counter)
+    start_cpu: float = field(default_factory=time.process_time)
+    stages: List[StageRecord] = field(default_factory=list)
+    functions: Dict[str, FunctionRecord] = field(default_factory=dict)
+    events: List[tuple[str, int, float]] = field(default_factory=list) # ('O'/'C', stage, seconds) for speedscope
+    per_stage_rss: bool = True
+    __open: List[tuple[int, float, float]] = field(default_factory=list) # Open stages with their start wall/CPU
+    __peaks: Dict[int, float] = field(default_factory=dict) # Highest RSS seen so far in every open stage
+    __lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __now(self) -> float: return time.perf_counter() - self.start_wall
+
+    def __fold_peak(self) -> float | None:
+        # Everything since the last reset counts towards every open stage
+        peak = _peak_rss()
+        if peak is not None:
+            for index, _, _ in self.__open:
+                self.__peaks[index] = max(self.__peaks.get(index, 0.0), peak)
+        return peak
+
+    def enter(self, name: str) -> None:
+        self.__fold_peak()
+        self.per_stage_rss &= _reset_peak_rss()
+
+        index = len(self.stages)
+        parent = self.__open[-1][0] if self.__open else None
+        self.stages.append(StageRecord(name=name, parent=parent, depth=len(self.__open), start=self.__now()))
+        self.__open.append((index, time.perf_counter(), time.process_time()))
+        self.events.append(('O', index, self.stages[index].start))
+
+    def exit(self) -> None:
+        self.__fold_peak()
+        index, wall, cpu = self.__open.pop()
+        record = self.stages[index]
+        record.wall_seconds = time.perf_counter() - wall
+        record.cpu_seconds = time.process_time() - cpu
+        record.peak_rss_mb = self.__peaks.pop(index, None)
+        self.events.append(('C', index, self.__now()))
+
+    def add_call(self, name: str, wall: float, cpu: float) -> None:
+        with self.__lock: # Hot functions also run on worker threads
+            record = self.functions.setdefault(name, FunctionRecord())
+            record.calls += 1
+            record.wall_seconds += wall
+            record.cpu_seconds += cpu
+
+    def report(self) -> Dict[str, object]:
+        return {
+            'command': sys.argv,
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall_seconds': time.perf_counter() - self.start_wall,
+            'cpu_seconds': time.process_time() - self.start_cpu,
+            'peak_rss_mb': max([_peak_rss() or 0.0] + [stage.peak_rss_mb or 0.0 for stage in self.stages]),
+            'per_stage_rss': self.per_stage_rss,
+            'stages': [asdict(stage) for stage in self.stages],
+            'functions': {name: asdict(record) for name, record in sorted(self.functions.items(), key=lambda item: -item[1].wall_seconds)},
+        }
+
+    def write(self, path: Path) -> None:
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=4)
+
+    def write_pstats(self, path: Path) -> None:
+        if self.cprofile is None:
+            raise RuntimeError("Profiling was enabled without cProfile")
+        self.cprofile.create_stats()
+        self.cprofile.dump_stats(path)
+
+    def write_speedscope(self, path: Path) -> None:
+        # The stage timeline as an evented profile, open it at https://www.speedscope.app
+        end = self.__now()
+        speedscope = {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': 'roadconnect',
+            'exporter': 'roadconnect',
+            'shared': {'frames': [{'name': stage.name} for stage in self.stages]},
+            'profiles': [{
+                'type': 'evented',
+                'name': 'stages',
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': end,
+                'events': [{'type': kind, 'frame': index, 'at': at} for kind, index, at in self.events]
+                    + [{'type': 'C', 'frame': index, 'at': end} for index, _, _ in reversed(self.__open)],
+            }],
+        }
+        with open(path, 'w') as speedscope_file:
+            json.dump(speedscope, speedscope_file)
+
+_profiler: Profiler | None = None
+
+def enable(use_cprofile: bool = False) -> Profiler:
+    global _profiler
+    _profiler = Profiler(cprofile=cProfile.Profile() if use_cprofile else None)
+    if _profiler.cprofile is not None:
+        _profiler.cprofile.enable()
+    return _profiler
+
+def disable() -> Profiler | None:
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None and profiler.cprofile is not None:
+        profiler.cprofile.disable()
+    return profiler
+
+def active() -> Profiler | None:
+    return _profiler
+
+@contextmanager
+def _stage(profiler: Profiler, name: str) -> Iterator[None]:
+    profiler.enter(name)
+    try:
+        yield
+    finally:
+        profiler.exit()
+
+def stage(name: str) -> ContextManager[None]:
+    # with profiling.stage('load roads'): ...
+    return nullcontext() if _profiler is None else _stage(_profiler, name)
+
+def timed(function: F) -> F:
+    # Counts calls and time of a hot function while profiling
+    name = f"{function.__module__}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = _profiler
+        if profiler is None:
+            return function(*args, **kwargs)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.add_call(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    return wrapper # type: ignore[return-value]
@@ -0,0 +1,67 @@
+import os
+import shutil
+from pathlib import Path
+from typing import Callable
+import numpy as np
+import shapely
+import pytest
+
+from model.graph import Graph, NodeType
+from model.engine import Topology, build_topology
+from utils import config
+
+REPOSITORY = Path(__file__).resolve().parents[1]
+
+# The model reads its configuration and input files from the working directory and writes next to
+# them as it loads, so the bundled watershed is loaded once from a copy.
+
+@pytest.fixture(scope='session')
+def bundled(tmp_path_factory: pytest.TempPathFactory) -> tuple[Graph, Topology]:
+    directory = tmp_path_factory.mktemp('bundled')
+    shutil.copytree(REPOSITORY / 'config', directory / 'config')
+    shutil.copytree(REPOSITORY / 'user_data', directory / 'user_data')
+
+    cwd, config_path = os.getcwd(), config.CONFIG_PATH
+    os.chdir(directory)
+    config.CONFIG_PATH = str(directory / 'config' / 'config.json')
+    try:
+        from model import data
+        graph = Graph()
+        graph.add_nodes(data.drains.get_nodes())
+        graph.add_nodes(data.ponds.get_nodes())
+        yield graph, build_topology(graph)
+    finally:
+        os.chdir(cwd)
+        config.CONFIG_PATH = config_path
+
+@pytest.fixture
+def random_topology() -> Callable[[int, int], Topology]:
+    # A random forest of n nodes in topological order (every child comes after its parents), with a
+    # few ponds, some of them partly full, and costs spread around the runoff of ordinary storms
+    def build(seed: int, n: int) -> Topology:
+        rng = np.random.default_rng(seed)
+        child = np.where(rng.random(n) < 0.85, np.arange(n) + 1 + rng.integers(0, 10, n), -1)
+        child[child >= n] = -1
+        routed = child >= 0
+        is_pond = routed & (rng.random(n) < 0.1)
+        max_capacity = np.where(is_pond, rng.uniform(1, 20, n), 0.0)
+
+        local = np.where(is_pond | ~routed, 0.0, 1.0)[:, None]
+        topology = Topology(
+            points=list(shapely.points(np.arange(n), np.zeros(n))),
+            node_type=np.where(is_pond, NodeType.POND.value, np.where(routed, NodeType.DRAIN.value, NodeType.TERMINATION.value)),
+            child=child,
+            distance_to_child=np.where(routed, rng.uniform(1, 100, n), 0.0),
+            cost_to_connect_child=np.zeros(n),
+            road_types=['sand', 'dirt', 'gravel'],
+            local_area=local * rng.uniform(0, 500, (n, 3)),
+            local_length=local * rng.uniform(0, 50, (n, 3)),
+            runoff_coefficient=np.array([0.11, 0.22, 0.33]),
+            erosion_rate=np.array([0.003, 4.15, 5.35]),
+            max_capacity=max_capacity,
+            used_capacity=max_capacity * rng.choice([0, 0.5], n),
+        )
+        topology.cost_to_connect_child = topology.distance_to_child * 0.01
+        topology.build_levels()
+        return topology
+    return build
@@ -0,0 +1,101 @@
+import dataclasses
+from pathlib import Path
+import numpy as np
+import pytest
+
+from model import checkpoint, engine
+
+# A continuous run killed part way (after an event, or between writing a checkpoint's log and its state)
+# and resumed from its checkpoints against the same run uninterrupted, the way ModelRunner drives it
+
+BULK_DENSITY = 1600
+
+class Killed(Exception):
+    pass
+
+def run(topology: engine.Topology, rainfall: np.ndarray, checkpointer: checkpoint.Checkpointer, kill_after: int | None = None) -> tuple:
+    saved = checkpointer.load() or checkpoint.Checkpoint(next_event=0, aggregates=engine.EventAggregates.empty(topology.n_nodes), log=engine.EventLog())
+    aggregates, log = saved.aggregates, saved.log
+    state = engine.PondState(saved.next_event, saved.used_capacity if saved.used_capacity is not None else topology.used_capacity.copy())
+
+    def on_event(state: engine.PondState, result: engine.EventResults) -> None:
+        event = state.next_event - 1
+        aggregates.add(result)
+        log.add(event, topology, result, {'storm_id': np.array([f"s{event // 3}"])})
+        checkpointer.save_if_due(state.next_event, aggregates, log, state.used_capacity)
+        if state.next_event == kill_after:
+            raise Killed
+
+    engine.run_continuous(topology, rainfall[state.next_event:], BULK_DENSITY, state, on_event=on_event)
+    return aggregates, log, state
+
+def checkpointer(directory: Path, topology: engine.Topology, n_events: int, key: bytes = b'rain', bulk_density: float = BULK_DENSITY) -> checkpoint.Checkpointer:
+    return checkpoint.Checkpointer(directory, 5, 'continuous', key, n_events, topology, {'sediment_bulk_density': bulk_density})
+
+@pytest.mark.parametrize('kill', ['after event', 'between files'])
+def test_resume(bundled, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, kill: str) -> None:
+    _, topology = bundled
+    rainfall = np.random.default_rng(0).uniform(0, 150, 42)
+    aggregates, log, state = run(topology, rainfall, checkpointer(tmp_path / 'whole', topology, len(rainfall)))
+
+    directory = tmp_path / 'killed'
+    if kill == 'after event':
+        with pytest.raises(Killed):
+            run(topology, rainfall, checkpointer(directory, topology, len(rainfall)), kill_after=23)
+    else:
+        # The log of the checkpoint at event 15 is written, its state isn't
+        save_atomically = checkpoint.save_atomically
+        def failing(path: Path, arrays: dict) -> None:
+            if path.name == 'continuous.npz' and int(arrays['next_event']) == 15:
+                raise Killed
+            save_atomically(path, arrays)
+        monkeypatch.setattr(checkpoint, 'save_atomically', failing)
+        with pytest.raises(Killed):
+            run(topology, rainfall, checkpointer(directory, topology, len(rainfall)))
+        monkeypatch.undo()
+        assert (directory / 'continuous.log.10.npz').is_file()
+
+    resumed = checkpointer(directory, topology, len(rainfall))
+    assert resumed.load().next_event == (20 if kill == 'after event' else 10)
+    resumed_aggregates, resumed_log, resumed_state = run(topology, rainfall, resumed)
+
+    assert resumed_state.next_event == resumed_aggregates.n_events == len(rainfall)
+    np.testing.assert_allclose(resumed_state.used_capacity, state.used_capacity, rtol=1e-12)
+    for f in dataclasses.fields(engine.EventAggregates):
+        np.testing.assert_allclose(getattr(resumed_aggregates, f.name), getattr(aggregates, f.name), rtol=1e-12)
+    frame = resumed_log.to_frame()
+    assert frame['event'].tolist() == list(range(len(rainfall)))
+    assert frame['storm_id'].tolist() == log.to_frame()['storm_id'].tolist()
+    np.testing.assert_allclose(frame['sediment_out'], log.to_frame()['sediment_out'], rtol=1e-12)
+
+    # Every log file only has the events since the previous checkpoint, and the last checkpoint loads
+    # the whole log back
+    with np.load(directory / 'continuous.npz') as saved:
+        log_files = saved['log_files'].tolist()
+    assert log_files == list(range(0, len(rainfall), 5))
+    for first in log_files:
+        with np.load(directory / f"continuous.log.{first}.npz") as rows:
+            assert rows['event'].tolist() == list(range(first, min(first + 5, len(rainfall))))
+    loaded = checkpointer(directory, topology, len(rainfall)).load()
+    assert loaded.log.to_frame().equals(frame)
+
+def test_fingerprint(random_topology, tmp_path: Path) -> None:
+    topology = random_topology(0, 50)
+    log = engine.EventLog()
+    log.add(0, topology, engine.run_events(topology, [10.0, 20.0]), {})
+    aggregates = engine.EventAggregates.empty(topology.n_nodes)
+    checkpointer(tmp_path, topology, 10).save(2, aggregates, log, topology.used_capacity)
+    assert checkpointer(tmp_path, topology, 10).load().next_event == 2
+
+    # A checkpoint of different rainfall, settings or network isn't resumed
+    changed = dataclasses.replace(topology, max_capacity=topology.max_capacity * 2)
+    for other in (
+        checkpointer(tmp_path, topology, 10, key=b'other rain'),
+        checkpointer(tmp_path, topology, 10, bulk_density=1500),
+        checkpoint.Checkpointer(tmp_path, 5, 'continuous', b'rain', 10, topology),
+        checkpointer(tmp_path, changed, 10),
+    ):
+        with pytest.raises(ValueError):
+            other.load()
+    with pytest.raises(ValueError):
+        checkpoint.Checkpointer(tmp_path, 0, 'continuous', b'rain', 10, topology)
@@ -0,0 +1,54 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+import pytest
+
+from preprocess.contributing import contributing_areas, contributing_segments
+from tests.test_drains import lattice, touching
+
+# Contributing segments against walking every segment down to its lowest touching neighbour
+
+def walk(roads: gpd.GeoDataFrame, drain_segments: dict) -> list:
+    # Drain row every segment ends up at, -1 for none. drain_segments maps a segment to its drain row.
+    elevation = roads['ELEVATION'].to_numpy()
+    neighbours = touching(roads.geometry.to_numpy())
+    labels = []
+    for segment in range(len(roads)):
+        while segment not in drain_segments:
+            lower = [j for j in neighbours[segment] if elevation[j] < elevation[segment]]
+            if not lower:
+                break
+            segment = min(lower, key=lambda j: (elevation[j], j))
+        labels.append(drain_segments.get(segment, -1))
+    return labels
+
+@pytest.mark.parametrize('seed', range(3))
+def test_contributing_segments(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    roads = lattice(rng)
+    segments = rng.choice(len(roads), 15, replace=False)
+    segments = np.append(segments, segments[0]) # The first of two drains on a segment gets it
+    drains = gpd.GeoSeries(shapely.line_interpolate_point(roads.geometry.to_numpy()[segments], rng.uniform(0.2, 0.8, len(segments)), normalized=True), crs=roads.crs)
+
+    drain_segments = {}
+    for row, segment in enumerate(segments):
+        drain_segments.setdefault(int(segment), row)
+    assert contributing_segments(roads, drains).tolist() == walk(roads, drain_segments)
+
+def test_drains_off_the_roads() -> None:
+    roads = lattice(np.random.default_rng(0))
+    with pytest.raises(ValueError):
+        contributing_segments(roads, gpd.GeoSeries([shapely.Point(0.5, 0.5)], crs=roads.crs))
+
+def test_contributing_areas() -> None:
+    roads = lattice(np.random.default_rng(0))
+    drain = np.random.default_rng(1).integers(-1, 4, len(roads))
+    areas = contributing_areas(roads, drain, buffer=0.25)
+
+    assert areas['DRAIN'].tolist() == [0, 1, 2, 3]
+    for _, row in areas.iterrows():
+        members = roads.geometry.to_numpy()[drain == row['DRAIN']]
+        assert row['SEGMENTS'] == len(members)
+        np.testing.assert_allclose(row['LENGTH'], shapely.length(members).sum())
+        np.testing.assert_allclose(row['AREA'], shapely.area(shapely.buffer(members, 0.25, cap_style='flat')).sum())
+        assert row.geometry.symmetric_difference(shapely.union_all(shapely.buffer(members, 0.25, cap_style='flat'))).area < 1e-9
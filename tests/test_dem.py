@@ -0,0 +1,106 @@
+import zipfile
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+import pytest
+
+from preprocess import dem
+
+# Mosaics of small overlapping tiles against what every output pixel should take
+
+CRS_UTM = CRS.from_epsg(32619)
+
+def write_tile(path: Path, left: float, top: float, value: float, size: int = 40, hole: bool = False) -> None:
+    data = np.full((size, size), value, dtype='float32')
+    if hole:
+        data[5:15, 25:35] = -1
+    with rasterio.open(path, 'w', driver='GTiff', count=1, height=size, width=size, dtype='float32', crs=CRS_UTM, transform=from_origin(left, top, 1, 1), nodata=-1) as dst:
+        dst.write(data, 1)
+
+@pytest.fixture
+def tiles(tmp_path: Path) -> Path:
+    # a covers x 0-40, y 0-40, b covers x 20-60, y 10-50 and comes later, with a hole over a
+    directory = tmp_path / 'tiles'
+    directory.mkdir()
+    write_tile(directory / 'a.tif', 0, 40, 1)
+    write_tile(directory / 'b.tif', 20, 50, 2, hole=True)
+    return directory
+
+def expected(extent: shapely.Geometry, transform, shape: tuple) -> np.ndarray:
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    x, y = transform * (cols + 0.5, rows + 0.5)
+    in_a = (x < 40) & (y < 40)
+    in_b = (x > 20) & (y > 10) & ~((x > 45) & (x < 55) & (y > 35) & (y < 45))
+    result = np.where(in_b, 2.0, np.where(in_a, 1.0, dem.NODATA))
+    return np.where(shapely.contains_xy(extent, x, y), result, dem.NODATA)
+
+@pytest.mark.parametrize('window_size', [7, 512])
+def test_mosaic(tiles: Path, tmp_path: Path, window_size: int) -> None:
+    source = dem.DirectoryTiles(tiles)
+    extent = shapely.Polygon([(2.2, 2.3), (57.7, 8.1), (50.3, 47.6), (4.1, 30.2)])
+    found = source.tiles(extent, CRS_UTM)
+    assert [tile.name for tile in found] == ['a.tif', 'b.tif']
+    assert source.tiles(shapely.box(100, 100, 110, 110), CRS_UTM) == []
+
+    output = tmp_path / 'mosaic.tif'
+    dem.mosaic([dem.fetch(tile, tmp_path) for tile in found], extent, CRS_UTM, 1.0, output, workers=2, window_size=window_size)
+    with rasterio.open(output) as src:
+        assert src.bounds == (2, 2, 58, 48)
+        np.testing.assert_array_equal(src.read(1), expected(extent, src.transform, src.shape))
+
+def test_prepare_dem(tiles: Path, tmp_path: Path) -> None:
+    source = dem.DirectoryTiles(tiles)
+    extent = shapely.box(10, 6, 50, 44)
+    output = dem.prepare_dem(source, extent, CRS_UTM, 1.0, tmp_path / 'store', workers=2)
+    with rasterio.open(output) as src:
+        assert src.res == (1.0, 1.0) and src.bounds == (10, 6, 50, 44)
+        assert src.profile['tiled']
+        np.testing.assert_array_equal(src.read(1), expected(extent, src.transform, src.shape))
+    modified = output.stat().st_mtime_ns
+    assert dem.prepare_dem(source, extent, CRS_UTM, 1.0, tmp_path / 'store', workers=2) == output
+    assert output.stat().st_mtime_ns == modified
+    assert dem.prepare_dem(source, extent, CRS_UTM, 2.0, tmp_path / 'store', workers=2) != output
+    with pytest.raises(ValueError):
+        dem.prepare_dem(source, shapely.box(100, 100, 110, 110), CRS_UTM, 1.0, tmp_path / 'store')
+
+def test_indexed_tiles(tiles: Path, tmp_path: Path) -> None:
+    # Relative locations are relative to the index, and a tile listed twice is fetched once
+    with zipfile.ZipFile(tiles / 'b.zip', 'w') as archive:
+        archive.write(tiles / 'b.tif', 'b.tif')
+    index = gpd.GeoDataFrame({'url': ['a.tif', 'b.zip', 'b.zip']}, geometry=[shapely.box(0, 0, 40, 40), shapely.box(20, 10, 60, 50), shapely.box(20, 10, 60, 50)], crs=CRS_UTM)
+    index.to_file(tiles / 'index.gpkg')
+    source = dem.open_source(str(tiles / 'index.gpkg'))
+    found = source.tiles(shapely.box(30, 20, 35, 25), CRS_UTM)
+    assert [tile.location for tile in found] == [str(tiles / 'a.tif'), str(tiles / 'b.zip')]
+
+    paths = dem.fetch_all(found, tmp_path / 'store', workers=2)
+    assert paths[0] == tiles / 'a.tif'
+    with rasterio.open(paths[1]) as src:
+        assert src.read(1)[0, 0] == 2
+    with pytest.raises(ValueError):
+        dem.IndexedTiles(str(tiles / 'index.gpkg'), url_column='href')
+
+def test_fetch_same_names(tmp_path: Path) -> None:
+    # Zipped tiles sharing a name under different paths are extracted to different places
+    tiles = []
+    for value, folder in enumerate(['x', 'y'], 1):
+        (tmp_path / folder).mkdir()
+        write_tile(tmp_path / folder / 'tile.tif', 0, 40, value)
+        with zipfile.ZipFile(tmp_path / folder / 'tile.zip', 'w') as archive:
+            archive.write(tmp_path / folder / 'tile.tif', 'tile.tif')
+        tiles.append(dem.Tile('tile.zip', str(tmp_path / folder / 'tile.zip'), shapely.box(0, 0, 40, 40)))
+    paths = dem.fetch_all(tiles, tmp_path / 'store', workers=2)
+    assert paths[0] != paths[1]
+    for value, path in enumerate(paths, 1):
+        with rasterio.open(path) as src:
+            assert src.read(1)[0, 0] == value
+
+def test_sources_need_tiles() -> None:
+    class Incomplete(dem.TileSource):
+        pass
+    with pytest.raises(TypeError):
+        Incomplete()
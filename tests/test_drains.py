@@ -0,0 +1,51 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+import pytest
+
+from preprocess.drains import adjacency, local_minima, natural_drains
+
+# Natural drains against comparing every segment with every other
+
+def lattice(rng: np.random.Generator, size: int = 12) -> gpd.GeoDataFrame:
+    # Unit segments of a grid of roads, touching at their ends, with few distinct elevations so that
+    # there are ties and flats
+    horizontal = [shapely.LineString([(x, y), (x + 1, y)]) for x in range(size) for y in range(size + 1)]
+    vertical = [shapely.LineString([(x, y), (x, y + 1)]) for x in range(size + 1) for y in range(size)]
+    segments = np.array(horizontal + vertical)
+    segments = segments[rng.random(len(segments)) < 0.8]
+    return gpd.GeoDataFrame({'ELEVATION': rng.integers(0, 8, len(segments)).astype(float)}, geometry=segments, crs='EPSG:32619')
+
+def touching(geometries: np.ndarray) -> list:
+    return [[j for j in range(len(geometries)) if geometries[i].touches(geometries[j])] for i in range(len(geometries))]
+
+@pytest.mark.parametrize('seed', range(3))
+def test_adjacency(seed: int) -> None:
+    geometries = lattice(np.random.default_rng(seed)).geometry.to_numpy()
+    indptr, indices = adjacency(geometries)
+    assert [indices[indptr[i]:indptr[i + 1]].tolist() for i in range(len(geometries))] == touching(geometries)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_natural_drains(seed: int) -> None:
+    roads = lattice(np.random.default_rng(seed))
+    elevation = roads['ELEVATION'].to_numpy()
+    expected = [
+        i for i, neighbours in enumerate(touching(roads.geometry.to_numpy()))
+        if neighbours and all(elevation[i] < elevation[j] for j in neighbours)
+    ]
+
+    indptr, indices = adjacency(roads.geometry.to_numpy())
+    assert np.flatnonzero(local_minima(indptr, indices, elevation)).tolist() == expected
+
+    drains = natural_drains(roads)
+    assert drains['SEGMENT'].tolist() == expected
+    np.testing.assert_array_equal(drains['ELEVATION'], elevation[expected])
+    assert np.all(shapely.distance(drains.geometry.to_numpy(), roads.geometry.to_numpy()[expected]) < 1e-9)
+
+def test_natural_drains_need_elevation() -> None:
+    roads = lattice(np.random.default_rng(0))
+    with pytest.raises(ValueError):
+        natural_drains(roads.drop(columns='ELEVATION'))
+    roads.loc[0, 'ELEVATION'] = np.nan
+    with pytest.raises(ValueError):
+        natural_drains(roads)
@@ -0,0 +1,144 @@
+from collections import Counter
+from typing import Dict
+import numpy as np
+import pytest
+
+from model import engine
+from model.graph import Graph, NodeType, pond_efficiency
+from utils import config
+
+# The batched engine against the per-node graph walk it replaced: every node in topological order
+# adds its local runoff and sediment, a pond traps up to its available capacity (and sediment by its
+# efficiency), and the share of runoff above the flowpath's cost carries everything on to the child.
+
+def reference_event(graph: Graph, rainfall: float | Dict, travel_cost: float | None = None) -> Dict[str, Dict]:
+    road_types = config.get_road_types()
+    runoff: Dict = {}
+    sediment: Dict = {}
+    area: Dict = {}
+    result: Dict[str, Dict] = {name: {} for name in ('runoff', 'sediment', 'volume', 'connected', 'trapped_sediment', 'area')}
+
+    for point in graph.get_topological_order():
+        node = graph.get_node(point)
+        depth = rainfall[point] if isinstance(rainfall, dict) else rainfall
+        runoff.setdefault(point, Counter())
+        sediment.setdefault(point, Counter())
+        area[point] = area.get(point, 0.0) + sum(node.road._local_area.values())
+        for road_type, road_area in node.road._local_area.items():
+            runoff[point][road_type] += road_area * depth / 1000 * road_types[road_type]['runoff_coefficient']
+            sediment[point][road_type] += road_area * depth / 1000 * road_types[road_type]['erosion_rate']
+
+        trapped_sediment = 0.0
+        if node.node_type == NodeType.POND:
+            available = node.pond.max_capacity - node.pond.used_capacity
+            runoff_in, sediment_in = sum(runoff[point].values()), sum(sediment[point].values())
+            runoff_out = runoff_in - min(available, runoff_in)
+            efficiency = float(pond_efficiency(available, runoff_in, runoff_out))
+            trapped_sediment = sediment_in * efficiency
+            for road_type in runoff[point]:
+                runoff[point][road_type] *= runoff_out / runoff_in if runoff_in else 1.0
+                sediment[point][road_type] *= 1 - efficiency
+
+        volume = 0.0
+        if node.child is not None:
+            total = sum(runoff[point].values())
+            cost = node.cost_to_connect_child if travel_cost is None else travel_cost * node.distance_to_child
+            volume = max(0.0, total - cost)
+            if volume > 0:
+                percent = volume / total
+                child = node.child
+                runoff.setdefault(child, Counter())
+                sediment.setdefault(child, Counter())
+                for road_type in runoff[point]:
+                    runoff[child][road_type] += runoff[point][road_type] * percent
+                    sediment[child][road_type] += sediment[point][road_type] * percent
+                area[child] = area.get(child, 0.0) + area[point]
+
+        result['runoff'][point] = sum(runoff[point].values())
+        result['sediment'][point] = sum(sediment[point].values())
+        result['volume'][point] = volume
+        result['connected'][point] = volume > 0
+        result['trapped_sediment'][point] = trapped_sediment
+        result['area'][point] = area[point]
+    return result
+
+def assert_matches(topology: engine.Topology, results: engine.EventResults, event: int, reference: Dict[str, Dict]) -> None:
+    points = topology.points
+    np.testing.assert_allclose(results.runoff_sum[event], [reference['runoff'][point] for point in points], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(results.sediment_sum[event], [reference['sediment'][point] for point in points], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(results.volume_reaching_child[event], [reference['volume'][point] for point in points], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(results.trapped_sediment[event], [reference['trapped_sediment'][point] for point in points], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(results.contributing_area[event], [reference['area'][point] for point in points], rtol=1e-9)
+    np.testing.assert_array_equal(results.connected[event], [reference['connected'][point] for point in points])
+
+def test_bundled_events_match_graph(bundled) -> None:
+    graph, topology = bundled
+    rainfall = config.get_rainfall_values() + [0.0, 200.0, 1000.0]
+    results = engine.run_events(topology, rainfall)
+    assert results.connected.any()
+    for event, depth in enumerate(rainfall):
+        assert_matches(topology, results, event, reference_event(graph, depth))
+
+def test_bundled_spatial_rainfall_matches_graph(bundled) -> None:
+    graph, topology = bundled
+    rainfall = np.random.default_rng(0).uniform(0, 300, (4, topology.n_nodes))
+    results = engine.run_events(topology, rainfall)
+    for event in range(len(rainfall)):
+        assert_matches(topology, results, event, reference_event(graph, dict(zip(topology.points, rainfall[event]))))
+
+def test_bundled_travel_cost_override(bundled) -> None:
+    graph, topology = bundled
+    results = engine.run_events(topology, [60.0, 60.0], travel_cost=np.array([0.001, 0.05]))
+    for event, travel_cost in enumerate([0.001, 0.05]):
+        assert_matches(topology, results, event, reference_event(graph, 60.0, travel_cost))
+
+@pytest.mark.parametrize('seed', range(3))
+def test_batches_are_independent(random_topology, seed: int) -> None:
+    # A batch is the same as its events run one at a time
+    topology = random_topology(seed, 300)
+    rainfall = np.random.default_rng(seed).uniform(0, 150, 16)
+    batch = engine.run_events(topology, rainfall)
+    for event, depth in enumerate(rainfall):
+        single = engine.run_events(topology, [depth])
+        np.testing.assert_allclose(batch.runoff[event], single.runoff[0], rtol=1e-12)
+        np.testing.assert_allclose(batch.sediment[event], single.sediment[0], rtol=1e-12)
+        np.testing.assert_array_equal(batch.connected[event], single.connected[0])
+
+    # Batches of any size add up to the same totals
+    whole, batched = engine.EventAggregates.empty(topology.n_nodes), engine.EventAggregates.empty(topology.n_nodes)
+    whole.add(batch)
+    for first in range(0, len(rainfall), 5):
+        batched.add(engine.run_events(topology, rainfall[first:first + 5]))
+    assert batched.n_events == whole.n_events == len(rainfall)
+    np.testing.assert_allclose(batched.sediment, whole.sediment, rtol=1e-12)
+    np.testing.assert_array_equal(batched.events_connected, whole.events_connected)
+    assert engine.batch_size(topology, 300 * 3 * 7) == 7
+
+def fresh_state(topology: engine.Topology) -> engine.PondState:
+    return engine.PondState(next_event=0, used_capacity=topology.used_capacity.copy())
+
+def test_continuous_fills_ponds(bundled) -> None:
+    _, topology = bundled
+    rainfall = np.full(20, 80.0)
+    used = []
+    state = engine.run_continuous(topology, rainfall, 1600, fresh_state(topology), on_event=lambda state, result: used.append(state.used_capacity.copy()))
+    assert state.next_event == len(used) == len(rainfall)
+    assert np.all(np.diff(used, axis=0) >= 0)
+    assert np.all(state.used_capacity <= topology.max_capacity)
+    assert np.any(state.used_capacity[topology.is_pond] > topology.used_capacity[topology.is_pond])
+    with pytest.raises(ValueError):
+        engine.run_continuous(topology, rainfall, 0, fresh_state(topology))
+
+def test_continuous_resumes(bundled) -> None:
+    # Running a series chunk by chunk from the same state is the same as one run
+    _, topology = bundled
+    rainfall = np.random.default_rng(0).uniform(0, 150, 30)
+    whole, chunked = engine.EventAggregates.empty(topology.n_nodes), engine.EventAggregates.empty(topology.n_nodes)
+    state = engine.run_continuous(topology, rainfall, 1600, fresh_state(topology), on_event=lambda state, result: whole.add(result))
+    resumed = fresh_state(topology)
+    for chunk in (rainfall[:12], rainfall[12:25], rainfall[25:]):
+        resumed = engine.run_continuous(topology, chunk, 1600, resumed, on_event=lambda state, result: chunked.add(result))
+    assert resumed.next_event == chunked.n_events == len(rainfall)
+    np.testing.assert_allclose(resumed.used_capacity, state.used_capacity, rtol=1e-12)
+    np.testing.assert_allclose(chunked.sediment, whole.sediment, rtol=1e-12)
+    np.testing.assert_array_equal(chunked.events_connected, whole.events_connected)
@@ -0,0 +1,115 @@
+import json
+import math
+from pathlib import Path
+import numpy as np
+import pytest
+
+from model import ensemble, engine
+from utils import config
+
+# Parameter samples from every distribution, the configured ranges they're drawn from, and an ensemble
+# run against every sample run on its own through the engine
+
+REPOSITORY = Path(__file__).resolve().parents[1]
+
+def distribution(kind: str, **parameters) -> config.DistributionData:
+    return {'distribution': kind, 'parameters': parameters}
+
+def test_sample_distribution() -> None:
+    rng = np.random.default_rng(0)
+    n = 100_000
+    uniform = ensemble.sample_distribution(distribution('uniform', low=2, high=5), rng, n)
+    assert uniform.min() >= 2 and uniform.max() <= 5
+    triangular = ensemble.sample_distribution(distribution('triangular', low=1, mode=2, high=6), rng, n)
+    assert triangular.min() >= 1 and triangular.max() <= 6
+    assert abs(triangular.mean() - 3) < 0.02
+    lognormal = ensemble.sample_distribution(distribution('lognormal', median=4, sigma=0.5), rng, n)
+    assert lognormal.min() > 0 and abs(np.median(lognormal) - 4) < 0.03
+
+    # Truncated rather than censored at 0: no mass at 0, and the mean of the truncated normal
+    normal = ensemble.sample_distribution(distribution('normal', mean=1, std=2), rng, n)
+    assert normal.min() > 0
+    alpha = -1 / 2
+    density, tail = math.exp(-alpha ** 2 / 2) / math.sqrt(2 * math.pi), 0.5 * math.erfc(alpha / math.sqrt(2))
+    assert abs(normal.mean() - (1 + 2 * density / tail)) < 0.02
+    assert np.all(ensemble.sample_distribution(distribution('normal', mean=3, std=0), rng, 10) == 3)
+
+    with pytest.raises(ValueError):
+        ensemble.sample_distribution(distribution('normal', mean=-1, std=1), rng, 10)
+    with pytest.raises(ValueError):
+        ensemble.sample_distribution(distribution('beta', a=1, b=1), rng, 10)
+
+@pytest.fixture
+def uncertainty(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    # get_uncertainty_settings of the bundled configuration with the given uncertain parameters
+    def settings(parameters: dict) -> config.UncertaintySettings:
+        data = json.loads((REPOSITORY / 'config' / 'config.json').read_text())
+        data['uncertainty'] = {'samples': 10, 'seed': 0, 'parameters': parameters}
+        path = tmp_path / 'config.json'
+        path.write_text(json.dumps(data))
+        monkeypatch.setattr(config, 'CONFIG_PATH', str(path))
+        return config.get_uncertainty_settings()
+    return settings
+
+def test_uncertainty_ranges(uncertainty) -> None:
+    parameters = {
+        'travel_cost': {'distribution': 'uniform', 'low': 0.005, 'high': 0.02},
+        'pond_capacity': {'distribution': 'normal', 'mean': 1, 'std': 0.2},
+        'dirt.erosion_rate': {'distribution': 'lognormal', 'median': 4.15, 'sigma': 0.3},
+        'dirt.runoff_coefficient': {'distribution': 'triangular', 'low': 0.1, 'mode': 0.2, 'high': 0.4},
+    }
+    settings = uncertainty(parameters)
+    assert settings['parameters']['pond_capacity'] == distribution('normal', mean=1.0, std=0.2)
+
+    for name, invalid in (
+        ('travel_cost', {'distribution': 'uniform', 'low': 0.02, 'high': 0.005}),
+        ('dirt.runoff_coefficient', {'distribution': 'triangular', 'low': 0.1, 'mode': 0.5, 'high': 0.4}),
+        ('dirt.runoff_coefficient', {'distribution': 'triangular', 'low': 0.1, 'mode': 0.1, 'high': 0.1}),
+        ('pond_capacity', {'distribution': 'normal', 'mean': 1, 'std': -0.2}),
+        ('pond_capacity', {'distribution': 'normal', 'mean': -1, 'std': 0.2}),
+        ('dirt.erosion_rate', {'distribution': 'lognormal', 'median': 0, 'sigma': 0.3}),
+        ('dirt.erosion_rate', {'distribution': 'lognormal', 'median': 4.15, 'sigma': -0.3}),
+        ('dirt.erosion_rate', {'distribution': 'lognormal', 'median': float('inf'), 'sigma': 0.3}),
+        ('dirt.erosion_rate', {'distribution': 'lognormal', 'median': 4.15}),
+        ('dirt.erosion_rate', {'distribution': 'gamma', 'shape': 2, 'scale': 1}),
+        ('unknown', {'distribution': 'uniform', 'low': 0, 'high': 1}),
+    ):
+        with pytest.raises(ValueError):
+            uncertainty({**parameters, name: invalid})
+
+def test_run_ensemble(random_topology) -> None:
+    topology = random_topology(0, 200)
+    rainfall = np.random.default_rng(1).uniform(0, 120, 9)
+    distributions = {
+        'sand.runoff_coefficient': distribution('uniform', low=0.05, high=0.3),
+        'dirt.erosion_rate': distribution('normal', mean=4, std=1.5),
+        'travel_cost': distribution('lognormal', median=0.01, sigma=0.4),
+        'pond_capacity': distribution('triangular', low=0.5, mode=1, high=2),
+        'pond_efficiency.scale': distribution('uniform', low=100, high=130),
+    }
+    samples = ensemble.sample_parameters(topology, 0.01, distributions, 7, seed=3)
+    assert np.array_equal(samples.erosion_rate, ensemble.sample_parameters(topology, 0.01, distributions, 7, seed=3).erosion_rate)
+
+    # Any block size and number of threads, over chunks of events
+    results = ensemble.EnsembleResults.empty(samples, topology.n_nodes)
+    ensemble.run_ensemble(topology, rainfall, results, max_batch_values=2 ** 24, workers=1)
+    chunked = ensemble.EnsembleResults.empty(samples, topology.n_nodes)
+    for events in (rainfall[:4], rainfall[4:]):
+        ensemble.run_ensemble(topology, events, chunked, max_batch_values=2 * 200 * 3 * 2, workers=2)
+    assert results.n_events == chunked.n_events == len(rainfall)
+
+    for s in range(samples.n_samples):
+        single = engine.run_events(
+            topology,
+            rainfall,
+            runoff_coefficient=samples.runoff_coefficient[s],
+            erosion_rate=samples.erosion_rate[s],
+            travel_cost=samples.travel_cost[s],
+            max_capacity=samples.pond_capacity[s] * topology.max_capacity,
+            efficiency_curve=samples.pond_efficiency[s],
+        )
+        for ensemble_results in (results, chunked):
+            np.testing.assert_allclose(ensemble_results.runoff[s], single.runoff_sum.sum(axis=0), rtol=1e-12)
+            np.testing.assert_allclose(ensemble_results.sediment[s], single.sediment_sum.sum(axis=0), rtol=1e-12)
+            np.testing.assert_allclose(ensemble_results.trapped_sediment[s], single.trapped_sediment.sum(axis=0), rtol=1e-12)
+            np.testing.assert_array_equal(ensemble_results.events_connected[s], single.connected.sum(axis=0))
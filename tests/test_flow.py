@@ -0,0 +1,142 @@
+import heapq
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+import pytest
+
+from preprocess import flow
+
+# Depression filling against a priority flood, receivers on planes and on filled noise, and flowpaths
+# traced between roads on a small synthetic DEM
+
+def rough(shape: tuple, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    elevation = rng.uniform(0, 10, shape) + np.linspace(0, 5, shape[1])
+    valid = np.ones(shape, dtype=bool)
+    valid[shape[0] // 3:shape[0] // 2, shape[1] // 3:shape[1] // 2] = False
+    return elevation, valid
+
+def outlets(valid: np.ndarray) -> np.ndarray:
+    padded = np.pad(valid, 1)
+    height, width = valid.shape
+    surrounded = np.all([padded[1 + r:height + 1 + r, 1 + c:width + 1 + c] for r, c in flow.NEIGHBOURS], axis=0)
+    return valid & ~surrounded
+
+def priority_flood(elevation: np.ndarray, valid: np.ndarray, epsilon: float) -> np.ndarray:
+    # Barnes et al. (2014), one cell at a time from the outlets up
+    water = np.full(elevation.shape, -np.inf)
+    queue = [(elevation[cell], cell) for cell in zip(*np.nonzero(outlets(valid)))]
+    for level, cell in queue:
+        water[cell] = level
+    heapq.heapify(queue)
+    while queue:
+        level, (row, col) = heapq.heappop(queue)
+        for r, c in flow.NEIGHBOURS:
+            cell = (row + r, col + c)
+            if 0 <= cell[0] < valid.shape[0] and 0 <= cell[1] < valid.shape[1] and valid[cell] and water[cell] == -np.inf:
+                water[cell] = max(elevation[cell], level + epsilon)
+                heapq.heappush(queue, (water[cell], cell))
+    return water
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_fill_depressions(seed: int) -> None:
+    elevation, valid = rough((25, 30), seed)
+    filled = flow.fill_depressions(elevation, valid, 1e-3)
+    assert filled.shape == (27, 32) and np.all(np.isneginf(filled[~np.pad(valid, 1)]))
+    inner = filled[1:-1, 1:-1]
+    np.testing.assert_allclose(inner[valid], priority_flood(elevation, valid, 1e-3)[valid], rtol=0, atol=1e-9)
+    assert np.all(inner[valid] >= elevation[valid])
+
+    # Every cell that isn't an outlet has a neighbour at least epsilon below it
+    lowest = np.min([np.where(np.isfinite(s), s, np.inf) for s in (np.roll(filled, (-r, -c), (0, 1))[1:-1, 1:-1] for r, c in flow.NEIGHBOURS)], axis=0)
+    drains = valid & ~outlets(valid)
+    assert np.all(inner[drains] >= lowest[drains] + 1e-3 - 1e-9)
+
+@pytest.mark.parametrize('size', [50, 200])
+def test_fill_visits_every_cell_once(monkeypatch, size: int) -> None:
+    # A wide flat basin, which took the old fill one pass per cell of its radius: every cell is still
+    # pushed onto the heap once, so the work grows as N log N whatever the depression's size
+    rows, cols = np.mgrid[:size, :size]
+    radius = np.hypot(rows - size / 2, cols - size / 2)
+    elevation = np.where(radius < size / 3, 0.0, radius / size)
+    valid = np.ones(elevation.shape, dtype=bool)
+    pushed = []
+    push = flow.heapq.heappush
+    monkeypatch.setattr(flow.heapq, 'heappush', lambda queue, item: pushed.append(item[1]) or push(queue, item))
+    filled = flow.fill_depressions(elevation, valid, 1e-3)
+    assert len(pushed) == len(set(pushed)) == (size - 2) ** 2
+    np.testing.assert_allclose(filled[1:-1, 1:-1], priority_flood(elevation, valid, 1e-3), rtol=0, atol=1e-9)
+
+def test_fill_keeps_slopes() -> None:
+    elevation = np.add.outer(np.arange(12.0), np.arange(15.0))
+    np.testing.assert_array_equal(flow.fill_depressions(elevation, np.ones(elevation.shape, dtype=bool))[1:-1, 1:-1], elevation)
+
+@pytest.mark.parametrize('method', ['d8', 'dinf'])
+@pytest.mark.parametrize('direction', range(8))
+def test_receivers_on_planes(method: str, direction: int) -> None:
+    # A plane falling towards one neighbour drains every cell to it where it's on the DEM
+    r, c = flow.NEIGHBOURS[direction]
+    rows, cols = np.mgrid[:9, :11]
+    elevation = -(rows * r + cols * c).astype(float)
+    receiver = flow.receivers(flow.fill_depressions(elevation, np.ones(elevation.shape, dtype=bool)), from_origin(0, 9, 1, 1), method)
+    index = (rows + 1) * 13 + cols + 1
+    inside = (rows + r >= 0) & (rows + r < 9) & (cols + c >= 0) & (cols + c < 11)
+    np.testing.assert_array_equal(receiver[index[inside]], index[inside] + r * 13 + c)
+    assert np.all(np.isin(receiver[index[~inside]], np.append(index, -1)))
+
+@pytest.mark.parametrize('method', ['d8', 'dinf'])
+def test_receivers_reach_outlets(method: str) -> None:
+    elevation, valid = rough((25, 30))
+    filled = flow.fill_depressions(elevation, valid)
+    receiver = flow.receivers(filled, from_origin(0, 50, 2, 2), method, block_rows=7)
+    z = filled.reshape(-1)
+    assert np.all(receiver[~np.isfinite(z)] == -1)
+    assert np.all(np.isfinite(z[receiver[receiver >= 0]])) # Never into nodata or off the DEM
+    assert np.all(z[receiver[receiver >= 0]] < z[receiver >= 0])
+
+    cells = np.flatnonzero(np.pad(valid & ~outlets(valid), 1).reshape(-1))
+    assert np.all(receiver[cells] >= 0)
+    for _ in range(valid.size): # Strictly downhill, so every walk ends
+        cells = receiver[cells]
+        cells = cells[cells >= 0]
+    assert len(cells) == 0
+
+    with pytest.raises(ValueError):
+        flow.receivers(filled, from_origin(0, 50, 2, 2), 'mfd')
+
+def test_trace() -> None:
+    # 0 -> 1 -> 2 -> 3 -> 4 -> 5, road cells 0, 1, 4, 5
+    receiver = np.array([1, 2, 3, 4, 5, -1, 7, -1])
+    stop = np.array([True, True, False, False, True, True, False, False])
+    cells, lengths, stopped = flow.trace(receiver, np.array([0, 2, 4, 6, 7]), stop)
+    assert lengths.tolist() == [4, 2, 1, 1, 0]
+    assert cells.tolist() == [1, 2, 3, 4, 3, 4, 5, 7]
+    assert stopped.tolist() == [True, True, False, False, False]
+
+def test_trace_flowpaths() -> None:
+    # A 2 m DEM rising to the north with a pit between two roads across it
+    rows, cols = np.mgrid[:30, :20]
+    elevation = (30 - rows) * 0.5 + cols * 0.01
+    elevation[12, 10] -= 5
+    transform = from_origin(1000, 2060, 2, 2)
+    road_y = [2060 - 2 * 5.5, 2060 - 2 * 20.5]
+    roads = gpd.GeoSeries([shapely.LineString([(1000, y), (1040, y)]) for y in road_y], crs='EPSG:32619')
+    starts = gpd.GeoSeries([shapely.Point(1021.3, road_y[0] + 0.2), shapely.Point(1021.3, 2060 - 2 * 25.5), shapely.Point(900, 2000)], crs='EPSG:32619')
+    with MemoryFile() as memory:
+        with memory.open(driver='GTiff', count=1, height=30, width=20, dtype='float64', crs='EPSG:32619', transform=transform) as dem:
+            dem.write(elevation, 1)
+        with memory.open() as dem:
+            paths = flow.trace_flowpaths(starts, roads, dem)
+
+    assert paths['START'].tolist() == [0, 1]
+    assert paths['TO_ROAD'].tolist() == [True, False]
+    first, second = (shapely.get_coordinates(line) for line in paths.geometry)
+    # From the start point through cell centres, over the filled pit, to the first cell of the next road
+    np.testing.assert_array_equal(first[0], [1021.3, road_y[0] + 0.2])
+    assert np.all((first[1:] - 1) % 2 == 0)
+    assert np.all(np.diff(first[:, 1]) < 0) and first[-1, 1] == road_y[1]
+    # Off the bottom of the DEM and along its edge, downhill to the corner
+    np.testing.assert_array_equal(second[-1], [1001, 2001])
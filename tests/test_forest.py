@@ -0,0 +1,94 @@
+import numpy as np
+import shapely
+import pytest
+
+from model import engine
+from model.engine import Topology
+
+# ForestIndex against walking the child array
+
+def upstream(topology: Topology, node: int) -> set:
+    # Every node whose path to its terminal node goes through `node`, including itself
+    nodes = set()
+    for start in range(topology.n_nodes):
+        current = start
+        while current >= 0:
+            if current == node:
+                nodes.add(start)
+                break
+            current = topology.child[current]
+    return nodes
+
+def downstream(topology: Topology, node: int) -> list:
+    path = [node]
+    while topology.child[path[-1]] >= 0:
+        path.append(int(topology.child[path[-1]]))
+    return path
+
+def connected_upstream(topology: Topology, values: np.ndarray, connected: np.ndarray) -> np.ndarray:
+    # values summed over the nodes whose every edge on the way to the node is connected
+    result = np.zeros((topology.n_nodes,) + values.shape[1:])
+    for start in range(topology.n_nodes):
+        current = start
+        while True:
+            result[current] += values[start]
+            if topology.child[current] < 0 or not connected[current]:
+                break
+            current = topology.child[current]
+    return result
+
+def check_forest(topology: Topology, rng: np.random.Generator) -> None:
+    forest = topology.forest
+    values = rng.uniform(0, 10, (topology.n_nodes, 2))
+    upstream_sum = forest.upstream_sum(values.T)
+    for node in range(topology.n_nodes):
+        nodes = upstream(topology, node)
+        assert set(forest.upstream(node).tolist()) == nodes
+        assert forest.upstream_count()[node] == len(nodes)
+        np.testing.assert_allclose(upstream_sum[:, node], values[sorted(nodes)].sum(axis=0), rtol=1e-9)
+        path = downstream(topology, node)
+        assert forest.downstream(node).tolist() == path
+        assert forest.terminal[node] == path[-1]
+    through = rng.integers(0, topology.n_nodes, 50)
+    for node in rng.integers(0, topology.n_nodes, 50):
+        np.testing.assert_array_equal(forest.drains_through(node, through), [node in upstream(topology, other) for other in through])
+
+    connected = rng.random((5, topology.n_nodes)) < [[0.0], [0.3], [0.7], [0.95], [1.0]]
+    result = forest.connected_upstream_sum(values, connected)
+    for event in range(len(connected)):
+        np.testing.assert_allclose(result[event], connected_upstream(topology, values, connected[event]), rtol=1e-9, atol=1e-9)
+
+def test_bundled_forest(bundled) -> None:
+    _, topology = bundled
+    check_forest(topology, np.random.default_rng(0))
+
+@pytest.mark.parametrize('seed', range(4))
+def test_random_forest(random_topology, seed: int) -> None:
+    check_forest(random_topology(seed, 200), np.random.default_rng(seed))
+
+def test_levels_order_children_after_parents(random_topology) -> None:
+    topology = random_topology(7, 500)
+    routed = topology.child >= 0
+    assert np.all(topology.depth[topology.child[routed]] > topology.depth[routed])
+    assert sorted(np.concatenate([level.nodes for level in topology.levels]).tolist()) == list(range(topology.n_nodes))
+
+def test_contributing_area_is_connected_upstream_area(random_topology) -> None:
+    topology = random_topology(3, 200)
+    results = engine.run_events(topology, [5.0, 40.0, 400.0])
+    area = topology.local_area.sum(axis=1)
+    for event in range(3):
+        np.testing.assert_allclose(results.contributing_area[event], connected_upstream(topology, area, results.connected[event]), rtol=1e-9, atol=1e-9)
+
+def test_bundled_queries(bundled) -> None:
+    _, topology = bundled
+    from model import forest, scenario
+    from model.data import roads
+    queries = forest.DrainageQueries(topology, scenario.SegmentTable.from_roads(roads._gdf, topology))
+    for node, point in enumerate(topology.points):
+        points = {topology.points[i] for i in upstream(topology, node)}
+        assert set(queries.upstream(point)) == points
+        assert queries.downstream(point) == [topology.points[i] for i in downstream(topology, node)]
+        assert queries.segments_reaching(point).tolist() == [row for row, drain in enumerate(roads._gdf['DRAIN_IDX']) if drain in points]
+        np.testing.assert_allclose(queries.contributing_road(point)[0], roads._gdf['AREA'][roads._gdf['DRAIN_IDX'].isin(points)].sum(), rtol=1e-9)
+    with pytest.raises(KeyError):
+        queries.upstream(shapely.Point(-1, -1))
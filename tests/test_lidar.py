@@ -0,0 +1,88 @@
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+import rasterio.windows
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+import pytest
+
+from preprocess import lidar
+
+# A road surface from two small overlapping clouds of a tilted plane, one ground point at every cell
+# centre, against the plane itself: vegetation is ignored, a stray return is dropped and cells without
+# points are filled from their neighbours, whatever the tile and chunk sizes.
+
+laspy = pytest.importorskip('laspy')
+
+CRS_UTM = CRS.from_epsg(32619)
+ROADS = [shapely.box(2.3, 3.1, 37.6, 9.8), shapely.box(18.2, 0.4, 24.7, 29.6)]
+
+def plane(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    return 100 + 0.02 * x - 0.01 * y
+
+def write_cloud(path: Path, x: np.ndarray, y: np.ndarray, z: np.ndarray, classification: np.ndarray) -> None:
+    order = np.random.default_rng(0).permutation(len(x)) # Every chunk spread over the tiles
+    header = laspy.LasHeader(point_format=3, version='1.2')
+    header.scales, header.offsets = [0.001] * 3, [0.0] * 3
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = x[order], y[order], z[order]
+    las.classification = classification[order]
+    las.write(path)
+
+@pytest.fixture
+def clouds(tmp_path: Path) -> list:
+    x, y = (axis.reshape(-1) for axis in np.meshgrid(np.arange(0, 40) + 0.5, np.arange(-2, 32) + 0.5))
+    # No points in two road cells
+    kept = ~(((x == 10.5) & (y == 6.5)) | ((x == 21.5) & (y == 20.5)))
+    x, y = x[kept], y[kept]
+    ground = np.full(len(x), lidar.GROUND)
+    vegetation = np.full(len(x), 5)
+
+    paths = []
+    for name, part in (('a.las', x < 22), ('b.las', x >= 18)):
+        px, py = np.tile(x[part], 2), np.tile(y[part], 2)
+        pz = np.r_[plane(x[part], y[part]), plane(x[part], y[part]) + 15]
+        classification = np.r_[ground[part], vegetation[part]]
+        if name == 'b.las':
+            # A car on the road
+            px, py, pz = np.r_[px, 30.5], np.r_[py, 5.5], np.r_[pz, plane(30.5, 5.5) + 5]
+            classification = np.r_[classification, lidar.ROAD_SURFACE]
+        paths.append(tmp_path / name)
+        write_cloud(paths[-1], px, py, pz, classification)
+    return lidar.open_clouds(paths, CRS_UTM)
+
+@pytest.mark.parametrize('tile_size, chunk_size', [(8, 50), (1024, 1_000_000)])
+def test_road_surface(clouds: list, tmp_path: Path, tile_size: int, chunk_size: int) -> None:
+    output = tmp_path / 'surface.tif'
+    roads = gpd.GeoSeries(ROADS, crs=CRS_UTM)
+    cells = lidar.road_surface(clouds, roads, output, tile_size=tile_size, workers=2, chunk_size=chunk_size)
+    assert not list(tmp_path.glob('spool-*'))
+
+    with rasterio.open(output) as src:
+        assert src.bounds == (2, 0, 38, 30)
+        surface = src.read(1)
+        road = rasterio.features.rasterize(ROADS, out_shape=src.shape, transform=src.transform, all_touched=True).astype(bool)
+        rows, cols = np.mgrid[:src.height, :src.width]
+        x, y = src.transform * (cols + 0.5, rows + 0.5)
+    assert cells == road.sum()
+    np.testing.assert_allclose(surface[road], plane(x, y)[road], atol=2e-3)
+    assert np.all(surface[~road] == lidar.NODATA)
+
+def test_spool_by_chunk(clouds: list, tmp_path: Path) -> None:
+    # Every chunk goes to its own files, none with more points than a chunk
+    width, height, halo, chunk_size = 36, 30, 2, 50
+    transform = from_origin(2, 30, 1, 1)
+    window = rasterio.windows.Window(-halo, -halo, width + 2 * halo, height + 2 * halo)
+    spool = tmp_path / 'spool'
+    spool.mkdir()
+    written = lidar._spool_cloud(
+        clouds[0], '0', CRS_UTM, window, transform, width, height, halo, shapely.to_wkb(ROADS),
+        [lidar.GROUND, lidar.ROAD_SURFACE], chunk_size, 8, spool,
+    )
+    assert sorted(path.name for _, path in written) == sorted(path.name for path in spool.iterdir())
+    sizes = [len(np.load(path)['cells']) for _, path in written]
+    assert max(sizes) <= chunk_size
+    assert len({path.name.rsplit('-', 1)[1] for _, path in written}) > 1
@@ -0,0 +1,88 @@
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+from rasterio.transform import from_origin
+import pytest
+
+from preprocess import lithology
+
+# Road classes from a stub classifier, block by block and in small batches, against every road
+# rasterized on its own over the whole grid
+
+CRS = 'EPSG:32619'
+TRANSFORM = from_origin(0, 50, 1, 1)
+
+class Threshold:
+    # Paved where the first band is bright, as a fitted classifier with sorted classes_
+    classes_ = np.array(['gravel', 'paved'])
+
+    def __init__(self) -> None:
+        self.batches = []
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        self.batches.append(len(features))
+        return np.where(features[:, 0] > 50, 'paved', 'gravel')
+
+@pytest.fixture(scope='module')
+def bands(tmp_path_factory) -> list:
+    rng = np.random.default_rng(0)
+    brightness = np.where(np.arange(60) < 30, 20.0, 80.0)[None, :] + rng.normal(0, 15, (50, 60))
+    brightness[40:, :10] = 0 # Not imaged
+    other = rng.uniform(1, 10, (50, 60))
+    other[40:, :10] = 0
+    other[5:8, 35:40] = -1 # Nodata
+    paths = []
+    for i, values in enumerate([brightness, other]):
+        path = tmp_path_factory.mktemp('bands') / f"B{i}.tif"
+        with rasterio.open(path, 'w', driver='GTiff', count=1, height=50, width=60, dtype='float32', crs=CRS, transform=TRANSFORM, nodata=-1) as dst:
+            dst.write(values.astype('float32'), 1)
+        paths.append(path)
+    return paths
+
+def roads() -> gpd.GeoSeries:
+    # Off the cell corners, where all_touched is ambiguous at block edges
+    return gpd.GeoSeries([
+        shapely.LineString([(2.3, 45.2), (25.4, 30.3)]),   # Gravel side
+        shapely.LineString([(35.2, 45.3), (57.6, 5.4)]),   # Paved side, through the nodata
+        shapely.LineString([(20.3, 20.2), (55.4, 25.3)]),  # Mostly paved, crossing the other one
+        shapely.LineString([(1.2, 2.3), (8.4, 9.2)]),      # Not imaged
+        shapely.LineString([(100, 100), (120, 120)]), # Off the grid
+        None,
+    ], crs=CRS)
+
+def reference(geometries: gpd.GeoSeries, paths: list) -> tuple:
+    values = []
+    for path in paths:
+        with rasterio.open(path) as src:
+            values.append(src.read(1))
+    values = np.stack(values)
+    valid = (values != -1).all(axis=0) & (values != 0).any(axis=0)
+    majority, pixels = [], []
+    for geometry in geometries:
+        under = valid & rasterio.features.geometry_mask([geometry], valid.shape, TRANSFORM, invert=True, all_touched=True) if geometry is not None else np.zeros(valid.shape, dtype=bool)
+        paved = (values[0][under] > 50).sum()
+        pixels.append(under.sum())
+        majority.append(None if not under.any() else 'paved' if paved > under.sum() - paved else 'gravel')
+    return majority, pixels
+
+@pytest.mark.parametrize('block_size', [7, 2048])
+def test_classify_roads(bands: list, block_size: int) -> None:
+    classifier = Threshold()
+    majority, pixels = lithology.classify_roads(roads(), bands, classifier, block_size=block_size, batch_size=16)
+    expected_majority, expected_pixels = reference(roads(), bands)
+    assert majority.tolist() == expected_majority
+    assert pixels.tolist() == expected_pixels
+    assert majority[:4].tolist() == ['gravel', 'paved', 'paved', None]
+    assert max(classifier.batches) <= 16
+
+def test_assign_types() -> None:
+    typed = gpd.GeoDataFrame({'TYPE': ['paved', 'gravel', 'paved']}, geometry=list(roads()[:3]), crs=CRS)
+    result = lithology.assign_types(typed, np.array(['Chert', None, 'paved'], dtype=object), {'Chert': 'gravel'})
+    assert result['LITHOLOGY'].isna().tolist() == [False, True, False]
+    assert result['LITHOLOGY'].dropna().tolist() == ['Chert', 'paved']
+    assert result['TYPE'].tolist() == ['gravel', 'gravel', 'paved']
+    untyped = lithology.assign_types(typed.drop(columns='TYPE'), np.array([None, 'paved', None], dtype=object), default='native')
+    assert untyped['TYPE'].tolist() == ['native', 'paved', 'native']
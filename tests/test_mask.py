@@ -0,0 +1,100 @@
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+from rasterio.transform import from_origin
+import pytest
+
+from preprocess import mask
+
+# The tiled road mask against the notebook's approach: every polygon rasterized over the whole DEM with
+# its own majority
+
+CRS = 'EPSG:32619'
+TRANSFORM = from_origin(0, 100, 1, 1)
+
+@pytest.fixture(scope='module')
+def dem(tmp_path_factory) -> Path:
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[:100, :120]
+    values = (rows * 0.05 + np.sin(cols / 9) + rng.normal(0, 0.3, rows.shape)).astype('float32')
+    values[rng.random(values.shape) < 0.02] = -9999
+    path = tmp_path_factory.mktemp('mask') / 'dem.tif'
+    with rasterio.open(path, 'w', driver='GTiff', count=1, height=100, width=120, dtype='float32', crs=CRS, transform=TRANSFORM, nodata=-9999) as dst:
+        dst.write(values, 1)
+    return path
+
+def polygons() -> gpd.GeoSeries:
+    # Overlapping buffered road segments, and one road across the whole DEM
+    rng = np.random.default_rng(1)
+    start = rng.uniform(5, 95, (40, 2))
+    end = start + rng.uniform(-15, 15, (40, 2))
+    segments = shapely.buffer(shapely.linestrings(np.stack([start, end], axis=1)), rng.uniform(1, 4, 40))
+    return gpd.GeoSeries(np.append(segments, shapely.LineString([(0, 3), (60, 90), (120, 20)]).buffer(2.5)), crs=CRS)
+
+def reference(geometries: gpd.GeoSeries, path: Path, tolerance: float = 0.3, decimals: int = 1) -> np.ndarray:
+    with rasterio.open(path) as src:
+        values = src.read(1)
+        valid = values != src.nodata
+    rounded = np.round(values.astype(float) * 10 ** decimals).astype(np.int64)
+    result = np.zeros(values.shape, dtype='uint8')
+    for geometry in geometries:
+        under = rasterio.features.geometry_mask([geometry], values.shape, TRANSFORM, invert=True, all_touched=True) & valid
+        if not under.any():
+            continue
+        counts = np.bincount(rounded[under] - rounded[under].min())
+        majority = rounded[under].min() + np.argmax(counts) # The smallest on ties
+        result[under & (np.abs(rounded - majority) <= round(tolerance * 10 ** decimals))] = 1
+    return result
+
+def test_value_counts() -> None:
+    labels, values, counts = mask.value_counts(np.array([2, 0, 2, 2, 0]), np.array([5, 1, 5, 4, 1]), np.array([1, 2, 3, 4, 5]))
+    assert labels.tolist() == [0, 2, 2] and values.tolist() == [1, 4, 5] and counts.tolist() == [7, 4, 4]
+
+def test_group_majority() -> None:
+    rng = np.random.default_rng(2)
+    labels, values = rng.integers(0, 30, 500), rng.integers(0, 6, 500)
+    majority, found = mask.group_majority(labels, values, 32)
+    for label in range(32):
+        assert found[label] == (label in labels)
+        if found[label]:
+            counts = np.bincount(values[labels == label])
+            assert majority[label] == np.argmax(counts)
+    # Weighted by counts, as the per-tile counts are added up
+    weights = rng.integers(1, 4, 500)
+    majority, _ = mask.group_majority(labels, values, 32, weights)
+    for label in np.unique(labels):
+        assert majority[label] == np.argmax(np.bincount(values[labels == label], weights[labels == label]))
+
+def test_overlap_layers() -> None:
+    geometries = polygons().to_numpy()
+    layer = mask.overlap_layers(geometries, 1.5)
+    i, j = shapely.STRtree(geometries).query(geometries, predicate='dwithin', distance=1.5)
+    assert np.all(layer[i[i != j]] != layer[j[i != j]])
+    assert layer.min() == 0 and np.all(np.isin(np.arange(layer.max() + 1), layer))
+
+@pytest.mark.parametrize('size', [1, 7, 45, 200])
+def test_raster_tiles(size: int) -> None:
+    # Every cell in exactly one tile
+    covered = np.zeros((100, 120), dtype=int)
+    for tile in mask.raster_tiles(120, 100, size):
+        assert 0 < tile.width <= size and 0 < tile.height <= size
+        covered[tile.toslices()] += 1
+    assert np.all(covered == 1)
+
+@pytest.mark.parametrize('tile_size', [16, 45, 2048])
+def test_road_mask(dem: Path, tmp_path: Path, tile_size: int) -> None:
+    roads = polygons()
+    output = tmp_path / 'mask.tif'
+    cells = mask.road_mask(roads, dem, output, tile_size=tile_size, workers=2)
+    with rasterio.open(output) as src:
+        result = src.read(1)
+        assert src.transform == TRANSFORM
+    np.testing.assert_array_equal(result, reference(roads, dem))
+    assert cells == result.sum() > 0
+
+def test_road_mask_needs_polygons(dem: Path, tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        mask.road_mask(polygons().boundary, dem, tmp_path / 'mask.tif')
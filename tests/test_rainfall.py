@@ -0,0 +1,179 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import shapely
+import rasterio
+import rasterio.warp
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+import pytest
+
+from model.data import rainfall
+
+# Every rainfall source streamed in small chunks, from any event, against the series it was written from
+
+def settings(path: Path, column: str | None = 'rain', chunk_size: int = 4, **columns) -> dict:
+    return {'path': path, 'column': column, 'timestamp_column': columns.get('timestamp'), 'storm_id_column': columns.get('storm_id'), 'chunk_size': chunk_size}
+
+def series(n: int = 11) -> pd.DataFrame:
+    return pd.DataFrame({
+        'rain': np.random.default_rng(0).uniform(0, 100, n).round(3),
+        'time': pd.date_range('2020-01-01', periods=n, freq='D'),
+        'storm': [f"s{i // 3}" for i in range(n)],
+    })
+
+def read(source, start: int = 0, points=None) -> tuple:
+    chunks = list(source.chunks(start=start, points=points))
+    assert [chunk.first_event for chunk in chunks] == list(np.cumsum([start] + [chunk.n_events for chunk in chunks[:-1]]))
+    metadata = {key: np.concatenate([chunk.metadata[key] for chunk in chunks]) for key in chunks[0].metadata}
+    return np.concatenate([chunk.depth for chunk in chunks]), metadata
+
+def test_inline() -> None:
+    source = rainfall.InlineRainfall([1, 2, 3, 4, 5], chunk_size=2)
+    assert source.n_events == 5
+    assert read(source, 3)[0].tolist() == [4, 5]
+    with pytest.raises(ValueError):
+        rainfall.InlineRainfall([1, 'a'], chunk_size=2)
+    with pytest.raises(ValueError):
+        rainfall.InlineRainfall([1, float('nan')], chunk_size=2)
+
+def test_sources_need_chunks() -> None:
+    class Incomplete(rainfall.RainfallSource):
+        pass
+    with pytest.raises(TypeError):
+        Incomplete()
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_table(tmp_path: Path, suffix: str) -> None:
+    table, path = series(), tmp_path / f"rain{suffix}"
+    table.to_csv(path, index=False) if suffix == '.csv' else table.to_parquet(path)
+    source = (rainfall.CsvRainfall if suffix == '.csv' else rainfall.ParquetRainfall)(settings(path, timestamp='time', storm_id='storm'))
+    assert source.n_events == len(table)
+
+    for start in (0, 3, 5, 10):
+        depth, metadata = read(source, start)
+        np.testing.assert_allclose(depth, table['rain'][start:])
+        assert metadata['timestamp'].tolist() == table['time'][start:].dt.strftime('%Y-%m-%dT%H:%M:%S').tolist()
+        assert metadata['storm_id'].tolist() == table['storm'][start:].tolist()
+
+def test_table_with_missing_values(tmp_path: Path) -> None:
+    table, path = series(), tmp_path / 'rain.csv'
+    table.loc[6, 'rain'] = np.nan
+    table.to_csv(path, index=False)
+    with pytest.raises(ValueError):
+        read(rainfall.CsvRainfall(settings(path)))
+
+def test_netcdf_gauge(tmp_path: Path) -> None:
+    xarray = pytest.importorskip('xarray')
+    table, path = series(), tmp_path / 'rain.nc'
+    xarray.Dataset({'rain': ('time', table['rain'].to_numpy()), 'storm': ('time', table['storm'].to_numpy())}, coords={'time': table['time'].to_numpy()}).to_netcdf(path)
+    source = rainfall.NetcdfRainfall(settings(path, storm_id='storm'))
+    assert source.n_events == len(table)
+
+    depth, metadata = read(source, 2)
+    np.testing.assert_allclose(depth, table['rain'][2:])
+    assert metadata['storm_id'].tolist() == table['storm'][2:].tolist()
+    assert metadata['timestamp'][0] == '2020-01-03T00:00:00'
+
+def test_netcdf_grid(bundled, tmp_path: Path) -> None:
+    # Nodes without road segments get the grid cell they fall in, y descending as in most gridded products
+    xarray = pytest.importorskip('xarray')
+    xs, ys = np.arange(0, 50, 10.0), np.arange(40, -10, -10.0)
+    grid = np.random.default_rng(1).uniform(0, 100, (7, len(ys), len(xs)))
+    path = tmp_path / 'rain.nc'
+    xarray.Dataset({'rain': (('time', 'y', 'x'), grid)}, coords={'x': xs, 'y': ys}).to_netcdf(path)
+    source = rainfall.NetcdfRainfall(settings(path, chunk_size=3))
+
+    points = [shapely.Point(1, 39), shapely.Point(26, 4), shapely.Point(44, 21)]
+    depth, _ = read(source, 1, points)
+    np.testing.assert_allclose(depth, grid[1:][:, [0, 4, 2], [0, 3, 4]])
+    with pytest.raises(ValueError):
+        read(source)
+
+    # Up to half a cell beyond the outer cell centres is still on the grid
+    depth, _ = read(source, 0, [shapely.Point(-4.9, 44.9), shapely.Point(44.9, -4.9)])
+    np.testing.assert_allclose(depth, grid[:, [0, 4], [0, 4]])
+    for outside in (shapely.Point(45.1, 20), shapely.Point(20, -5.1), shapely.Point(-20, 60)):
+        with pytest.raises(ValueError):
+            read(source, 0, [points[0], outside])
+
+def write_stack(path: Path, bands: np.ndarray, bounds: tuple, crs, nodata: float | None = None) -> None:
+    # bands (B, rows, cols) over `bounds`
+    (left, bottom, right, top), (_, height, width) = bounds, bands.shape
+    transform = from_origin(left, top, (right - left) / width, (top - bottom) / height)
+    with rasterio.open(path, 'w', driver='GTiff', count=len(bands), height=height, width=width, dtype='float64', crs=crs, transform=transform, nodata=nodata) as dst:
+        dst.write(bands)
+
+def expected_depth(path: Path, points: list) -> np.ndarray:
+    # Area-weighted rainfall at the midpoints of every node's road segments, sampled one point at a
+    # time, or at the node without any
+    from model.data import roads
+    with rasterio.open(path) as src:
+        depth = np.zeros((src.count, len(points)))
+        for node, point in enumerate(points):
+            segments = roads._gdf[roads._gdf['DRAIN_IDX'] == point]
+            if len(segments):
+                xy = shapely.get_coordinates(shapely.line_interpolate_point(segments.geometry.to_numpy(), 0.5, normalized=True))
+                weight = segments['AREA'].to_numpy(dtype=float)
+            else:
+                xy, weight = np.array([[point.x, point.y]]), np.ones(1)
+            if src.crs != CRS.from_user_input(roads._gdf.crs):
+                xy = np.column_stack(rasterio.warp.transform(roads._gdf.crs, src.crs, xy[:, 0], xy[:, 1]))
+            values = np.array(list(src.sample(xy))).T # (bands, samples)
+            depth[:, node] = values @ weight / weight.sum()
+    return depth
+
+def bundled_bounds(points: list, margin: float = 50.0) -> tuple:
+    from model.data import roads
+    left, bottom, right, top = shapely.union_all(list(roads._gdf.geometry) + list(points)).bounds
+    return left - margin, bottom - margin, right + margin, top + margin
+
+def test_raster_stack(bundled, tmp_path: Path) -> None:
+    _, topology = bundled
+    from model.data import roads
+    path = tmp_path / 'radar.tif'
+    bands = np.random.default_rng(2).uniform(0, 80, (5, 40, 60))
+    write_stack(path, bands, bundled_bounds(topology.points), roads._gdf.crs)
+    source = rainfall.RasterStackRainfall(settings(path, column=None, chunk_size=2))
+    assert source.n_events == 5
+
+    depth, metadata = read(source, 1, topology.points)
+    assert metadata['band'].tolist() == [2, 3, 4, 5]
+    np.testing.assert_allclose(depth, expected_depth(path, topology.points)[1:], rtol=1e-12)
+    with pytest.raises(ValueError):
+        read(source)
+
+def test_raster_stack_outside(bundled, tmp_path: Path) -> None:
+    _, topology = bundled
+    from model.data import roads
+    left, bottom, right, top = bundled_bounds(topology.points)
+    path = tmp_path / 'radar.tif'
+    write_stack(path, np.ones((2, 10, 10)), (left, bottom, (left + right) / 2, top), roads._gdf.crs)
+    with pytest.raises(ValueError):
+        read(rainfall.RasterStackRainfall(settings(path, column=None)), 0, topology.points)
+
+def test_raster_stack_crs(bundled, tmp_path: Path) -> None:
+    # A stack in another CRS is sampled at the segments' reprojected midpoints
+    _, topology = bundled
+    from model.data import roads
+    bounds = rasterio.warp.transform_bounds(roads._gdf.crs, 'EPSG:4326', *bundled_bounds(topology.points, 500))
+    path = tmp_path / 'radar.tif'
+    write_stack(path, np.random.default_rng(3).uniform(0, 80, (2, 40, 60)), bounds, 'EPSG:4326')
+    depth, _ = read(rainfall.RasterStackRainfall(settings(path, column=None)), 0, topology.points)
+    np.testing.assert_allclose(depth, expected_depth(path, topology.points), rtol=1e-12)
+
+def test_raster_stack_nodata(bundled, tmp_path: Path) -> None:
+    # Nodes without a valid sample take the nearest valid one, and events without any are 0
+    _, topology = bundled
+    from model.data import roads
+    bands = np.random.default_rng(4).uniform(0, 80, (3, 40, 60))
+    bands[0] = -1
+    bands[1, :, :30] = -1
+    bands[1, :, 30:] = 7
+    path = tmp_path / 'radar.tif'
+    write_stack(path, bands, bundled_bounds(topology.points), roads._gdf.crs, nodata=-1)
+    with pytest.warns(UserWarning, match='no valid sample'):
+        depth, _ = read(rainfall.RasterStackRainfall(settings(path, column=None)), 0, topology.points)
+    np.testing.assert_array_equal(depth[0], 0)
+    np.testing.assert_allclose(depth[1], 7)
+    np.testing.assert_allclose(depth[2], expected_depth(path, topology.points)[2], rtol=1e-12)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from model import engine, response
+
+# Connectivity index and response curves against running the engine at the same depths
+
+def check_connectivity(topology: engine.Topology, rainfall: np.ndarray) -> None:
+    index = response.build_connectivity_index(topology)
+    results = engine.run_events(topology, rainfall)
+    for event, depth in enumerate(rainfall):
+        np.testing.assert_array_equal(index.connected(depth), results.connected[event])
+        assert index.n_connected(depth) == results.connected[event].sum()
+    np.testing.assert_allclose(index.connected_area(rainfall), results.contributing_area, rtol=1e-9, atol=1e-9)
+    assert np.all(np.diff(index.depth[np.isfinite(index.depth)]) >= 0)
+    assert np.all(np.isfinite(index.depth[:np.isfinite(index.depth).sum()]))
+
+def check_critical_depths(topology: engine.Topology) -> None:
+    # Just above an edge's critical depth it's connected, just below it isn't
+    index = response.build_connectivity_index(topology)
+    finite = np.isfinite(index.depth) & (index.depth > 0)
+    below = engine.run_events(topology, index.depth[finite] * (1 - 1e-6))
+    above = engine.run_events(topology, index.depth[finite] * (1 + 1e-6))
+    edges = index.edges[finite]
+    assert not below.connected[np.arange(len(edges)), edges].any()
+    assert above.connected[np.arange(len(edges)), edges].all()
+
+def check_curves(topology: engine.Topology, rainfall: np.ndarray, max_depth: float, sediment: bool = True) -> None:
+    # Runoff is exact at any depth, sediment interpolated on the grid
+    curves = response.build_response_curves(topology, max_depth=max_depth, resolution=0.5)
+    results = engine.run_events(topology, rainfall)
+    for event, depth in enumerate(rainfall):
+        query = curves.evaluate(depth)
+        np.testing.assert_allclose(curves.runoff_in(depth)[topology.child < 0], results.runoff_sum[event][topology.child < 0], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(query.runoff, results.runoff_sum[event], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(query.volume_reaching_child, results.volume_reaching_child[event], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(query.trapped_runoff, results.trapped_runoff[event], rtol=1e-9, atol=1e-9)
+        np.testing.assert_array_equal(query.connected, results.connected[event])
+        if sediment:
+            np.testing.assert_allclose(query.sediment, results.sediment_sum[event], rtol=1e-2, atol=1e-6)
+
+def test_piecewise_linear_pruning() -> None:
+    # Sums and clips drop the breakpoints where the slope doesn't change
+    PiecewiseLinear = response.PiecewiseLinear
+    rising = PiecewiseLinear(xs=np.array([0.0, 1.0]), ys=np.array([0.0, 0.0]), slope=1.0)
+    levelling = PiecewiseLinear(xs=np.array([0.0, 1.0]), ys=np.array([0.0, 1.0]), slope=0.0)
+    total = rising + levelling
+    assert total.xs.tolist() == [0.0] and total.slope == 1.0
+
+    straight = PiecewiseLinear(xs=np.array([0.0, 1.0, 2.0, 3.0]), ys=np.array([0.0, 1.0, 2.0, 3.0]), slope=1.0)
+    assert (straight + PiecewiseLinear.linear(0.0)).xs.tolist() == [0.0]
+    clipped = straight.clipped(0.5)
+    assert clipped.xs.tolist() == [0.0, 0.5] and clipped.ys.tolist() == [0.0, 0.0]
+    np.testing.assert_allclose(clipped(np.arange(0, 5, 0.25)), np.maximum(0, np.arange(0, 5, 0.25) - 0.5))
+
+@pytest.mark.parametrize('seed', range(3))
+def test_runoff_functions_only_keep_kinks(random_topology, seed: int) -> None:
+    # Runoff is convex, so the slope goes up at every breakpoint that's left
+    for function in response.build_runoff_functions(random_topology(seed, 300)):
+        slopes = np.append(np.diff(function.ys) / np.diff(function.xs), function.slope)
+        assert np.all(np.diff(slopes) > 0)
+
+def test_bundled_response_curves(bundled) -> None:
+    _, topology = bundled
+    check_curves(topology, np.random.default_rng(1).uniform(0, 300, 20), 300)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_random_response_curves(random_topology, seed: int) -> None:
+    topology = random_topology(seed, 300)
+    _, fill_depth = response.critical_depths(topology, response.build_runoff_functions(topology))
+    fill_depth = fill_depth[np.isfinite(fill_depth) & (fill_depth > 0) & (fill_depth < 200)]
+    # Sediment jumps where a pond fills, just before and past it
+    rainfall = np.concatenate([np.random.default_rng(seed).uniform(0, 200, 20), fill_depth * (1 - 1e-6), fill_depth * (1 + 1e-6)])
+    check_curves(topology, rainfall, 200)
+
+def test_response_curves_need_a_grid(bundled) -> None:
+    _, topology = bundled
+    with pytest.raises(ValueError):
+        response.build_response_curves(topology, max_depth=0)
+
+def test_bundled_connectivity(bundled) -> None:
+    _, topology = bundled
+    check_connectivity(topology, np.concatenate([[0.0], np.random.default_rng(0).uniform(0, 1000, 200)]))
+    check_critical_depths(topology)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_random_connectivity(random_topology, seed: int) -> None:
+    topology = random_topology(seed, 300)
+    check_connectivity(topology, np.random.default_rng(seed).uniform(0, 200, 100))
+    check_critical_depths(topology)
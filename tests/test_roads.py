@@ -0,0 +1,61 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+import pytest
+
+from preprocess.roads import segment_lines, segment_roads
+
+# Segmentation against the definition: n = max(1, round(L / target)) pieces of length L / n that
+# run end to end along the line and keep every vertex
+
+def random_lines(rng: np.random.Generator, n: int) -> np.ndarray:
+    return np.array([
+        shapely.LineString(np.cumsum(rng.uniform(-20, 20, (rng.integers(2, 12), 2)), axis=0))
+        for _ in range(n)
+    ])
+
+@pytest.mark.parametrize('target', [0.7, 2.0, 15.0, 1000.0])
+def test_segment_lines(target: float) -> None:
+    lines = random_lines(np.random.default_rng(0), 50)
+    segments, line = segment_lines(lines, target)
+    assert np.all(np.diff(line) >= 0)
+
+    for index, geometry in enumerate(lines):
+        pieces = segments[line == index]
+        n = max(1, round(geometry.length / target))
+        assert len(pieces) == n
+        np.testing.assert_allclose(shapely.length(pieces), geometry.length / n, rtol=1e-9)
+        np.testing.assert_allclose(shapely.get_coordinates(pieces[0])[0], geometry.coords[0])
+        np.testing.assert_allclose(shapely.get_coordinates(pieces[-1])[-1], geometry.coords[-1])
+        for first, second in zip(pieces[:-1], pieces[1:]):
+            np.testing.assert_allclose(shapely.get_coordinates(first)[-1], shapely.get_coordinates(second)[0])
+        assert np.all(shapely.distance(shapely.points(shapely.get_coordinates(pieces)), geometry) < 1e-9)
+        assert np.all(shapely.distance(shapely.points(np.array(geometry.coords)), shapely.MultiLineString(list(pieces))) < 1e-9)
+
+def test_segment_lines_drops_empty_lines() -> None:
+    lines = np.array([shapely.LineString([(0, 0), (0, 0)]), shapely.LineString([(0, 0), (10, 0)]), shapely.LineString()])
+    segments, line = segment_lines(lines, 2.0)
+    assert line.tolist() == [1] * 5
+    with pytest.raises(ValueError):
+        segment_lines(lines, 0)
+
+def test_segment_roads() -> None:
+    roads = gpd.GeoDataFrame({
+        'KIND': ['dirt', None],
+        'W': [4.0, None],
+    }, geometry=[
+        shapely.LineString([(0, 0), (10, 0)]),
+        shapely.MultiLineString([[(0, 5), (3, 5)], [(0, 9), (0, 19)]]),
+    ], crs='EPSG:32619')
+    result = segment_roads(roads, target_length=2.0, width=6.0, width_column='W', type_column='KIND', road_type='gravel')
+
+    assert result['SOURCE'].tolist() == [0] * 5 + [1] * (2 + 5)
+    assert result['TYPE'].tolist() == ['dirt'] * 5 + ['gravel'] * 7
+    assert result['WIDTH'].tolist() == [4.0] * 5 + [6.0] * 7
+    np.testing.assert_allclose(result['LENGTH'], shapely.length(result.geometry.to_numpy()))
+    np.testing.assert_allclose(result['AREA'], result['LENGTH'] * result['WIDTH'])
+
+    with pytest.raises(ValueError):
+        segment_roads(roads.to_crs('EPSG:4326'), width=6.0)
+    with pytest.raises(ValueError):
+        segment_roads(roads)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from model import engine, scenario
+from model.scenario import Scenario, SegmentTable
+
+# What-ifs pushed down a node's path against a full run of the changed watershed
+
+CACHES = ['runoff', 'sediment', 'ancestor_runoff', 'ancestor_sediment', 'volume_reaching_child', 'sediment_reaching_child', 'connected', 'trapped_runoff', 'trapped_sediment', 'percent']
+
+def assert_same(scenario: Scenario, expected: Scenario) -> None:
+    for name in CACHES:
+        np.testing.assert_allclose(getattr(scenario, name), getattr(expected, name), rtol=1e-9, atol=1e-9, err_msg=name)
+    for name in ('runoff', 'sediment', 'volume_reaching_child', 'sediment_reaching_child', 'trapped_sediment', 'events_connected'):
+        np.testing.assert_allclose(getattr(scenario.aggregates, name), getattr(expected.aggregates, name), rtol=1e-9, atol=1e-9, err_msg=name)
+    assert scenario.aggregates.n_events == expected.aggregates.n_events
+
+def path_below(topology, node: int) -> list:
+    path = [node]
+    while topology.child[path[-1]] >= 0:
+        path.append(topology.child[path[-1]])
+    return path
+
+def rainfall(n_nodes: int, spatial: bool) -> np.ndarray:
+    rng = np.random.default_rng(5)
+    return rng.uniform(0, 120, (13, n_nodes) if spatial else 13)
+
+@pytest.mark.parametrize('spatial', [False, True])
+def test_recompute_in_batches(bundled, monkeypatch, spatial: bool) -> None:
+    _, topology = bundled
+    rain = rainfall(topology.n_nodes, spatial)
+    whole = Scenario(topology, rain)
+    results = engine.run_events(topology, rain)
+    np.testing.assert_array_equal(whole.runoff, results.runoff)
+    np.testing.assert_array_equal(whole.trapped_sediment, results.trapped_sediment)
+
+    monkeypatch.setattr(scenario, 'batch_size', lambda topology: 4)
+    assert_same(Scenario(topology, rain), whole)
+
+@pytest.mark.parametrize('spatial', [False, True])
+def test_changes_match_full_runs(bundled, monkeypatch, spatial: bool) -> None:
+    from model.data import roads
+    _, topology = bundled
+    monkeypatch.setattr(scenario, 'batch_size', lambda topology: 5)
+    rain = rainfall(topology.n_nodes, spatial)
+    what_if = Scenario(topology, rain, SegmentTable.from_roads(roads._gdf, topology))
+
+    # A pond on the drain with the longest path below it, then sized down, then removed
+    drains = np.flatnonzero(~topology.is_pond & (topology.child >= 0) & (topology.local_area.sum(axis=1) > 0))
+    node = int(drains[np.argmax([len(path_below(topology, drain)) for drain in drains])])
+    changes = [
+        lambda: what_if.propose_pond(node, 40.0),
+        lambda: what_if.propose_pond(node, 5.0, 1.0),
+        lambda: what_if.propose_pond_removal(node),
+    ]
+    ponds = np.flatnonzero(topology.is_pond)
+    if len(ponds):
+        changes.append(lambda: what_if.propose_pond_removal(int(ponds[0])))
+    segment = int(np.flatnonzero(what_if.segments.node >= 0)[0])
+    other = next(name for name in topology.road_types if topology.road_types.index(name) != what_if.segments.road_type[segment])
+    changes.append(lambda: what_if.propose_road_type(segment, other))
+
+    for propose in changes:
+        before = what_if.trapped_sediment.sum(axis=1).copy()
+        change = propose()
+        delta = what_if.delta(change, 'trapped_sediment')
+        what_if.apply(change)
+        rerun = Scenario(what_if.topology, rain)
+        assert_same(what_if, rerun)
+        np.testing.assert_allclose(delta, rerun.trapped_sediment.sum(axis=1) - before, rtol=1e-9, atol=1e-9)
+    assert what_if.segments.road_type[segment] == topology.road_types.index(other)
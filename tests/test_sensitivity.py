@@ -0,0 +1,74 @@
+from pathlib import Path
+import numpy as np
+import pytest
+
+from model import engine, sensitivity
+
+# The estimators on functions with known indices, and the evaluator against the engine
+
+def ishigami(points: np.ndarray) -> np.ndarray:
+    x1, x2, x3 = points.T
+    return (np.sin(x1) + 7 * np.sin(x2) ** 2 + 0.1 * x3 ** 4 * np.sin(x1))[:, None]
+
+def linear(points: np.ndarray) -> np.ndarray:
+    return (points @ np.array([4.0, -2.0, 0.0, 1.0]))[:, None]
+
+def test_sobol_ishigami() -> None:
+    # S1 = (0.3139, 0.4424, 0) and ST = (0.5576, 0.4424, 0.2437) for a = 7, b = 0.1
+    bounds = np.tile([-np.pi, np.pi], (3, 1))
+    indices = sensitivity.sobol(ishigami, ['x1', 'x2', 'x3'], bounds, 20000, np.random.default_rng(0))
+    assert indices.n_points == 20000 * 5
+    np.testing.assert_allclose(indices.indices['S1'][:, 0], [0.3139, 0.4424, 0.0], atol=0.03)
+    np.testing.assert_allclose(indices.indices['ST'][:, 0], [0.5576, 0.4424, 0.2437], atol=0.03)
+
+def test_sobol_linear() -> None:
+    # Independent inputs with variances c^2 / 12 of a total of 21 / 12, no interactions
+    bounds = np.tile([0.0, 1.0], (4, 1))
+    indices = sensitivity.sobol(linear, list('abcd'), bounds, 20000, np.random.default_rng(1))
+    np.testing.assert_allclose(indices.indices['S1'][:, 0], np.array([16, 4, 0, 1]) / 21, atol=0.03)
+    np.testing.assert_allclose(indices.indices['ST'][:, 0], np.array([16, 4, 0, 1]) / 21, atol=0.03)
+
+def test_morris_linear() -> None:
+    # Every elementary effect of a linear function is its coefficient times the parameter's range
+    bounds = np.array([[0.0, 1.0], [0.0, 2.0], [5.0, 6.0], [-1.0, 1.0]])
+    indices = sensitivity.morris(linear, list('abcd'), bounds, 30, 4, np.random.default_rng(2))
+    assert indices.n_points == 30 * 5
+    np.testing.assert_allclose(indices.indices['mu'][:, 0], [4.0, -4.0, 0.0, 2.0])
+    np.testing.assert_allclose(indices.indices['mu_star'][:, 0], [4.0, 4.0, 0.0, 2.0])
+    np.testing.assert_allclose(indices.indices['sigma'][:, 0], 0, atol=1e-12)
+
+def test_morris_ishigami_ranks() -> None:
+    bounds = np.tile([-np.pi, np.pi], (3, 1))
+    indices = sensitivity.morris(ishigami, ['x1', 'x2', 'x3'], bounds, 500, 8, np.random.default_rng(3))
+    assert np.all(indices.indices['mu_star'][:, 0] > 0)
+    assert indices.indices['sigma'][2, 0] > indices.indices['mu'][2, 0] # x3 only acts through x1
+
+def test_evaluator(bundled, tmp_path: Path) -> None:
+    # Outputs are the engine's per-event watershed means, and points are only run once, across caches
+    _, topology = bundled
+    from model.data.rainfall import InlineRainfall
+    rainfall = InlineRainfall([50, 40, 30, 44], chunk_size=3)
+    names = ['dirt.erosion_rate', 'travel_cost']
+    points = np.array([[4.0, 0.01], [2.0, 0.02], [4.0, 0.01]])
+
+    cache = sensitivity.ResultCache(tmp_path / 'cache.npz', 'inputs', len(names))
+    evaluate = sensitivity.Evaluator(topology, rainfall, 0.01, names, cache)
+    outputs = evaluate(points)
+    assert evaluate.n_runs == 2
+    np.testing.assert_array_equal(outputs[0], outputs[2])
+
+    terminal = topology.child < 0
+    for point, output in zip(points, outputs):
+        erosion = topology.erosion_rate.copy()
+        erosion[topology.road_types.index('dirt')] = point[0]
+        results = engine.run_events(topology, rainfall.values, erosion_rate=erosion, travel_cost=point[1])
+        np.testing.assert_allclose(output[sensitivity.OUTPUTS.index('sediment_out')], results.sediment_sum[:, terminal].sum(axis=1).mean(), rtol=1e-9)
+        np.testing.assert_allclose(output[sensitivity.OUTPUTS.index('connected_edges')], results.connected.sum(axis=1).mean(), rtol=1e-9)
+
+    reloaded = sensitivity.Evaluator(topology, rainfall, 0.01, names, sensitivity.ResultCache(tmp_path / 'cache.npz', 'inputs', len(names)))
+    np.testing.assert_array_equal(reloaded(points[:2]), outputs[:2])
+    assert reloaded.n_runs == 0
+
+    changed = sensitivity.Evaluator(topology, rainfall, 0.01, names, sensitivity.ResultCache(tmp_path / 'cache.npz', 'other inputs', len(names)))
+    changed(points[:1])
+    assert changed.n_runs == 1
@@ -0,0 +1,59 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+import pytest
+
+from preprocess import trim
+
+# Flowpaths between two roads, y = 0 and y = -20, traced in either direction
+
+CRS = 'EPSG:32619'
+ROADS = gpd.GeoSeries([shapely.LineString([(-50, 0), (50, 0)]), shapely.LineString([(-50, -20), (50, -20)])], crs=CRS)
+STARTS = gpd.GeoSeries([shapely.Point(0, 0), shapely.Point(20, 0), shapely.Point(-30, 0), shapely.Point(40, 0), shapely.Point(10, -20), shapely.Point(-10, 0)], crs=CRS)
+FLOWPATHS = gpd.GeoSeries([
+    shapely.LineString([(0, -40), (0, -10), (0.004, 0.003)]),               # Towards its drain, which is just off its end
+    shapely.LineString([(20, 0), (25, 0), (25, -5), (25, -30)]),             # Along its own road first
+    shapely.LineString([(-30, 0), (-30, -10), (-25, -10), (-25, -6), (-33, -6), (-33, -30)]), # Crossing itself
+    shapely.LineString([(40, 0), (40, -19.5)]),                              # Just short of the next road
+    shapely.LineString([(10, -20), (10, -10), (10, 10)]),                     # Uphill
+    shapely.LineString([(0, 0), (5, -30)]),                                  # A second path from the first drain
+    shapely.LineString([(-40, -5), (-40, -30)]),                             # From no drain
+], crs=CRS)
+
+def test_cut_lines() -> None:
+    lines = np.array([shapely.LineString([(0, 0), (10, 0), (10, 10)]), shapely.LineString([(0, 0), (0, 5)]), shapely.LineString([(0, 0), (3, 4)])])
+    cut = trim.cut_lines(lines, np.array([15, np.nan, 7]))
+    assert shapely.equals(cut, [shapely.LineString([(0, 0), (10, 0), (10, 5)]), lines[1], lines[2]]).all()
+
+def test_trim_flowpaths() -> None:
+    result = trim.trim_flowpaths(FLOWPATHS, STARTS, ROADS)
+    assert result['START'].tolist() == [0, 1, 2, 3, 4]
+    assert result['TO_ROAD'].tolist() == [True, True, True, False, True]
+    assert shapely.is_simple(result.geometry).all()
+    # Starting exactly at their point, cut at the first crossing after leaving their own road
+    np.testing.assert_array_equal(shapely.get_coordinates(shapely.get_point(result.geometry, 0)), shapely.get_coordinates(STARTS[:5]))
+    expected = [
+        [(0, 0), (0, -10), (0, -20)],
+        [(20, 0), (25, 0), (25, -5), (25, -20)],
+        [(-30, 0), (-30, -6), (-33, -6), (-33, -20)],
+        [(40, 0), (40, -19.5)],
+        [(10, -20), (10, -10), (10, 0)],
+    ]
+    for line, coordinates in zip(result.geometry, expected):
+        np.testing.assert_allclose(shapely.get_coordinates(line), coordinates, atol=1e-9)
+    np.testing.assert_allclose(result['LENGTH'], shapely.length(result.geometry))
+
+def test_trim_snaps_to_roads() -> None:
+    result = trim.trim_flowpaths(FLOWPATHS, STARTS, ROADS, snap=1.0)
+    assert result['TO_ROAD'].all()
+    np.testing.assert_array_equal(shapely.get_coordinates(result.geometry[3]), [(40, 0), (40, -19.5), (40, -20)])
+
+def test_trim_drops_uphill_paths() -> None:
+    with MemoryFile() as memory:
+        with memory.open(driver='GTiff', count=1, height=80, width=120, dtype='float64', crs=CRS, transform=from_origin(-60, 30, 1, 1)) as dem:
+            dem.write(np.repeat(np.linspace(30, -50, 80)[:, None], 120, axis=1), 1)
+        with memory.open() as dem:
+            result = trim.trim_flowpaths(FLOWPATHS, STARTS, ROADS, dem)
+    assert result['START'].tolist() == [0, 1, 2, 3]
@@ -0,0 +1,94 @@
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.features
+from rasterio.transform import from_origin
+import pytest
+
+from preprocess.zonal import STATISTICS, zonal_statistics, segment_elevation
+
+# Tiled zonal statistics against masking the whole raster for every polygon on its own
+
+NODATA = -9999.0
+
+def write_dem(path: Path, size: int = 150, seed: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[:size, :size]
+    dem = 100 + 0.3 * rows + 0.1 * cols + rng.normal(0, 2, (size, size))
+    dem[rng.random((size, size)) < 0.02] = NODATA
+    dem[rng.random((size, size)) < 0.001] = 500 # Outliers for the IQR filter
+    with rasterio.open(path, 'w', driver='GTiff', count=1, height=size, width=size, dtype='float64', crs='EPSG:32619', transform=from_origin(0, size, 1, 1), nodata=NODATA) as dst:
+        dst.write(dem, 1)
+
+def reference(polygon: shapely.Geometry, dataset, all_touched: bool) -> list:
+    values = dataset.read(1)
+    inside = rasterio.features.geometry_mask([polygon], values.shape, dataset.transform, invert=True, all_touched=all_touched)
+    values = values[inside & (values != NODATA)]
+    if not len(values):
+        return [0] + [np.nan] * (len(STATISTICS) - 1)
+    q1, q3 = np.percentile(values, [25, 75])
+    kept = values[(values >= q1 - 1.5 * (q3 - q1)) & (values <= q3 + 1.5 * (q3 - q1))]
+    return [len(values), values.min(), values.max(), values.std(), values.mean(), kept.mean()]
+
+def separate_polygons(rng: np.random.Generator, size: int = 150) -> np.ndarray:
+    # Buffered segments in cells of a 15 m grid, so that no two share a pixel
+    polygons = []
+    for x in range(0, size, 15):
+        for y in range(0, size, 15):
+            start = np.array([x + 4, y + 4]) + rng.uniform(0, 3, 2)
+            end = start + rng.uniform(-3, 6, 2)
+            polygons.append(shapely.buffer(shapely.LineString([start, end]), rng.uniform(0.4, 2), cap_style='flat'))
+    polygons.append(shapely.box(size + 10, 0, size + 20, 10)) # Outside the raster
+    return np.array(polygons)
+
+@pytest.mark.parametrize('tile_size', [16, 45, 2048])
+@pytest.mark.parametrize('all_touched', [False, True])
+def test_zonal_statistics(tmp_path: Path, tile_size: int, all_touched: bool) -> None:
+    write_dem(tmp_path / 'dem.tif')
+    polygons = separate_polygons(np.random.default_rng(tile_size))
+    with rasterio.open(tmp_path / 'dem.tif') as dataset:
+        result = zonal_statistics(polygons, dataset, tile_size=tile_size, all_touched=all_touched)
+        expected = np.array([reference(polygon, dataset, all_touched) for polygon in polygons])
+    assert list(result.columns) == STATISTICS
+    np.testing.assert_allclose(result.to_numpy(dtype=float), expected, rtol=1e-12, atol=1e-9)
+    assert result['count'].iloc[-1] == 0
+
+@pytest.mark.parametrize('tile_size', [16, 45])
+@pytest.mark.parametrize('all_touched', [False, True])
+def test_overlapping_polygons(tmp_path: Path, tile_size: int, all_touched: bool) -> None:
+    # A pixel counts for every polygon it is under: chained segments overlapping at their ends, crossing
+    # segments, and a polygon reaching across the whole raster
+    write_dem(tmp_path / 'dem.tif')
+    rng = np.random.default_rng(tile_size)
+    chain = np.cumsum(rng.uniform(1, 4, (60, 2)), axis=0)
+    polygons = np.array(
+        [shapely.buffer(shapely.LineString(chain[i:i + 2]), 2.5, cap_style='round') for i in range(len(chain) - 1)]
+        + [shapely.buffer(shapely.LineString([(0, y), (150, 150 - y)]), 3, cap_style='flat') for y in (20, 75, 130)]
+        + [shapely.buffer(shapely.LineString([(2, 2), (148, 148)]), 1.5)]
+    )
+    with rasterio.open(tmp_path / 'dem.tif') as dataset:
+        result = zonal_statistics(polygons, dataset, tile_size=tile_size, all_touched=all_touched)
+        expected = np.array([reference(polygon, dataset, all_touched) for polygon in polygons])
+    np.testing.assert_allclose(result.to_numpy(dtype=float), expected, rtol=1e-12, atol=1e-9)
+
+def test_segment_elevation(tmp_path: Path) -> None:
+    write_dem(tmp_path / 'dem.tif')
+    roads = gpd.GeoDataFrame({'WIDTH': [4.0, 0.01, 3.0]}, geometry=[
+        shapely.LineString([(10, 10), (30, 12)]),
+        shapely.LineString([(50.5, 50.5), (50.51, 50.5)]), # Covers no pixel centre
+        shapely.LineString([(80, 100), (80, 120)]),
+    ], crs='EPSG:32619')
+    result = segment_elevation(roads, tmp_path / 'dem.tif', tile_size=32)
+
+    with rasterio.open(tmp_path / 'dem.tif') as dataset:
+        polygon = shapely.buffer(roads.geometry[0], 2.0, cap_style='flat')
+        np.testing.assert_allclose(result.loc[0, ['ELE_COUNT', 'ELE_MIN', 'ELE_MAX', 'ELE_STD', 'ELE_MEAN', 'ELEVATION']].to_numpy(dtype=float), reference(polygon, dataset, False), rtol=1e-12)
+        assert result.loc[1, 'ELE_COUNT'] == 0
+        assert result.loc[1, 'ELEVATION'] == next(dataset.sample([(50.505, 50.5)]))[0]
+
+    with pytest.raises(ValueError):
+        segment_elevation(roads.drop(columns='WIDTH'), tmp_path / 'dem.tif')
+    with pytest.raises(ValueError):
+        segment_elevation(roads.set_geometry(roads.translate(1000, 0)), tmp_path / 'dem.tif')